@@ -0,0 +1,1745 @@
+#!/usr/bin/python
+
+""" **************************************************************************
+	python ontobench.py [benchmark name] [options]
+
+	Timing benchmarks for ontobucket.py and ontofetch.py.  Each benchmark
+	prints a JSON report of its timings.
+
+	Author: Damion Dooley
+
+	BENCHMARKS
+
+	dag: Compares bucket rule evaluation by walking each rule dictionary
+	(OntologyBuckets.do_bucket_rule) against evaluation of the rule set's
+	shared-subexpression DAG (ontorules.RuleDAG), checking both give the same
+	triggered buckets.  --scale N adds synthetic buckets (N x the rule file's
+	bucket count) built by recombining the rule file's own expressions, as
+	agency bucket sets tend to reuse term lists and exclusions.
+
+		python ontobench.py dag -R test/lexmapr.json -n 1000
+		python ontobench.py dag -R test/lexmapr.json -n 1000 --scale 20
+
+	optimise: Optimises a rule file with ontorules.RuleOptimiser and times
+	evaluation before and after.  It also checks, for the rule file and for
+	--random randomly generated rules, that each optimised rule gives the
+	same output as the original (by OntologyBuckets.do_bucket_rule) on every
+	subset of the entity ids the rule mentions (or on 500 random subsets if
+	it mentions more than 12), and exits with an error if any differ.
+
+		python ontobench.py optimise -R test/lexmapr.json --random 5000
+
+	scaling: Generates synthetic bucket rule sets of each --rule-counts size
+	(see RuleGenerator) and times DAG compilation, rule file loading (json
+	and pickle) and evaluation throughput for each --sample-counts number of
+	generated comparison sets.  Rule-by-rule do_bucket_rule() evaluation is
+	timed too while rules x samples is at most --tree-limit.  Rules are over
+	a synthetic --terms size term hierarchy, or over the class hierarchy of
+	an --ontology file.
+
+		python ontobench.py scaling --rule-counts 100,1000,10000 --sample-counts 100,1000
+		python ontobench.py scaling --ontology test/root-ontology.owl
+
+	query: Builds a synthetic ontology graph of --terms classes (see
+	RuleGenerator.get_synthetic_parents) with labels and deprecation
+	annotations, and times converting ontofetch.py's "tree" query result
+	by OntoHelper.do_query_table(), against a row.asdict() conversion of
+	every cell as do_query_table() used to do it (checking both give the 
+	same table), and with only the id and parent_id columns selected.
+	Raw iteration (as by OntoHelper.iter_query_table(..., raw = True)) of
+	those columns is timed for comparison.  Query time is reported apart
+	as it is the same for all.
+
+		python ontobench.py query --terms 20000
+
+	order: Builds a synthetic ontology as for query, with ui labels 
+	(GENEPIO:0000006) on a third of its terms, and times ontofetch.py's
+	"tree" query as it was with ORDER BY ?parent_id ?ui_label ?label, 
+	against the query without it followed by 
+	OntoHelper.get_hierarchy_order(), checking both give the same rows in
+	the same order.
+
+		python ontobench.py order --terms 20000
+
+	store: Writes a synthetic ontology of --terms classes (as for query) to 
+	an RDF/XML file, then in a fresh process for each, times loading it 
+	and running ontofetch.py's "tree" query, and reports peak memory: for
+	the default in-memory graph, for building an ontostore.SQLiteStore 
+	graph store file, and for reopening that store without parsing.
+
+		python ontobench.py store --terms 20000
+
+	startup: Times (median of --runs runs, each a new interpreter) 
+	ontobucket.py and ontofetch.py --version, and an ontobucket.py run
+	on -R rule file with -i ids, and with --ontology and -r, a warm -c 
+	run on its cached rules.  Each run is checked for whether it imported
+	rdflib.  Compiling ontofetch.py's queries is timed too, against 
+	loading them as saved by an earlier run (see ontohelper.QueryRegistry).
+
+		python ontobench.py startup --runs 10
+		python ontobench.py startup --ontology ../lexmapr_ontology/lexmapr.owl -r http://genepio.org/ontology/LEXMAPR_0000001
+
+	fetch: Splits a synthetic ontology of --terms classes (as for query)
+	into a main file and --imports import files it declares, serves them
+	from a local HTTP server process that delays each response by 
+	--latency milliseconds, and times loading the main file's URL as 
+	OntoHelper.do_ontology_includes() does (one file after another, by
+	rdflib), against ontoload.OntologyLoader at --concurrency.  For the
+	latter, the server fails the first request for each import file (503)
+	so that retries are exercised.  Both graphs must hold the same 
+	triples.
+
+		python ontobench.py fetch --terms 20000 --imports 8 --latency 300
+
+	compact: Compares ontofetch.py's .json output with its -f compact 
+	output (see OntoHelper.get_compact_struct()) for the terms of 
+	--ontology (by default test/root-ontology.owl), and of a synthetic 
+	ontology of --terms classes (as for query): file and gzipped sizes, 
+	and median of --runs writing and parsing times.  json_parse_ms is 
+	for json.loads() alone; parse_ms includes, for the compact file, the
+	reader's expansion back to the usual struct, which must match the 
+	.json output exactly.
+
+		python ontobench.py compact --terms 20000 --runs 5
+
+	index: Writes ontofetch.py .json and -f index output (see 
+	ontoindex.py) for a synthetic ontology of --terms classes (as for 
+	query), then in a fresh process for each, times opening it and -n 
+	random label and parent lookups by id, and reports the private 
+	(not shared, file-backed) memory it added.  Both must give the same
+	terms.
+
+		python ontobench.py index --terms 20000 -n 10000
+
+	watch: Writes a synthetic ontology of --terms classes (as for query)
+	as a main file and --imports files in its ./imports/ folder, and 
+	times a normal ontofetch.py load and build of it, against a watch 
+	mode (-w) rebuild after one label in one import file is changed.  
+	Rebuild output must match a normal build of the changed files.
+
+		python ontobench.py watch --terms 20000 --imports 8
+
+	workers: Builds a synthetic ontology as for query, and times 
+	ontofetch.py's term extraction (Ontology.iter_terms()) with each of 
+	--worker-counts worker processes (ontofetch.py -j), checking that 
+	each gives the same term records and @context as one process.  The
+	"tree" query, which isn't split between workers, is run beforehand.
+
+		python ontobench.py workers --terms 20000 --worker-counts 1,2,4,8,16,32
+
+	progress: Builds a synthetic ontology as for query, and times (median
+	of --runs) ontofetch.py's term extraction (Ontology.iter_terms()) 
+	without progress reporting, against reporting to a progress file at 
+	the default 1 second interval, and at no interval (an event at each
+	clock read, the most step() ever writes).  Term queries are cached by
+	a first run, so that the per term loop is as quick, and progress 
+	overhead as large a share of it, as it gets.  The time of a bare
+	ProgressReporter.step() call is reported too.
+
+		python ontobench.py progress --terms 20000 --runs 5
+
+	regress: Runs each of these commands, in a fresh process, and compares
+	its output files field by field with golden copies in --golden folder 
+	(by default test/regress/): JSON by path of keys and list positions,
+	tsv by term id row and column, and serve mode answers by request.
+		fetch: ontofetch.py test/root-ontology.owl (.json, .tsv and 
+			.deprecated.json).
+		bucket_rules: ontobucket.py rule compilation of 
+			test/root-ontology.owl under its AGENCY_0000001 root.
+		bucket_serve: ontobucket.py -R test/lexmapr.json serve mode 
+			answers to each of the rules' ids alone, each consecutive 
+			pair, and all together (less response times).
+	Median wall time of --runs runs and peak resident memory of each are
+	compared with those in the folder's baseline.json.  A changed output,
+	or a time (if by over 50ms) or memory over baseline by more than 
+	--tolerance percent, is reported and the benchmark exits with an error.  --update instead
+	records current outputs and performance as the new golden copies and
+	baseline; baselines are of the machine they were recorded on, so 
+	record them again (with unchanged code) before checking on another.
+
+		python ontobench.py regress --runs 3
+		python ontobench.py regress --runs 3 --update
+
+	slim: Builds a synthetic ontology as for query, and times ontofetch.py's
+	term extraction (Ontology.iter_terms()) and deprecation lookup for 
+	the small branch under a third level term, on the whole graph, 
+	against on a slim graph of that branch (see 
+	OntoHelper.set_slim_graph(), ontofetch.py --slim), whose pruning is 
+	timed too.  Both must give the same terms and @context.  A first, 
+	untimed extraction from a small graph imports rdflib and loads the
+	queries.
+
+		python ontobench.py slim --terms 50000
+
+	generate: Writes a synthetic rule file of --buckets buckets, and -n
+	comparison sets as serve mode {"ids": [...]} request lines, to the -o
+	folder as synthetic.json and synthetic.samples.jsonl.
+
+		python ontobench.py generate --buckets 5000 -n 10000 -o /tmp/
+
+	**************************************************************************
+"""
+
+import json
+import sys
+import time
+import random
+import optparse
+import os
+import pickle
+import tempfile
+import multiprocessing
+import resource
+import subprocess
+import shutil
+import gzip
+import gc
+
+import ontohelper as oh
+import ontobucket as ob
+import ontofetch as of
+import ontorules as orules
+
+try: #Python 2.7
+	from collections import OrderedDict
+except ImportError: # Python 2.6
+	from ordereddict import OrderedDict
+
+def stop_err(msg, exit_code = 1):
+	sys.stderr.write("%s\n" % msg)
+	sys.exit(exit_code)
+
+
+class MyParser(optparse.OptionParser):
+	"""
+	Allows formatted help info.  From http://stackoverflow.com/questions/1857346/python-optparse-how-to-include-additional-info-in-usage-output.
+	"""
+	def format_epilog(self, formatter):
+		return self.epilog
+
+
+class OntologyBenchmark(object):
+
+	CODE_VERSION = '0.0.4'
+	# Milliseconds over baseline a regress run's time can be, whatever the
+	# percent, as short runs vary by about this much from run to run.
+	REGRESS_SLACK_MS = 50
+
+	def __init__(self):
+
+		self.benchmarks = {
+			'dag': self.do_dag_benchmark,
+			'optimise': self.do_optimise_benchmark,
+			'scaling': self.do_scaling_benchmark,
+			'query': self.do_query_benchmark,
+			'order': self.do_order_benchmark,
+			'store': self.do_store_benchmark,
+			'startup': self.do_startup_benchmark,
+			'fetch': self.do_fetch_benchmark,
+			'compact': self.do_compact_benchmark,
+			'index': self.do_index_benchmark,
+			'watch': self.do_watch_benchmark,
+			'workers': self.do_workers_benchmark,
+			'progress': self.do_progress_benchmark,
+			'regress': self.do_regress_benchmark,
+			'slim': self.do_slim_benchmark,
+			'generate': self.do_generate
+		}
+
+
+	def __main__(self):
+
+		(options, args) = self.get_command_line()
+
+		if options.code_version:
+			print (self.CODE_VERSION)
+			return self.CODE_VERSION
+
+		if not len(args) or not args[0] in self.benchmarks:
+			stop_err('Please supply a benchmark name: ' + ', '.join(sorted(self.benchmarks)))
+
+		random.seed(options.seed)
+		report = self.benchmarks[args[0]](options)
+		print (json.dumps(report, sort_keys = False, indent = 4, separators = (',', ': ')))
+		if report.get('failures'):
+			stop_err('FAILED: ' + '; '.join(report['failures']))
+
+
+	def get_timing(self, fn, *args):
+		"""
+		Returns (result, seconds) of calling fn(*args).
+		"""
+		start = time.perf_counter()
+		result = fn(*args)
+		return (result, time.perf_counter() - start)
+
+
+	############################### DAG ###############################
+
+	def do_dag_benchmark(self, options):
+
+		buckets = ob.OntologyBuckets()
+		bucket_rules = buckets.load_rule_file(options.rules_file)
+		if options.scale:
+			bucket_rules = self.get_recombined_rules(bucket_rules, options.scale)
+
+		samples = self.get_samples(bucket_rules, options.samples)
+
+		(dag, compile_time) = self.get_timing(orules.RuleDAG, bucket_rules)
+		(tree_output, tree_time) = self.get_timing(self.do_tree_evaluation, buckets, bucket_rules, samples)
+		(dag_output, dag_time) = self.get_timing(self.do_dag_evaluation, dag, samples)
+
+		if tree_output != dag_output:
+			stop_err('ERROR: DAG and rule dictionary evaluation differ!')
+
+		report = OrderedDict()
+		report['rules_file'] = options.rules_file
+		report['buckets'] = len(bucket_rules)
+		report['samples'] = len(samples)
+		report['triggered'] = sum(len(output) for output in dag_output)
+		report['sharing'] = dag.get_sharing_report(top = 0)
+		del report['sharing']['most_shared']
+		report['dag_compile_ms'] = round(compile_time * 1000, 3)
+		report['tree_us_per_sample'] = round(tree_time * 1000000 / len(samples), 2)
+		report['dag_us_per_sample'] = round(dag_time * 1000000 / len(samples), 2)
+		report['speedup'] = round(tree_time / dag_time, 2) if dag_time else None
+
+		return report
+
+
+	def do_tree_evaluation(self, buckets, bucket_rules, samples):
+
+		outputs = []
+		for sample in samples:
+			buckets.comparison_set = sample
+			triggered = {}
+			for bucket_id, rule in bucket_rules.items():
+				output = buckets.do_bucket_rule(rule)
+				if output != {False}:
+					triggered[bucket_id] = output
+			outputs.append(triggered)
+
+		return outputs
+
+
+	def do_dag_evaluation(self, dag, samples):
+
+		outputs = []
+		for sample in samples:
+			outputs.append(dict((bucket_id, set(output)) for (bucket_id, output) in dag.evaluate(sample) if output != {False}))
+
+		return outputs
+
+
+	def get_recombined_rules(self, bucket_rules, scale):
+		"""
+		Adds scale x len(bucket_rules) synthetic buckets, each either a copy
+		of an existing bucket's expression, or the intersection of one
+		bucket's expression with the complement of another's.
+		"""
+		bodies = [rule.get('owl:someValuesFrom', rule) for rule in bucket_rules.values()]
+		rules = OrderedDict(bucket_rules)
+
+		for ptr in range(scale * len(bucket_rules)):
+			body = random.choice(bodies)
+			if random.random() < 0.5:
+				rule = {'owl:someValuesFrom': body}
+			else:
+				rule = {'owl:someValuesFrom': {'owl:intersectionOf': {
+					'owl:someValuesFrom': body,
+					'owl:complementOf': {'owl:someValuesFrom': random.choice(bodies)}
+				}}}
+			rules['SYNTHETIC:%07d' % ptr] = rule
+
+		return rules
+
+
+	def get_samples(self, bucket_rules, count):
+		"""
+		Random comparison sets of 1-8 ids drawn from the entity ids that rules
+		mention, plus an id no rule mentions.
+		"""
+		ids = sorted(orules.RuleDAG(bucket_rules).get_ids())
+
+		samples = []
+		for ptr in range(count):
+			sample = set(random.sample(ids, min(len(ids), random.randint(1, 8))))
+			sample.add('NOMATCH:%07d' % ptr)
+			samples.append(sample)
+
+		return samples
+
+
+	############################ OPTIMISE #############################
+
+	# Rules mentioning more entity ids than this are checked on random
+	# subsets rather than all subsets.
+	EXHAUSTIVE_IDS = 12
+
+	def do_optimise_benchmark(self, options):
+
+		buckets = ob.OntologyBuckets()
+		bucket_rules = buckets.load_rule_file(options.rules_file)
+		if options.scale:
+			bucket_rules = self.get_recombined_rules(bucket_rules, options.scale)
+
+		optimiser = orules.RuleOptimiser()
+		(optimised, optimise_time) = self.get_timing(optimiser.get_optimised_rules, bucket_rules)
+
+		samples = self.get_samples(bucket_rules, options.samples)
+		(tree_output, tree_time) = self.get_timing(self.do_tree_evaluation, buckets, bucket_rules, samples)
+		(optimised_output, optimised_time) = self.get_timing(self.do_tree_evaluation, buckets, optimised, samples)
+		dag = orules.RuleDAG(bucket_rules)
+		optimised_dag = orules.RuleDAG(optimised)
+		(dag_output, dag_time) = self.get_timing(self.do_dag_evaluation, dag, samples)
+		(optimised_dag_output, optimised_dag_time) = self.get_timing(self.do_dag_evaluation, optimised_dag, samples)
+
+		if not (tree_output == optimised_output == dag_output == optimised_dag_output):
+			stop_err('ERROR: optimised rule set evaluation differs on samples!')
+
+		report = OrderedDict()
+		report['rules_file'] = options.rules_file
+		report['buckets'] = len(bucket_rules)
+		report['rewrites'] = optimiser.counts
+		report['dag_nodes'] = len(dag.nodes)
+		report['optimised_dag_nodes'] = len(optimised_dag.nodes)
+		report['optimise_ms'] = round(optimise_time * 1000, 3)
+		report['tree_us_per_sample'] = round(tree_time * 1000000 / len(samples), 2)
+		report['optimised_tree_us_per_sample'] = round(optimised_time * 1000000 / len(samples), 2)
+		report['dag_us_per_sample'] = round(dag_time * 1000000 / len(samples), 2)
+		report['optimised_dag_us_per_sample'] = round(optimised_dag_time * 1000000 / len(samples), 2)
+
+		report['rule_file_check'] = self.do_equivalence_check(buckets, bucket_rules, optimised)
+
+		if options.random:
+			ids = ['TERM:%07d' % ptr for ptr in range(40)]
+			random_rules = OrderedDict(('RANDOM:%07d' % ptr, self.get_random_rule(ids, options.depth, options.width)) for ptr in range(options.random))
+			random_optimiser = orules.RuleOptimiser()
+			report['random_check'] = self.do_equivalence_check(buckets, random_rules, random_optimiser.get_optimised_rules(random_rules))
+			report['random_check']['rewrites'] = random_optimiser.counts
+
+		return report
+
+
+	def do_equivalence_check(self, buckets, bucket_rules, optimised):
+		"""
+		Compares each rule's output with its optimised rule's output on all
+		(or random) subsets of the entity ids it mentions.
+		"""
+		check = OrderedDict([('rules', 0), ('exhaustive', 0), ('comparison_sets', 0)])
+		for (bucket_id, rule) in bucket_rules.items():
+			ids = sorted(orules.get_rule_ids(rule) | orules.get_rule_ids(optimised[bucket_id]))
+			if len(ids) <= self.EXHAUSTIVE_IDS:
+				subsets = [set(ids[ptr] for ptr in range(len(ids)) if mask >> ptr & 1) for mask in range(2 ** len(ids))]
+				check['exhaustive'] += 1
+			else:
+				subsets = [set(ptr for ptr in ids if random.random() < 0.5) for count in range(500)]
+
+			for subset in subsets:
+				buckets.comparison_set = subset
+				if buckets.do_bucket_rule(rule) != buckets.do_bucket_rule(optimised[bucket_id]):
+					stop_err('ERROR: optimised ' + bucket_id + ' differs on ' + str(sorted(subset)) + ':\n' + json.dumps(rule) + '\n' + json.dumps(optimised[bucket_id]))
+
+			check['rules'] += 1
+			check['comparison_sets'] += len(subsets)
+
+		return check
+
+
+	def get_random_rule(self, ids, depth, width):
+		"""
+		Random rule dictionary of 0-2 entity ids and up to width distinct
+		rule functions, nested up to depth, including degenerate (empty) 
+		expressions that the optimiser can fold.
+		"""
+		rule = OrderedDict((item, None) for item in random.sample(ids, random.randint(0, 2)))
+		if depth > 0:
+			functions = list(orules.RuleDAG.FUNCTIONS)
+			for item in random.sample(functions, random.randint(0, min(width, len(functions)))):
+				content = self.get_random_rule(ids, depth - 1, width) if random.random() < 0.9 else {}
+				if orules.RuleDAG.FUNCTIONS[item] in orules.RuleOptimiser.CARDINALITIES:
+					content = {'limit': random.randint(0, 3), 'set': content}
+				rule[item] = content
+
+		return rule
+
+
+	############################# SCALING #############################
+
+	def get_generator(self, options):
+
+		if options.ontology:
+			# Ontology loading progress messages would mix with report.
+			stdout = sys.stdout
+			sys.stdout = sys.stderr
+			try:
+				parents = self.get_ontology_parents(options.ontology)
+			finally:
+				sys.stdout = stdout
+		else:
+			parents = RuleGenerator.get_synthetic_parents(options.terms, options.branching)
+
+		return RuleGenerator(parents, options.depth, options.width)
+
+
+	def get_ontology_parents(self, ontology_file):
+		"""
+		rdfs:subClassOf parents of each named class in given ontology (and
+		its imports), as entity ids.
+		"""
+		buckets = ob.OntologyBuckets()
+		buckets.load_ontology(ontology_file)
+		graph = buckets.onto_helper.graph
+
+		parents = OrderedDict()
+		for term in sorted(set(graph.subjects(buckets.TYPE, buckets.CLASS)) | set(graph.subjects(buckets.SUBCLASS_OF, None))):
+			if type(term) is ob.rdflib.term.URIRef:
+				parents[buckets.get_node_value(term)] = [buckets.get_node_value(parent) for parent in graph.objects(term, buckets.SUBCLASS_OF) if type(parent) is ob.rdflib.term.URIRef]
+
+		return parents
+
+
+	def do_scaling_benchmark(self, options):
+
+		buckets = ob.OntologyBuckets()
+		generator = self.get_generator(options)
+		temp_folder = tempfile.mkdtemp()
+
+		report = OrderedDict()
+		report['terms'] = len(generator.terms)
+		report['depth'] = options.depth
+		report['width'] = options.width
+		report['runs'] = []
+
+		for rule_count in [int(count) for count in options.rule_counts.split(',')]:
+			bucket_rules = generator.get_rules(rule_count)
+
+			run = OrderedDict()
+			run['buckets'] = rule_count
+			(dag, compile_time) = self.get_timing(orules.RuleDAG, bucket_rules)
+			run['rule_ids'] = len(dag.get_ids())
+			run['dag_nodes'] = len(dag.nodes)
+			run['dag_compile_ms'] = round(compile_time * 1000, 3)
+
+			# Rule file loading, as by -R, in both formats.
+			rule_file_path = os.path.join(temp_folder, 'rules')
+			with open(rule_file_path + '.json', 'w') as output_handle:
+				json.dump(bucket_rules, output_handle)
+			with open(rule_file_path + '.pickle', 'wb') as output_handle:
+				pickle.dump(bucket_rules, output_handle, pickle.HIGHEST_PROTOCOL)
+
+			run['json_bytes'] = os.path.getsize(rule_file_path + '.json')
+			run['json_load_ms'] = round(self.get_timing(buckets.load_rule_file, rule_file_path + '.json')[1] * 1000, 3)
+			run['pickle_load_ms'] = round(self.get_timing(buckets.load_rule_file, rule_file_path + '.pickle')[1] * 1000, 3)
+
+			run['evaluation'] = []
+			for sample_count in [int(count) for count in options.sample_counts.split(',')]:
+				samples = generator.get_samples(sample_count)
+				evaluation = OrderedDict()
+				evaluation['samples'] = sample_count
+				evaluation['mean_ids'] = round(float(sum(len(sample) for sample in samples)) / sample_count, 1)
+
+				(dag_output, dag_time) = self.get_timing(self.do_dag_evaluation, dag, samples)
+				evaluation['triggered_per_sample'] = round(float(sum(len(output) for output in dag_output)) / sample_count, 2)
+				evaluation['dag_samples_per_s'] = round(sample_count / dag_time, 1) if dag_time else None
+
+				if rule_count * sample_count <= options.tree_limit:
+					(tree_output, tree_time) = self.get_timing(self.do_tree_evaluation, buckets, bucket_rules, samples)
+					if tree_output != dag_output:
+						stop_err('ERROR: DAG and rule dictionary evaluation differ!')
+					evaluation['tree_samples_per_s'] = round(sample_count / tree_time, 1) if tree_time else None
+
+				run['evaluation'].append(evaluation)
+
+			report['runs'].append(run)
+
+		for file_name in os.listdir(temp_folder):
+			os.remove(os.path.join(temp_folder, file_name))
+		os.rmdir(temp_folder)
+
+		return report
+
+
+	############################## QUERY ##############################
+
+	def do_query_benchmark(self, options):
+
+		ontology = of.Ontology()
+		helper = ontology.onto_helper
+		self.add_synthetic_ontology(helper, RuleGenerator.get_synthetic_parents(options.terms, options.branching))
+
+		query = ontology.queries['tree']
+		bindings = {'root': ob.rdflib.term.URIRef('http://purl.obolibrary.org/obo/SYNTH_0000000')}
+
+		# Query is run once; conversions are timed on its rows.
+		result = helper.graph.query(query, initBindings = bindings)
+		(rows, query_time) = self.get_timing(list, result)
+		names = [str(var) for var in result.vars]
+		selected = [(names.index(column), column) for column in ('id', 'parent_id')]
+
+		(reference, reference_time) = self.get_timing(self.do_reference_table, helper, rows)
+		(table, table_time) = self.get_timing(lambda: list(helper.get_table_rows(rows, list(enumerate(names)))))
+		(selected_table, selected_time) = self.get_timing(lambda: list(helper.get_table_rows(rows, selected)))
+		(raw_count, raw_time) = self.get_timing(lambda: sum(1 for row in rows for value in (row[0], row[2])))
+
+		if table != reference:
+			stop_err('ERROR: do_query_table() and row.asdict() conversion differ!')
+		if table != helper.do_query_table(query, bindings):
+			stop_err('ERROR: do_query_table() differs from its conversion of query rows!')
+
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['triples'] = len(helper.graph)
+		report['rows'] = len(table)
+		report['query_ms'] = round(query_time * 1000, 1)
+		report['asdict_conversion_ms'] = round(reference_time * 1000, 1)
+		report['conversion_ms'] = round(table_time * 1000, 1)
+		report['selected_conversion_ms'] = round(selected_time * 1000, 1)
+		report['raw_iteration_ms'] = round(raw_time * 1000, 1)
+		report['speedup'] = round(reference_time / table_time, 2) if table_time else None
+
+		return report
+
+
+	def do_order_benchmark(self, options):
+
+		ontology = of.Ontology()
+		helper = ontology.onto_helper
+		parents = RuleGenerator.get_synthetic_parents(options.terms, options.branching)
+		self.add_synthetic_ontology(helper, parents)
+		rdflib = ob.rdflib
+		for (ptr, term) in enumerate(parents):
+			if ptr % 3 == 0:
+				uri = rdflib.term.URIRef('http://purl.obolibrary.org/obo/' + term.replace(':', '_'))
+				helper.graph.add((uri, ontology.UI_LABEL, rdflib.term.Literal('ui label %d' % (ptr % 7), lang = 'en')))
+				if ptr % 9 == 0:
+					helper.graph.add((uri, ontology.UI_LABEL, rdflib.term.Literal('alternate ui label %d' % (ptr % 5))))
+
+		# The "tree" query as it was before get_hierarchy_order().
+		ordered_query = oh.QueryRegistry({'tree': ontology.queries.sources['tree'].replace(
+			'OPTIONAL {?id rdfs:label ?label}.',
+			'OPTIONAL {?id rdfs:label ?label}.\n OPTIONAL {?id GENEPIO:0000006 ?ui_label}.'
+			).rstrip() + '\nORDER BY ?parent_id ?ui_label ?label'}, helper.namespace)['tree']
+		bindings = {'root': rdflib.term.URIRef('http://purl.obolibrary.org/obo/SYNTH_0000000')}
+
+		(reference, reference_time) = self.get_timing(lambda: list(helper.graph.query(ordered_query, initBindings = bindings)))
+		(rows, query_time) = self.get_timing(lambda: list(helper.graph.query(ontology.queries['tree'], initBindings = bindings)))
+		names = [str(var) for var in helper.graph.query(ontology.queries['tree'], initBindings = bindings).vars]
+		(ordered, order_time) = self.get_timing(helper.get_hierarchy_order, rows, names.index('id'), names.index('parent_id'), names.index('label'), ontology.UI_LABEL)
+
+		if [tuple(row) for row in ordered] != [tuple(row) for row in reference]:
+			stop_err('ERROR: get_hierarchy_order() and ORDER BY give different row order!')
+
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['rows'] = len(rows)
+		report['order_by_query_ms'] = round(reference_time * 1000, 1)
+		report['query_ms'] = round(query_time * 1000, 1)
+		report['hierarchy_order_ms'] = round(order_time * 1000, 1)
+		report['speedup'] = round(reference_time / (query_time + order_time), 2)
+		return report
+
+
+	def do_store_benchmark(self, options):
+
+		ontology = of.Ontology()
+		self.add_synthetic_ontology(ontology.onto_helper, RuleGenerator.get_synthetic_parents(options.terms, options.branching))
+		temp_folder = tempfile.mkdtemp()
+		ontology_file = os.path.join(temp_folder, 'synthetic.owl')
+		store_path = os.path.join(temp_folder, 'synthetic.graph.sqlite')
+		ontology.onto_helper.graph.serialize(ontology_file, format = 'xml')
+
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['triples'] = len(ontology.onto_helper.graph)
+		report['ontology_bytes'] = os.path.getsize(ontology_file)
+		del ontology
+
+		# Each run is in a new interpreter so its peak memory is its own.
+		pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild = 1)
+		try:
+			for (name, graph_store) in (('memory', None), ('sqlite_build', store_path), ('sqlite_reopen', store_path)):
+				report[name] = pool.apply(do_store_run, (ontology_file, graph_store))
+		finally:
+			pool.close()
+
+		report['store_bytes'] = sum(os.path.getsize(store_path + suffix) for suffix in ('', '-wal') if os.path.isfile(store_path + suffix))
+
+		for file_name in os.listdir(temp_folder):
+			os.remove(os.path.join(temp_folder, file_name))
+		os.rmdir(temp_folder)
+
+		return report
+
+
+	def do_startup_benchmark(self, options):
+
+		temp_folder = tempfile.mkdtemp()
+		script_folder = os.path.dirname(os.path.realpath(__file__))
+		bucket_script = os.path.join(script_folder, 'ontobucket.py')
+		fetch_script = os.path.join(script_folder, 'ontofetch.py')
+		with open(options.rules_file) as input_handle:
+			ids = sorted(orules.RuleDAG(json.load(input_handle)).get_ids())[0:3]
+
+		commands = OrderedDict()
+		commands['ontobucket_version'] = [bucket_script, '-v']
+		commands['ontofetch_version'] = [fetch_script, '-v']
+		commands['ontobucket_rule_file'] = [bucket_script, '-R', options.rules_file, '-i', ','.join(ids)]
+		if options.ontology and options.root:
+			commands['ontobucket_cached'] = [bucket_script, options.ontology, '-r', options.root, '-o', temp_folder + os.sep, '-c', '-i', ','.join(ids)]
+
+		report = OrderedDict()
+		report['runs'] = options.runs
+		try:
+			env = dict(os.environ, ONTOFETCH_QUERY_CACHE = os.path.join(temp_folder, 'queries'))
+			report['python_ms'] = self.get_startup_timing([sys.executable, '-c', 'pass'], env, options.runs)[0]
+			for (name, command) in commands.items():
+				# Untimed first run writes any cached rules.
+				self.get_startup_timing([sys.executable] + command, env, 1)
+				(run_ms, rdflib_imported) = self.get_startup_timing([sys.executable] + command, env, options.runs)
+				report[name] = OrderedDict([('ms', run_ms), ('imports_rdflib', rdflib_imported)])
+
+			report['rdflib_import_ms'] = self.get_startup_timing([sys.executable, '-c', 'import rdflib.plugins.sparql'], env, options.runs)[0]
+
+			ontology = of.Ontology()
+			sources = ontology.queries.sources
+			sources.update(ontology.onto_helper.queries.sources)
+			ontology.queries['tree'] # Imports rdflib before anything is timed.
+			report['queries'] = len(sources)
+			for (name, cache_folder) in (('query_compile_ms', None), ('query_save_ms', os.path.join(temp_folder, 'saved')), ('query_load_ms', os.path.join(temp_folder, 'saved'))):
+				registry = oh.QueryRegistry(sources, ontology.onto_helper.namespace, cache_folder)
+				report[name] = round(self.get_timing(registry.items)[1] * 1000, 1)
+		finally:
+			shutil.rmtree(temp_folder)
+
+		return report
+
+
+	def get_startup_timing(self, command, env, runs):
+		"""
+		Returns (median milliseconds, whether rdflib was imported) of given
+		number of runs of command, run with python -X importtime for the 
+		last of them.
+		"""
+		timings = []
+		for ptr in range(runs):
+			start = time.perf_counter()
+			subprocess.check_call(command, env = env, stdout = subprocess.DEVNULL)
+			timings.append(time.perf_counter() - start)
+
+		traced = subprocess.run(command[0:1] + ['-X', 'importtime'] + command[1:], env = env, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
+		rdflib_imported = ' rdflib.term\n' in traced.stderr
+
+		timings.sort()
+		return (round(timings[len(timings) // 2] * 1000, 1), rdflib_imported)
+
+
+	def do_fetch_benchmark(self, options):
+
+		rdflib = ob.rdflib
+		source = of.Ontology().onto_helper
+		self.add_synthetic_ontology(source, RuleGenerator.get_synthetic_parents(options.terms, options.branching))
+		temp_folder = tempfile.mkdtemp()
+		triples = set(source.graph)
+
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['imports'] = options.imports
+		report['triples'] = len(triples)
+		report['latency_ms'] = options.latency
+		report['concurrency'] = options.concurrency
+
+		graphs = {}
+		context = multiprocessing.get_context('spawn')
+		try:
+			for (name, failures) in (('serial', 0), ('concurrent', 1)):
+				queue = context.Queue()
+				server = context.Process(target = do_http_server, args = (temp_folder, options.latency / 1000.0, failures, queue))
+				server.start()
+				base_url = queue.get()
+				try:
+					self.write_split_ontology(triples, options.imports, temp_folder, base_url)
+					helper = oh.OntoHelper()
+					helper.verbose = False
+					helper.fetch_concurrency = options.concurrency
+					main_url = base_url + 'main.owl'
+					if name == 'serial':
+						start = time.perf_counter()
+						helper.graph.parse(main_url, format = 'xml')
+						helper.do_ontology_includes(main_url)
+					else:
+						start = time.perf_counter()
+						helper.do_ontology_load(main_url)
+					report[name + '_ms'] = round((time.perf_counter() - start) * 1000, 1)
+					graphs[name] = helper.graph
+				finally:
+					server.terminate()
+					server.join()
+
+		finally:
+			shutil.rmtree(temp_folder)
+
+		# Ontology header triples name the server's port, so are left out.
+		ontology_type = (rdflib.RDF.type, rdflib.OWL.Ontology)
+		for (name, graph) in graphs.items():
+			headers = set(graph.subjects(*ontology_type))
+			report[name + '_triples'] = len(graph)
+			graphs[name] = set(triple for triple in graph if not triple[0] in headers)
+		if graphs['serial'] != graphs['concurrent'] or not triples <= graphs['serial']:
+			stop_err('ERROR: serial and concurrent loading give different graphs!')
+
+		report['speedup'] = round(report['serial_ms'] / report['concurrent_ms'], 2)
+		return report
+
+
+	def do_compact_benchmark(self, options):
+
+		ontology_file = options.ontology or 'test/root-ontology.owl'
+		(metadata, context, terms) = of.fetch_terms(ontology_file)
+		structs = OrderedDict()
+		structs[os.path.basename(ontology_file)] = OrderedDict([('@context', context), ('metadata', metadata), ('specifications', OrderedDict((term['id'], term) for term in terms))])
+
+		structs['synthetic'] = self.get_synthetic_struct(options)
+
+		helper = oh.OntoHelper()
+		report = OrderedDict()
+		report['runs'] = options.runs
+		for (name, struct) in structs.items():
+			formats = OrderedDict()
+			formats['json'] = (
+				lambda: json.dumps(struct, sort_keys = False, indent = 4, separators = (',', ': ')),
+				lambda text: json.loads(text, object_pairs_hook = OrderedDict)
+			)
+			formats['compact'] = (
+				lambda: json.dumps(helper.get_compact_struct(struct), sort_keys = False, separators = (',', ':')),
+				lambda text: helper.get_expanded_struct(json.loads(text, object_pairs_hook = OrderedDict))
+			)
+
+			result = OrderedDict([('terms', len(struct['specifications']))])
+			for (format_name, (write, read)) in formats.items():
+				text = write()
+				if json.dumps(read(text)) != json.dumps(struct):
+					stop_err('ERROR: %s output of %s does not read back as written!' % (format_name, name))
+				result[format_name] = OrderedDict([
+					('bytes', len(text.encode('utf-8'))),
+					('gzip_bytes', len(gzip.compress(text.encode('utf-8')))),
+					('write_ms', self.get_median_ms(write, options.runs)),
+					('json_parse_ms', self.get_median_ms(json.loads, options.runs, text)),
+					('parse_ms', self.get_median_ms(read, options.runs, text))
+				])
+
+			result['size_ratio'] = round(result['json']['bytes'] / result['compact']['bytes'], 2)
+			result['parse_speedup'] = round(result['json']['parse_ms'] / result['compact']['parse_ms'], 2)
+			report[name] = result
+
+		return report
+
+
+	def get_synthetic_struct(self, options):
+		"""
+		Returns ontofetch.py struct of a synthetic ontology of --terms
+		classes (as for query).
+		"""
+		ontology = of.Ontology()
+		ontology.onto_helper.verbose = False
+		self.add_synthetic_ontology(ontology.onto_helper, RuleGenerator.get_synthetic_parents(options.terms, options.branching))
+		struct = ontology.onto_helper.struct
+		struct['specifications'] = OrderedDict((term['id'], term) for term in ontology.iter_terms(['http://purl.obolibrary.org/obo/SYNTH_0000000']))
+		return struct
+
+
+	def do_index_benchmark(self, options):
+
+		struct = self.get_synthetic_struct(options)
+		specifications = struct['specifications']
+		ids = list(specifications)
+		sample_ids = [random.choice(ids) for ptr in range(options.samples)]
+		temp_folder = tempfile.mkdtemp()
+		basename = os.path.join(temp_folder, 'synthetic')
+
+		helper = oh.OntoHelper()
+		helper.do_output_json(struct, basename)
+		(_, index_time) = self.get_timing(helper.do_output_index, struct, basename)
+
+		report = OrderedDict()
+		report['terms'] = len(ids)
+		report['lookups'] = len(sample_ids)
+		report['json_bytes'] = os.path.getsize(basename + '.json')
+		report['index_bytes'] = os.path.getsize(basename + '.index')
+		report['index_write_ms'] = round(index_time * 1000, 1)
+
+		# Each run is in a new interpreter so its memory use is its own.
+		pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild = 1)
+		try:
+			for (name, file_path) in (('json', basename + '.json'), ('index', basename + '.index')):
+				(report[name], terms) = pool.apply(do_index_run, (file_path, sample_ids))
+				if terms != [dict((key, specifications[id].get(key)) for key in ('id', 'label', 'parent_id')) for id in sample_ids]:
+					stop_err('ERROR: %s lookups give wrong terms!' % name)
+		finally:
+			pool.close()
+			shutil.rmtree(temp_folder)
+
+		return report
+
+
+	def do_watch_benchmark(self, options):
+
+		source = of.Ontology().onto_helper
+		self.add_synthetic_ontology(source, RuleGenerator.get_synthetic_parents(options.terms, options.branching))
+		temp_folder = tempfile.mkdtemp()
+		imports_folder = os.path.join(temp_folder, 'imports')
+		os.mkdir(imports_folder)
+		self.write_split_ontology(set(source.graph), options.imports, imports_folder, 'http://example.org/synthetic/')
+		main_file = os.path.join(temp_folder, 'main.owl')
+		os.rename(os.path.join(imports_folder, 'main.owl'), main_file)
+		# ontofetch.py option defaults, so every option do_build() reads is set.
+		build_options = of.Ontology().get_command_line(['-r', 'http://purl.obolibrary.org/obo/SYNTH_0000000'])[0]
+
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['imports'] = options.imports
+
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			ontology = of.Ontology()
+			ontology.onto_helper.verbose = False
+			start = time.perf_counter()
+			ontology.read_ontology(main_file)
+			ontology.do_build(build_options, os.path.join(temp_folder, 'full'))
+			report['full_build_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+			watched = of.Ontology()
+			helper = watched.onto_helper
+			helper.verbose = False
+			helper.local_queries.update([watched.queries['entity_text'], helper.queries['entity_synonyms']])
+			start = time.perf_counter()
+			helper.do_ontology_load_sources(main_file)
+			watched.do_build(build_options, os.path.join(temp_folder, 'watch'))
+			report['watch_first_build_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+			# One term's label is changed in one import file.
+			import_file = os.path.join(imports_folder, 'import1.owl')
+			with open(import_file) as input_handle:
+				content = input_handle.read()
+			with open(import_file, 'w') as output_handle:
+				output_handle.write(content.replace('>synthetic term ', '>renamed term ', 1))
+			os.utime(import_file, (time.time(), os.path.getmtime(import_file) + 1))
+
+			start = time.perf_counter()
+			subjects = watched.do_rebuild(main_file, helper.get_changed_sources(), build_options, os.path.join(temp_folder, 'watch'))
+			report['watch_rebuild_ms'] = round((time.perf_counter() - start) * 1000, 1)
+			report['changed_subjects'] = len(subjects)
+
+			ontology = of.Ontology()
+			ontology.onto_helper.verbose = False
+			ontology.read_ontology(main_file)
+			ontology.do_build(build_options, os.path.join(temp_folder, 'full'))
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+
+		with open(os.path.join(temp_folder, 'full.json')) as full_handle, open(os.path.join(temp_folder, 'watch.json')) as watch_handle:
+			if full_handle.read() != watch_handle.read():
+				stop_err('ERROR: watch mode rebuild differs from a full build!')
+		shutil.rmtree(temp_folder)
+
+		report['speedup'] = round(report['full_build_ms'] / report['watch_rebuild_ms'], 2)
+		return report
+
+
+	def do_workers_benchmark(self, options):
+
+		parents = RuleGenerator.get_synthetic_parents(options.terms, options.branching)
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['cpus'] = multiprocessing.cpu_count()
+		report['runs'] = []
+		expected = None
+		for workers in [int(count) for count in options.worker_counts.split(',')]:
+			# A new graph each time, so no run gets another's cached queries.
+			ontology = of.Ontology()
+			ontology.onto_helper.verbose = False
+			self.add_synthetic_ontology(ontology.onto_helper, parents)
+			ontology.get_tree_table('http://purl.obolibrary.org/obo/SYNTH_0000000')
+			ontology.workers = workers
+
+			(terms, seconds) = self.get_timing(lambda: list(ontology.iter_terms(['http://purl.obolibrary.org/obo/SYNTH_0000000'])))
+			output = (terms, list(ontology.onto_helper.struct['@context'].items()))
+			if expected is None:
+				(expected, baseline) = (output, seconds)
+			elif output != expected:
+				stop_err('ERROR: %d workers give different terms than one!' % workers)
+
+			run = OrderedDict()
+			run['workers'] = workers
+			run['ms'] = round(seconds * 1000, 1)
+			run['speedup'] = round(baseline / seconds, 2)
+			report['runs'].append(run)
+
+		return report
+
+
+	def do_progress_benchmark(self, options):
+
+		root = 'http://purl.obolibrary.org/obo/SYNTH_0000000'
+		ontology = of.Ontology()
+		helper = ontology.onto_helper
+		helper.verbose = False
+		self.add_synthetic_ontology(helper, RuleGenerator.get_synthetic_parents(options.terms, options.branching))
+		expected = list(ontology.iter_terms([root]))
+
+		folder = tempfile.mkdtemp()
+		report = OrderedDict()
+		report['terms'] = options.terms
+		try:
+			for (name, interval) in [('off', None), ('file', 1.0), ('file_no_interval', 0)]:
+				file_path = os.path.join(folder, name + '.progress.jsonl')
+				helper.progress = oh.ProgressReporter(None, file_path, interval) if interval is not None else oh.ProgressReporter()
+				report[name + '_ms'] = self.get_median_ms(lambda: list(ontology.iter_terms([root])), options.runs)
+				helper.progress.close()
+				if list(ontology.iter_terms([root])) != expected:
+					stop_err('ERROR: Progress reporting changed terms!')
+				if interval is not None:
+					with open(file_path) as input_handle:
+						report[name + '_events'] = sum(1 for line in input_handle)
+
+			report['overhead_percent'] = round(100.0 * (report['file_ms'] - report['off_ms']) / report['off_ms'], 2)
+
+			progress = oh.ProgressReporter(None, os.path.join(folder, 'step.progress.jsonl'))
+			progress.start('step', 1000000)
+			(result, seconds) = self.get_timing(lambda: [progress.step() for ptr in range(1000000)])
+			progress.close()
+			report['step_ns'] = round(seconds * 1000, 1)
+		finally:
+			shutil.rmtree(folder)
+
+		return report
+
+
+	def do_slim_benchmark(self, options):
+
+		parents = RuleGenerator.get_synthetic_parents(options.terms, options.branching)
+		# First child of first child of root's first child.
+		root = 'http://purl.obolibrary.org/obo/SYNTH_%07d' % ((options.branching + 1) * options.branching + 1)
+		ontology = of.Ontology()
+		ontology.onto_helper.verbose = False
+		self.add_synthetic_ontology(ontology.onto_helper, RuleGenerator.get_synthetic_parents(100, options.branching))
+		list(ontology.iter_terms())
+
+		report = OrderedDict()
+		report['terms'] = options.terms
+		report['root'] = root
+		expected = None
+		for slim in (False, True):
+			# A new graph each time, so neither run gets cached queries.
+			ontology = None
+			gc.collect()
+			ontology = of.Ontology()
+			helper = ontology.onto_helper
+			helper.verbose = False
+			self.add_synthetic_ontology(helper, parents)
+			name = 'slim' if slim else 'full'
+			report[name + '_triples'] = len(helper.graph)
+			if slim:
+				((branch_terms, triples), seconds) = self.get_timing(helper.set_slim_graph, [root], [ontology.DEPRECATED, ontology.REPLACED_BY])
+				report['branch_terms'] = branch_terms
+				report['slim_triples'] = triples
+				report['prune_ms'] = round(seconds * 1000, 1)
+
+			(terms, seconds) = self.get_timing(lambda: list(ontology.iter_terms([root])))
+			output = (terms, list(helper.struct['@context'].items()), ontology.get_replacements())
+			report[name + '_ms'] = round(seconds * 1000, 1)
+			if expected is None:
+				expected = output
+			elif output != expected:
+				stop_err('ERROR: Slim graph gives different terms than whole graph!')
+
+		report['speedup'] = round(report['full_ms'] / (report['slim_ms'] + report['prune_ms']), 2)
+		return report
+
+
+	def get_regress_cases(self, rule_ids):
+		"""
+		Returns name -> (command arguments after python, given output 
+		folder; stdin text or None; output files compared) of regress
+		benchmark commands.  Serve mode answers are written to serve.jsonl.
+		"""
+		script_folder = os.path.dirname(os.path.realpath(__file__))
+		requests = [[id] for id in rule_ids] + [rule_ids[ptr: ptr + 2] for ptr in range(len(rule_ids) - 1)] + [rule_ids]
+
+		cases = OrderedDict()
+		cases['fetch'] = (lambda folder: [os.path.join(script_folder, 'ontofetch.py'), 'test/root-ontology.owl', '-o', folder + os.sep], None, ['root-ontology.json', 'root-ontology.tsv', 'root-ontology.deprecated.json'])
+		# Two roots sharing terms, e.g. FOODON:00001253, with a parent under each.
+		cases['fetch_roots'] = (lambda folder: [os.path.join(script_folder, 'ontofetch.py'), 'test/root-ontology.owl', '-r', 'http://purl.obolibrary.org/obo/FOODON_00002381,http://purl.obolibrary.org/obo/FOODON_00002373', '-o', folder + os.sep], None, ['root-ontology.json', 'root-ontology.tsv'])
+		cases['bucket_rules'] = (lambda folder: [os.path.join(script_folder, 'ontobucket.py'), 'test/root-ontology.owl', '-r', 'http://genepio.org/ontology/lexmapr/AGENCY_0000001', '-o', folder + os.sep], None, ['root-ontology.json'])
+		cases['bucket_serve'] = (lambda folder: [os.path.join(script_folder, 'ontobucket.py'), '-R', 'test/lexmapr.json', '-s', 'stdio'], ''.join(json.dumps({'ids': ids}) + '\n' for ids in requests), ['serve.jsonl'])
+		return cases
+
+
+	def do_regress_benchmark(self, options):
+
+		with open('test/lexmapr.json') as input_handle:
+			rule_ids = sorted(orules.RuleDAG(json.load(input_handle)).get_ids())
+		cases = self.get_regress_cases(rule_ids)
+
+		baseline_path = os.path.join(options.golden, 'baseline.json')
+		baseline = {}
+		if not options.update:
+			if not os.path.isfile(baseline_path):
+				stop_err('No regression baseline in ' + options.golden + '; record one with --update.')
+			with open(baseline_path) as input_handle:
+				baseline = json.load(input_handle)
+
+		temp_folder = tempfile.mkdtemp()
+		# Compiled queries are saved by the first run, as for a user's.
+		env = dict(os.environ, ONTOFETCH_QUERY_CACHE = os.path.join(temp_folder, 'queries'))
+		report = OrderedDict()
+		report['runs'] = options.runs
+		report['tolerance_percent'] = options.tolerance
+		report['failures'] = []
+		try:
+			for (name, (get_command, stdin_text, output_files)) in cases.items():
+				output_folder = os.path.join(temp_folder, name)
+				os.makedirs(output_folder)
+				command = [sys.executable] + get_command(output_folder)
+				timings = []
+				peaks = []
+				for ptr in range(max(1, options.runs)):
+					(seconds, peak_kb) = self.get_regress_run(command, stdin_text, output_folder, env)
+					timings.append(seconds)
+					peaks.append(peak_kb)
+				timings.sort()
+
+				case = report[name] = OrderedDict()
+				case['ms'] = round(timings[len(timings) // 2] * 1000, 1)
+				case['peak_kb'] = max(peaks)
+				golden_folder = os.path.join(options.golden, name)
+				if options.update:
+					if not os.path.isdir(golden_folder):
+						os.makedirs(golden_folder)
+					for file_name in output_files:
+						shutil.copyfile(os.path.join(output_folder, file_name), os.path.join(golden_folder, file_name))
+					baseline[name] = OrderedDict([('ms', case['ms']), ('peak_kb', case['peak_kb'])])
+					continue
+
+				differences = []
+				for file_name in output_files:
+					differences.extend(file_name + ': ' + difference for difference in self.get_output_differences(os.path.join(golden_folder, file_name), os.path.join(output_folder, file_name)))
+				case['differences'] = len(differences)
+				if differences:
+					case['first_differences'] = differences[0:20]
+					report['failures'].append('%s output changed (%d differences)' % (name, len(differences)))
+
+				expected = baseline.get(name)
+				if expected is None:
+					report['failures'].append(name + ' has no baseline')
+					continue
+				for field in ('ms', 'peak_kb'):
+					case['baseline_' + field] = expected[field]
+					case[field + '_change_percent'] = round(100.0 * (case[field] - expected[field]) / expected[field], 1)
+					if case[field + '_change_percent'] > options.tolerance and (field != 'ms' or case['ms'] - expected['ms'] > self.REGRESS_SLACK_MS):
+						report['failures'].append('%s %s %s is over baseline %s by more than %s%%' % (name, field, case[field], expected[field], options.tolerance))
+		finally:
+			shutil.rmtree(temp_folder)
+
+		if options.update:
+			with open(baseline_path, 'w') as output_handle:
+				json.dump(baseline, output_handle, indent = 4, separators = (',', ': '))
+			report['updated'] = options.golden
+
+		return report
+
+
+	def get_regress_run(self, command, stdin_text, output_folder, env):
+		"""
+		Runs command (in the current folder), writing its standard output
+		to serve.jsonl in output_folder if it reads stdin_text, and 
+		returns (wall seconds, peak resident memory KiB).  Exits with an
+		error if the command fails.
+		"""
+		stdin_handle = None
+		stdout_handle = subprocess.DEVNULL
+		if stdin_text is not None:
+			stdin_handle = tempfile.TemporaryFile('w+')
+			stdin_handle.write(stdin_text)
+			stdin_handle.seek(0)
+			stdout_handle = open(os.path.join(output_folder, 'serve.jsonl'), 'w')
+		try:
+			start = time.perf_counter()
+			process = subprocess.Popen(command, env = env, stdin = stdin_handle, stdout = stdout_handle, stderr = subprocess.DEVNULL)
+			# The child's own resource usage, which subprocess doesn't give.
+			(pid, status, usage) = os.wait4(process.pid, 0)
+			seconds = time.perf_counter() - start
+			process.returncode = os.waitstatus_to_exitcode(status)
+		finally:
+			if stdin_text is not None:
+				stdin_handle.close()
+				stdout_handle.close()
+
+		if process.returncode:
+			stop_err('ERROR: ' + ' '.join(command) + ' exited with status ' + str(process.returncode))
+		return (seconds, usage.ru_maxrss)
+
+
+	def get_output_differences(self, golden_path, output_path):
+		"""
+		Returns list of descriptions of differences of given output file
+		from its golden copy.
+		"""
+		if not os.path.isfile(golden_path):
+			return ['no golden copy']
+		if not os.path.isfile(output_path):
+			return ['not written']
+
+		if output_path.endswith('.tsv'):
+			return self.get_tsv_differences(golden_path, output_path)
+
+		with open(golden_path) as input_handle:
+			expected = input_handle.read()
+		with open(output_path) as input_handle:
+			actual = input_handle.read()
+
+		if output_path.endswith('.jsonl'):
+			# Serve mode response times vary from run to run.
+			(expected, actual) = ([dict((key, value) for (key, value) in json.loads(line).items() if key != 'ms') for line in text.splitlines()] for text in (expected, actual))
+		else:
+			(expected, actual) = (json.loads(expected, object_pairs_hook = OrderedDict), json.loads(actual, object_pairs_hook = OrderedDict))
+
+		differences = []
+		self.get_json_differences(expected, actual, '', differences)
+		return differences
+
+
+	def get_json_differences(self, expected, actual, path, differences):
+		"""
+		Adds a description of each difference between given JSON values to
+		differences, by "/" separated path of keys and list positions.  
+		Key order matters too: it is the order output is written in.
+		"""
+		if isinstance(expected, dict) and isinstance(actual, dict):
+			for key in expected:
+				if key in actual:
+					self.get_json_differences(expected[key], actual[key], path + '/' + key, differences)
+				else:
+					differences.append(path + '/' + key + ' missing')
+			for key in actual:
+				if not key in expected:
+					differences.append(path + '/' + key + ' added')
+			if [key for key in expected if key in actual] != [key for key in actual if key in expected]:
+				differences.append((path or '/') + ' keys reordered')
+
+		elif isinstance(expected, list) and isinstance(actual, list):
+			for ptr in range(min(len(expected), len(actual))):
+				self.get_json_differences(expected[ptr], actual[ptr], path + '/' + str(ptr), differences)
+			if len(expected) != len(actual):
+				differences.append('%s has %d items, not %d' % (path or '/', len(actual), len(expected)))
+
+		elif expected != actual or type(expected) != type(actual):
+			differences.append('%s is %s, not %s' % (path or '/', json.dumps(actual), json.dumps(expected)))
+
+
+	def get_tsv_differences(self, golden_path, output_path):
+		"""
+		As get_output_differences() for a tsv file, comparing rows by 
+		their first (id) column, and within them each column by name.
+		"""
+		tables = []
+		for file_path in (golden_path, output_path):
+			with open(file_path) as input_handle:
+				lines = input_handle.read().split('\n')
+			header = lines[0].split('\t')
+			tables.append((header, OrderedDict((line.split('\t')[0], dict(zip(header, line.split('\t')))) for line in lines[1:] if line)))
+
+		((expected_header, expected), (actual_header, actual)) = tables
+		differences = []
+		if expected_header != actual_header:
+			differences.append('columns are %s, not %s' % (', '.join(actual_header), ', '.join(expected_header)))
+		for (id, row) in expected.items():
+			if not id in actual:
+				differences.append(id + ' missing')
+				continue
+			for column in expected_header:
+				if row.get(column) != actual[id].get(column):
+					differences.append('%s %s is %s, not %s' % (id, column, json.dumps(actual[id].get(column)), json.dumps(row.get(column))))
+		for id in actual:
+			if not id in expected:
+				differences.append(id + ' added')
+		if list(id for id in expected if id in actual) != list(id for id in actual if id in expected):
+			differences.append('rows reordered')
+		return differences
+
+
+	def get_median_ms(self, fn, runs, *args):
+		"""
+		Returns median milliseconds of given number of calls of fn(*args).
+		"""
+		timings = sorted(self.get_timing(fn, *args)[1] for ptr in range(max(1, runs)))
+		return round(timings[len(timings) // 2] * 1000, 2)
+
+
+	def write_split_ontology(self, triples, imports, folder, base_url):
+		"""
+		Writes given triples to main.owl and import files import[n].owl in
+		given folder, with each class's triples in one file, and main.owl 
+		declaring the imports by their base_url URLs.
+		"""
+		rdflib = ob.rdflib
+		graphs = [rdflib.Graph() for ptr in range(imports + 1)]
+		for triple in triples:
+			graphs[hash(triple[0]) % len(graphs)].add(triple)
+
+		main_uri = rdflib.term.URIRef(base_url + 'main.owl')
+		graphs[0].add((main_uri, rdflib.RDF.type, rdflib.OWL.Ontology))
+		for ptr in range(1, len(graphs)):
+			graphs[0].add((main_uri, rdflib.OWL.imports, rdflib.term.URIRef(base_url + 'import%d.owl' % ptr)))
+
+		for (ptr, graph) in enumerate(graphs):
+			graph.serialize(os.path.join(folder, 'import%d.owl' % ptr if ptr else 'main.owl'), format = 'xml')
+
+
+	def add_synthetic_ontology(self, helper, parents):
+		"""
+		Adds a class per term to graph, with rdfs:subClassOf parents, an
+		English rdfs:label, and for one term in 50, owl:deprecated and
+		IAO:0100001 (replaced by) annotations.
+		"""
+		rdflib = ob.rdflib
+		OBO = 'http://purl.obolibrary.org/obo/'
+		uris = dict((term, rdflib.term.URIRef(OBO + term.replace(':', '_'))) for term in parents)
+		for (ptr, (term, term_parents)) in enumerate(parents.items()):
+			uri = uris[term]
+			helper.graph.add((uri, rdflib.RDF.type, rdflib.OWL.Class))
+			helper.graph.add((uri, rdflib.RDFS.label, rdflib.term.Literal('synthetic term %d\nline 2' % ptr, lang = 'en')))
+			for parent in term_parents:
+				helper.graph.add((uri, rdflib.RDFS.subClassOf, uris[parent]))
+			if ptr % 50 == 1:
+				helper.graph.add((uri, rdflib.OWL.deprecated, rdflib.term.Literal(True)))
+				helper.graph.add((uri, rdflib.term.URIRef(OBO + 'IAO_0100001'), uris[term_parents[0]]))
+
+
+
+	def do_reference_table(self, helper, result):
+		"""
+		Converts query result rows cell by cell via row.asdict(), as 
+		do_query_table() did before its conversions were cached per query.
+		"""
+		rdflib = ob.rdflib
+		STRING_DATATYPE = rdflib.term.URIRef('http://www.w3.org/2001/XMLSchema#string')
+		table = []
+		for row in result:
+			rowdict = row.asdict()
+			newrowdict = {}
+			for column in rowdict:
+				value = rowdict[column]
+				valType = type(value)
+				if valType is rdflib.term.URIRef:
+					newrowdict[column] = helper.get_entity_id(value)
+				elif valType is rdflib.term.Literal:
+					literal = {'value': value.replace('\n', r'\n')}
+					if value.datatype == None or value.datatype == STRING_DATATYPE:
+						literal = literal['value']
+					else:
+						literal['datatype'] = helper.get_entity_id(value.datatype)
+					newrowdict[column] = literal
+				elif valType is rdflib.term.BNode:
+					newrowdict['expression'] = {'datatype':'disjunction', 'data':list(helper.get_disjunctions((value,))[value])}
+					newrowdict[column] = value
+			table.append(newrowdict)
+
+		return table
+
+
+	def do_generate(self, options):
+
+		if not options.output_folder:
+			stop_err('Please supply an output folder (-o) for generated files')
+
+		generator = self.get_generator(options)
+		bucket_rules = generator.get_rules(options.buckets)
+		samples = generator.get_samples(options.samples)
+
+		rule_file_path = os.path.join(options.output_folder, 'synthetic.json')
+		with open(rule_file_path, 'w') as output_handle:
+			output_handle.write(json.dumps(bucket_rules, sort_keys = False, indent = 4, separators = (',', ': ')))
+
+		sample_file_path = os.path.join(options.output_folder, 'synthetic.samples.jsonl')
+		with open(sample_file_path, 'w') as output_handle:
+			for sample in samples:
+				output_handle.write(json.dumps({'ids': sorted(sample)}) + '\n')
+
+		report = OrderedDict()
+		report['terms'] = len(generator.terms)
+		report['buckets'] = len(bucket_rules)
+		report['samples'] = len(samples)
+		report['rule_file'] = rule_file_path
+		report['sample_file'] = sample_file_path
+		return report
+
+
+	def get_command_line(self):
+		"""
+		*************************** Parse Command Line *****************************
+		"""
+		parser = MyParser(
+			description = 'Timing benchmarks for ontobucket.py and ontofetch.py.',
+			usage = 'ontobench.py [benchmark name] [options]*',
+			epilog="""  """)
+
+		# Standard code version identifier.
+		parser.add_option('-v', '--version', dest='code_version', default=False, action='store_true', help='Return version of this code.')
+
+		parser.add_option('-R', '--rules', dest='rules_file', type='string', help='Bucket rule .json or .pickle file to benchmark.', default='test/lexmapr.json')
+
+		parser.add_option('-n', '--samples', dest='samples', type='int', help='Number of comparison sets to evaluate.', default=1000)
+
+		parser.add_option('--scale', dest='scale', type='int', help='Add this many multiples of rule file bucket count as synthetic buckets.', default=0)
+
+		parser.add_option('--random', dest='random', type='int', help='Number of random rules to check optimiser equivalence on.', default=0)
+
+		parser.add_option('--depth', dest='depth', type='int', help='Nesting depth of random rules.', default=3)
+
+		parser.add_option('--width', dest='width', type='int', help='Maximum rule functions per random rule expression.', default=3)
+
+		parser.add_option('--rule-counts', dest='rule_counts', type='string', help='Comma separated synthetic rule set sizes for scaling benchmark.', default='100,1000,10000')
+
+		parser.add_option('--sample-counts', dest='sample_counts', type='string', help='Comma separated comparison set counts for scaling benchmark.', default='100,1000')
+
+		parser.add_option('--tree-limit', dest='tree_limit', type='int', help='Largest rules x samples product to time rule-by-rule evaluation for in scaling benchmark.', default=1000000)
+
+		parser.add_option('--buckets', dest='buckets', type='int', help='Number of synthetic buckets to generate.', default=1000)
+
+		parser.add_option('--terms', dest='terms', type='int', help='Size of synthetic term hierarchy.', default=5000)
+
+		parser.add_option('--branching', dest='branching', type='int', help='Mean number of children per synthetic hierarchy term.', default=6)
+
+		parser.add_option('--ontology', dest='ontology', type='string', help='Generate rules and samples over class hierarchy of given OWL ontology file instead of a synthetic one.')
+
+		parser.add_option('-o', '--output', dest='output_folder', type='string', help='Folder to write generated files to.')
+
+		parser.add_option('--imports', dest='imports', type='int', help='Number of import files to split fetch benchmark ontology into.', default=8)
+
+		parser.add_option('--latency', dest='latency', type='int', help='Milliseconds fetch benchmark HTTP server waits before each response.', default=200)
+
+		parser.add_option('--worker-counts', dest='worker_counts', type='string', help='Comma separated worker process counts for workers benchmark; the first is the baseline.', default='1,2,4,8')
+
+		parser.add_option('--concurrency', dest='concurrency', type='int', help='Number of parallel downloads in fetch benchmark.', default=4)
+
+		parser.add_option('-r', '--root', dest='root', type='string', help='Bucket root term URI of --ontology, for startup benchmark cached rule runs.')
+
+		parser.add_option('--runs', dest='runs', type='int', help='Number of runs of each command to take median time of in startup benchmark.', default=10)
+
+		parser.add_option('--golden', dest='golden', type='string', help='Folder of golden outputs and baseline.json of regress benchmark.', default='test/regress')
+
+		parser.add_option('--update', dest='update', default=False, action='store_true', help='Record current outputs and performance as regress benchmark golden outputs and baseline.')
+
+		parser.add_option('--tolerance', dest='tolerance', type='float', help='Percent over baseline time or peak memory that fails regress benchmark.', default=25.0)
+
+		parser.add_option('--seed', dest='seed', type='int', help='Random seed for synthetic rules and samples.', default=1)
+
+		return parser.parse_args()
+
+
+def get_peak_rss():
+	"""
+	Peak resident memory of this process in KiB.  On Linux ru_maxrss 
+	carries over from the parent process through fork and exec, so the
+	process's own high water mark is read from /proc if possible.
+	"""
+	try:
+		with open('/proc/self/status') as input_handle:
+			for line in input_handle:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except IOError:
+		pass
+
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def do_store_run(ontology_file, graph_store):
+	"""
+	Loads ontology (or reopens its graph store) and runs ontofetch.py's
+	"tree" query from the synthetic root, returning timings and the peak
+	memory of this process, with its memory use before loading.
+	"""
+	start_rss = get_peak_rss()
+	ontology = of.Ontology()
+	helper = ontology.onto_helper
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		start = time.perf_counter()
+		if graph_store:
+			helper.open_graph_store(graph_store)
+		if not helper.is_graph_stored(ontology_file):
+			ontology.load_ontology(ontology_file)
+		load_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		rows = helper.do_query_table(ontology.queries['tree'], {'root': ob.rdflib.term.URIRef('http://purl.obolibrary.org/obo/SYNTH_0000000')})
+		query_time = time.perf_counter() - start
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+	run = OrderedDict()
+	run['load_ms'] = round(load_time * 1000, 1)
+	run['tree_query_ms'] = round(query_time * 1000, 1)
+	run['rows'] = len(rows)
+	run['start_rss_mb'] = round(start_rss / 1024.0, 1)
+	run['peak_rss_mb'] = round(get_peak_rss() / 1024.0, 1)
+	return run
+
+
+def get_private_rss():
+	"""
+	Resident memory of this process in KiB that isn't shared file pages
+	(such as a memory-mapped file's), or None if unknown.
+	"""
+	try:
+		with open('/proc/self/status') as input_handle:
+			for line in input_handle:
+				if line.startswith('RssAnon:'):
+					return int(line.split()[1])
+	except IOError:
+		pass
+
+
+def do_index_run(file_path, ids):
+	"""
+	Opens ontofetch.py .json output (loading it) or .index output (as an
+	ontoindex.TermIndex), and looks up the label and parent of each given
+	id, returning (timings and memory use, looked up terms).
+	"""
+	import ontoindex
+
+	start_rss = get_private_rss()
+	start = time.perf_counter()
+	if file_path.endswith('.index'):
+		index = ontoindex.TermIndex(file_path)
+		open_time = time.perf_counter() - start
+		start = time.perf_counter()
+		terms = []
+		for id in ids:
+			term = index.get_term(id)
+			terms.append({'id': id, 'label': term['label'], 'parent_id': term['parent_id']})
+	else:
+		with open(file_path) as input_handle:
+			specifications = json.load(input_handle)['specifications']
+		open_time = time.perf_counter() - start
+		start = time.perf_counter()
+		terms = [dict((key, specifications[id].get(key)) for key in ('id', 'label', 'parent_id')) for id in ids]
+	lookup_time = time.perf_counter() - start
+
+	run = OrderedDict()
+	run['open_ms'] = round(open_time * 1000, 2)
+	run['lookup_us'] = round(lookup_time * 1000000 / max(1, len(ids)), 2)
+	run['private_rss_mb'] = round((get_private_rss() - start_rss) / 1024.0, 1) if start_rss is not None else None
+	run['peak_rss_mb'] = round(get_peak_rss() / 1024.0, 1)
+	return (run, terms)
+
+
+def do_http_server(folder, latency, failures, queue):
+	"""
+	Serves files in given folder on a free localhost port (put in queue
+	as the server's base URL) until terminated.  Each response is delayed
+	by latency seconds, and the first failures requests for each file get
+	a 503 (Service Unavailable) response.
+	"""
+	import http.server
+	import functools
+	requests = {}
+
+	class Handler(http.server.SimpleHTTPRequestHandler):
+
+		def do_GET(self):
+			time.sleep(latency)
+			requests[self.path] = requests.get(self.path, 0) + 1
+			if self.path != '/main.owl' and requests[self.path] <= failures:
+				self.send_error(503)
+				return
+			http.server.SimpleHTTPRequestHandler.do_GET(self)
+
+		def log_message(self, *args):
+			pass
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory = folder))
+	queue.put('http://127.0.0.1:%d/' % server.server_address[1])
+	server.serve_forever()
+
+
+class RuleGenerator(object):
+	"""
+	Random bucket rule sets and comparison sets over a term hierarchy, 
+	shaped like agency bucket rules: each bucket is an owl:someValuesFrom
+	of a term, a union of related terms (siblings, or a term and some of
+	its descendants), or, nested up to depth, intersections of such
+	unions with the complement of some of their descendants ("meat but
+	not poultry"), and qualified cardinalities.  Comparison sets are 1-3
+	hit terms, each with all of its ancestors, as lexmapr hits are given.
+	"""
+
+	CARDINALITIES = ['owl:qualifiedCardinality', 'owl:minQualifiedCardinality', 'owl:maxQualifiedCardinality']
+
+	# Chance that a comparison set hit is a term some rule mentions (or 
+	# one of its descendants) rather than any term.
+	RULE_HIT_CHANCE = 0.5
+
+	def __init__(self, parents, depth, width):
+		"""
+		INPUT
+			parents: OrderedDict of term id -> list of parent term ids
+		"""
+		self.parents = parents
+		self.depth = depth
+		self.width = width
+		self.terms = list(parents)
+		self.children = dict((term, []) for term in self.terms)
+		for (term, term_parents) in parents.items():
+			for parent in term_parents:
+				self.children.setdefault(parent, []).append(term)
+		self.ancestors = {}
+		self.rule_terms = []
+
+
+	@staticmethod
+	def get_synthetic_parents(size, branching):
+		"""
+		Term hierarchy of given size, built breadth first so each term has
+		about branching children, with one term in 20 given a second parent.
+		"""
+		parents = OrderedDict([('SYNTH:0000000', [])])
+		for ptr in range(1, size):
+			term_parents = ['SYNTH:%07d' % ((ptr - 1) // branching)]
+			if random.random() < 0.05:
+				second = 'SYNTH:%07d' % random.randrange(0, ptr)
+				if not second in term_parents:
+					term_parents.append(second)
+			parents['SYNTH:%07d' % ptr] = term_parents
+
+		return parents
+
+
+	def get_ancestors(self, term):
+		"""
+		Term and all its ancestors.  Hierarchy cycles are tolerated.
+		"""
+		if not term in self.ancestors:
+			ancestors = set()
+			stack = [term]
+			while stack:
+				node = stack.pop()
+				if not node in ancestors:
+					ancestors.add(node)
+					stack.extend(self.parents.get(node, []))
+			self.ancestors[term] = frozenset(ancestors)
+
+		return self.ancestors[term]
+
+
+	def get_descendants(self, term, limit):
+		"""
+		Up to limit descendants of term, nearest first.
+		"""
+		descendants = []
+		queue = list(self.children.get(term, []))
+		seen = set(queue)
+		while queue and len(descendants) < limit:
+			node = queue.pop(0)
+			descendants.append(node)
+			for child in self.children.get(node, []):
+				if not child in seen:
+					seen.add(child)
+					queue.append(child)
+
+		return descendants
+
+
+	def get_related_terms(self):
+		"""
+		1 to width related terms: a term and its siblings, or a term and
+		some of its descendants.
+		"""
+		term = random.choice(self.terms)
+		count = random.randint(1, self.width)
+		if random.random() < 0.5 and self.parents[term]:
+			related = [term] + [sibling for sibling in self.children[random.choice(self.parents[term])] if sibling != term]
+		else:
+			related = [term] + self.get_descendants(term, count * 2)
+
+		return related[0:count]
+
+
+	def get_expression(self, depth):
+
+		terms = self.get_related_terms()
+		self.rule_terms.extend(terms)
+		union = OrderedDict((term, None) for term in terms)
+
+		if depth > 0 and random.random() < 0.5:
+			# A nested union, intersection with exclusions, or cardinality
+			# alongside the plain terms.
+			choice = random.random()
+			if choice < 0.4:
+				union['owl:unionOf'] = self.get_expression(depth - 1)
+			elif choice < 0.8:
+				exclusions = OrderedDict()
+				for term in terms:
+					for descendant in self.get_descendants(term, random.randint(0, 2)):
+						exclusions[descendant] = None
+				if depth > 1 and random.random() < 0.3:
+					exclusions['owl:unionOf'] = self.get_expression(depth - 2)
+				union['owl:intersectionOf'] = OrderedDict([
+					('owl:someValuesFrom', self.get_expression(depth - 1)),
+					('owl:complementOf', exclusions)
+				])
+			else:
+				item = random.choice(self.CARDINALITIES)
+				union[item] = {'limit': random.randint(1, 2), 'set': self.get_expression(depth - 1)}
+
+		if len(union) == 1:
+			return union
+
+		return {'owl:unionOf': union}
+
+
+	def get_rules(self, count):
+		"""
+		OrderedDict of count synthetic bucket id -> rule.  Later samples
+		favour the terms of the last rule set generated.
+		"""
+		self.rule_terms = []
+		rules = OrderedDict()
+		for ptr in range(count):
+			rules['BUCKET:%07d' % ptr] = {'owl:someValuesFrom': self.get_expression(random.randint(0, self.depth))}
+
+		return rules
+
+
+	def get_samples(self, count):
+		"""
+		count comparison sets, each of 1-3 hits plus all their ancestors.
+		Hits favour terms that generated rules mention (and their near
+		descendants), so that buckets fire at realistic rates.
+		"""
+		samples = []
+		for ptr in range(count):
+			sample = set()
+			for hit in range(random.randint(1, 3)):
+				if self.rule_terms and random.random() < self.RULE_HIT_CHANCE:
+					term = random.choice(self.rule_terms)
+					term = random.choice([term] + self.get_descendants(term, 3))
+				else:
+					term = random.choice(self.terms)
+				sample.update(self.get_ancestors(term))
+			samples.append(sample)
+
+		return samples
+
+
+if __name__ == '__main__':
+
+	oh.OntoHelper.default_query_cache = True
+	benchmark = OntologyBenchmark()
+	benchmark.__main__()
@@ -23,7 +23,9 @@
 	This script requires python module RDFLib.
 
 	if --cache used, then --output folder is required in order to read where
-	cached [ontology].json file is.
+	cached [ontology].[key].pickle rule file is.  The key is a hash of the
+	ontology and its import files' content, the -r roots, and this code, so
+	a cached rule file is never used once any of these change.
 
 	EXAMPLES
 
@@ -44,8 +46,9 @@
 
 		python ontobucket.py ../lexmapr_ontology/lexmapr.owl -r http://genepio.org/ontology/LEXMAPR_0000001 -i FOODON:00001286 -o test/
 
-	As above, but also uses that test/lexmapr.json if it exists to run rules,
-	rather than generating it from scratch.
+	As above, but also uses a cached rule file in test/ if one exists for the
+	current ontology content and roots to run rules, rather than generating
+	it from scratch.
 
 		python ontobucket.py ../lexmapr_ontology/lexmapr.owl -r http://genepio.org/ontology/LEXMAPR_0000001 -i FOODON:00001286 -o test/ -c
 
@@ -61,6 +64,35 @@
 
 	> python ontobucket.py ../lexmapr_ontology/lexmapr.owl -r http://genepio.org/ontology/LEXMAPR_0000001 -o test/ -c -i FOODON:00002099
 
+	SERVE MODE
+	Load a rule file once and answer JSON line requests on stdin/stdout (or
+	on a unix socket with -s /tmp/ontobucket.sock). The rule file is 
+	reloaded when it changes.
+
+		python ontobucket.py -R test/lexmapr.json -s stdio
+		{"ids": ["FOODON:00002099", "FOODON:00001172"]}
+
+	TRACE MODE
+	-t writes a JSON report, on exit, of each bucket rule's evaluation 
+	count, cumulative time and fire rate across all -i or serve mode 
+	comparison sets (slowest rules first), and for the last --trace-limit
+	sets, which entity ids each part of each triggered rule matched.  Rules
+	are then evaluated one by one rather than by their shared DAG, so run
+	times are those of the rules themselves.
+
+		python ontobucket.py -R test/lexmapr.json -t trace.json -s stdio < requests.jsonl
+
+	MATERIALISED LOOKUP
+	-m writes [ontology].buckets.sqlite to the output folder: for every class
+	in the ontology (and its imports), the buckets it triggers when it and its
+	ancestors are the comparison set.  -l then answers -i ids, or serve mode
+	{"terms": [...]} requests, with one table lookup per term.  Terms not in
+	the table give null.
+
+		python ontobucket.py ../lexmapr_ontology/lexmapr.owl -r http://genepio.org/ontology/LEXMAPR_0000001 -o test/ -c -m
+		python ontobucket.py -R test/lexmapr.json -l test/lexmapr.buckets.sqlite -s stdio
+		{"terms": ["FOODON:00001286"]}
+
 	**************************************************************************
 """ 
 
@@ -69,13 +101,28 @@ import sys
 import os
 import optparse
 import datetime
+import hashlib
+import pickle
+import multiprocessing
+import collections
+import socketserver
+import threading
+import time
+import sqlite3
 from copy import deepcopy
 
+try: #Python 2.7
+	from collections import OrderedDict
+except ImportError: # Python 2.6
+	from ordereddict import OrderedDict
+
 #from ontohelper import OntoHelper as oh
 import ontohelper as oh
+import ontorules as orules
 
-import rdflib
-from rdflib.plugins.sparql import prepareQuery
+# rdflib is only imported when first used (see ontohelper); a plain
+# "import rdflib" would import it straight away.
+rdflib = oh.rdflib
 
 # Do this, otherwise a warning appears on stdout: No handlers could be 
 #found for logger "rdflib.term"
@@ -102,12 +149,43 @@ class OntologyBuckets(object):
 
 	CODE_VERSION = '0.0.4'
 	TEST = 0 # = 1 to test a hardcoded small subset of .owl ontology rules.
+	# Serve mode: seconds between rule file change checks, and number of
+	# most recent requests kept for latency statistics.
+	RELOAD_INTERVAL = 1.0
+	LATENCY_WINDOW = 10000
+	STRING_DATATYPE = oh.URIRefConstant('http://www.w3.org/2001/XMLSchema#string')
+
+	# Terms used by get_rule_triples() to find bucket rule expressions.
+	OWL = 'http://www.w3.org/2002/07/owl#'
+	SUBCLASS_OF = oh.URIRefConstant('http://www.w3.org/2000/01/rdf-schema#subClassOf')
+	TYPE = oh.URIRefConstant('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+	CLASS = oh.URIRefConstant(OWL + 'Class')
+	LABEL = oh.URIRefConstant('http://www.w3.org/2000/01/rdf-schema#label')
+	EQUIVALENT_CLASS = oh.URIRefConstant(OWL + 'equivalentClass')
+	ON_PROPERTY = oh.URIRefConstant(OWL + 'onProperty')
+	HAS_MEMBER = oh.URIRefConstant('http://purl.obolibrary.org/obo/RO_0002351')
+	RESTRICTION_PREDICATES = oh.URIRefConstant([OWL + 'someValuesFrom', OWL + 'qualifiedCardinality', OWL + 'minQualifiedCardinality', OWL + 'maxQualifiedCardinality'])
+	EXPRESSION_PREDICATES = oh.URIRefConstant([OWL + 'intersectionOf', OWL + 'unionOf', OWL + 'complementOf'])
 	
 	def __init__(self):
 
 		self.onto_helper = oh.OntoHelper()
 		self.timestamp = datetime.datetime.now()
 		self.comparison_set = None
+		# Subject-indexed blank node triples, see get_triple_map()
+		self.triple_map = None
+		# Cache of get_entity_id() conversions of URIRefs
+		self.entity_ids = {}
+		# Shared-subexpression form of the bucket rules being evaluated
+		self.rule_dag = None
+		# Whether to apply RuleOptimiser to loaded rules
+		self.optimise = False
+		# Connection to a materialised term lookup table, if any
+		self.lookup = None
+		# Ontology file loaded into graph, if any
+		self.ontology_file = None
+		# RuleTrace collecting per-rule counters in trace mode, else None
+		self.trace = None
 
 		self.owl_rules = {
 
@@ -139,74 +217,6 @@ class OntologyBuckets(object):
 
 		}
 
-		self.queries = {
-
-			##################################################################
-			# Membership Rules are boolean expressions or single entities linked
-			# via 'has member' relation between a parent_id entity and children.
-			# 
-			# This script returns all triples that immediately compose the
-			# owl.subject (aka owl.restriction). Below is simplest case
-			#
-			#   <owl:Restriction>
-            #      <owl:onProperty rdf:resource="obo:RO_0002351"/>
-            #      <owl:someValuesFrom rdf:resource="obo:FOODON_00002196"/>
-            #   </owl:Restriction>			
-			#	...
-
-			'report_mapping': rdflib.plugins.sparql.prepareQuery("""
-
-				SELECT DISTINCT ?label ?parent_id ?subject ?predicate ?object
-				WHERE {
-					BIND (OBO:RO_0002351 as ?has_member).
-					
-					?parent_id rdfs:subClassOf* ?root.
-					?parent_id owl:equivalentClass ?subject.
-					?parent_id rdfs:label ?label.
-					{	?subject owl:onProperty ?has_member.
-						?subject (owl:someValuesFrom | owl:qualifiedCardinality | owl:minQualifiedCardinality | owl:maxQualifiedCardinality) ?object.
-					}
-					UNION
-					{	?subject (owl:intersectionOf | owl:unionOf |  owl:complementOf) ?object.
-					}
-					?subject ?predicate ?object.
-
-				 } ORDER BY ?parent_id
-
-			""", initNs = self.onto_helper.namespace),
-
-			# Anything is retrieved here, including annotations
-			'triple_by_subject': rdflib.plugins.sparql.prepareQuery("""
-
-				SELECT DISTINCT ?predicate ?object
-				WHERE {?subject ?predicate ?object}
-				ORDER BY ?predicate
-
-			""", initNs = self.onto_helper.namespace),
-
-			# This query focuses on restriction parts and weeds out unneeded annotations.
-
-			#(owl:onClass | owl:intersectionOf | owl:unionOf | owl:complementOf)
-			'triple_by_relation': rdflib.plugins.sparql.prepareQuery("""
-
-				SELECT DISTINCT ?predicate ?object
-				WHERE {
-					?subject (owl:onClass) ?object.
-					?subject ?predicate ?object.
-				}
-				ORDER BY ?subject
-
-			""", initNs = self.onto_helper.namespace),
-
-			'cardinality_target': rdflib.plugins.sparql.prepareQuery("""
-
-				SELECT DISTINCT ?object
-				WHERE {
-					?subject owl:onClass ?object.
-				}
-			""", initNs = self.onto_helper.namespace)
-		}
-
 
 	def log(self, *args):
 		"""
@@ -230,74 +240,552 @@ class OntologyBuckets(object):
 			print (self.CODE_VERSION)
 			return self.CODE_VERSION
 
-		if not len(args):
+		# In stdio serve mode stdout carries responses, so progress messages
+		# go to stderr.
+		output_handle = sys.stdout
+		if options.serve == 'stdio':
+			sys.stdout = sys.stderr
+
+		self.onto_helper.fetch_concurrency = options.concurrency
+		self.onto_helper.fetch_retries = options.retries
+		if options.graph_store:
+			self.onto_helper.open_graph_store(options.graph_store)
+
+		if options.rules_file:
+			rule_file_path = options.rules_file
+			try:
+				bucket_rules = self.load_rule_file(rule_file_path)
+			except Exception as e:
+				stop_err('Rule file ' + rule_file_path + ' could not be loaded: ' + str(e))
+
+		elif not len(args):
 			stop_err('Please supply an OWL ontology file (in RDF/XML format)')
 
-		(main_ontology_file, output_file_basename) = self.onto_helper.check_ont_file(args[0], options)
+		else:
+			(bucket_rules, rule_file_path) = self.get_ontology_rules(args[0], options)
 
-		cached_rules = False;
+		self.optimise = options.optimise
+		if self.optimise:
+			bucket_rules = self.get_optimised_rules(bucket_rules)
 
-		if options.cache:
-			# If there is a cached file to use, go for it, otherwise will have to generate it.
-			if options.output_folder:
-				# Output rule file takes on ontology name + .json
-				json_file_path = output_file_basename + '.json'
+		if options.materialise:
+			if not len(args) or not options.output_folder:
+				stop_err('Materialising a term lookup table needs an ontology file and an output folder')
+
+			(main_ontology_file, output_file_basename) = self.onto_helper.check_ont_file(args[0], options)
+			self.load_ontology(main_ontology_file)
+
+			self.do_materialise(bucket_rules, output_file_basename + '.buckets.sqlite')
+
+		if options.lookup:
+			self.lookup = sqlite3.connect(options.lookup, check_same_thread = False)
 
-				if os.path.isfile('./' + json_file_path):
-					with (open(json_file_path)) as input_handle:
-						self.log("Using cached file:", json_file_path)
-						bucket_rules = json.load(input_handle);
-						cached_rules = True;
+		if options.trace:
+			self.trace = orules.RuleTrace(options.trace_limit)
+
+		if options.sharing:
+			print (json.dumps(self.get_rule_dag(bucket_rules).get_sharing_report(), sort_keys = False, indent = 4, separators = (',', ': ')))
+
+		# FUTURE: ALTERNATELY, INPUT comparison_ids as TSV FILE OR JSON WITH 
+		# records of hits
+		if options.comparison_ids:
 
+			self.log('Bucket reporting')
+			if self.lookup:
+				# Each id is classified on its own by materialised table.
+				for (term_id, buckets) in self.get_term_buckets(options.comparison_ids.split(',')).items():
+					print ("TERM:", term_id, buckets)
 			else:
-				stop_err('If using the cache flag, you must specify an output folder to read .json file from (or regenerate it to)')
+				for bucket_id, output in self.do_bucket_rules(bucket_rules, options.comparison_ids.split(',')).items():
+					print ("RULE:",bucket_id, output)
 
-		if not cached_rules: 
+		if options.serve:
+			self.do_serve(options.serve, bucket_rules, rule_file_path, output_handle)
 
-			# Load main ontology file into RDF graph
-			print ("Fetching and parsing " + main_ontology_file + " ...")
+		if options.trace:
+			self.write_trace_report(options.trace)
 
-			try:
-				# ISSUE: ontology file taken in as ascii; rdflib doesn't accept
-				# utf-8 characters so can experience conversion issues in string
-				# conversion stuff like .replace() below
-				self.onto_helper.graph.parse(main_ontology_file, format='xml')
 
-			except Exception as e:
-				#urllib2.URLError: <urlopen error [Errno 8] nodename nor servname provided, or not known>
-				stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+	def get_ontology_rules(self, ontology_file, options):
+		"""
+		Returns bucket rules of given ontology for options.root_uri roots,
+		from cached rule file if allowed and available, or else by loading
+		the ontology and compiling them.
 
-			# Add each ontology include file (must be in OWL RDF format)
-			self.onto_helper.do_ontology_includes(main_ontology_file)
+		OUTPUT
+			bucket_rules: dictionary of bucket id -> rule
+			cache_file_path: cached rule file, if options.cache, or None
+		"""
+		(main_ontology_file, output_file_basename) = self.onto_helper.check_ont_file(ontology_file, options)
 
-			for term_id in options.root_uri.split(','):
+		root_ids = options.root_uri.split(',')
+		bucket_rules = None
+		cache_file_path = None
 
-				# THE ONE CALL TO GET REPORT CATEGORY BOOLEAN EXPRESSIONS
-				self.log('bucket rule compilation for', term_id)
+		if options.cache:
+			# If there is a cached rule file for this exact ontology content,
+			# root list and code version, go for it, otherwise will have to 
+			# generate it.
+			if options.output_folder:
+				cache_file_path = output_file_basename + '.' + self.get_cache_key(main_ontology_file, root_ids) + '.pickle'
+				bucket_rules = self.load_rule_cache(cache_file_path)
+
+			else:
+				stop_err('If using the cache flag, you must specify an output folder to read cached rule file from (or regenerate it to)')
+
+		if bucket_rules is None: 
 
-				# If user has provided a set of comparison ids then actually 
-				# execute bucket rules on them and return a boolean result for
-				# each rule.
-				bucket_rules = self.do_membership_rules(term_id)
+			self.load_ontology(main_ontology_file)
+
+			# THE ONE CALL TO GET REPORT CATEGORY BOOLEAN EXPRESSIONS
+			bucket_rules = self.do_root_rules(root_ids)
 
 			# If output folder specified then write out bucket rule file 
 			if (options.output_folder):
 				
 				self.onto_helper.do_output_json(bucket_rules, output_file_basename)
 
-		# FUTURE: ALTERNATELY, INPUT comparison_ids as TSV FILE OR JSON WITH 
-		# records of hits
-		if options.comparison_ids:
+			if options.cache:
+				self.save_rule_cache(cache_file_path, bucket_rules)
 
-			self.log('Bucket reporting')
-			# The self.comparison_set of entity ids which rule parts are tested
-			# against.
-			self.comparison_set = set(options.comparison_ids.split(','))
-			
-			for bucket_id, rule in bucket_rules.items():
-				output = self.do_bucket_rule(rule)
-				if output != {False}:
-					print ("RULE:",bucket_id, output)
+		return (bucket_rules, cache_file_path)
+
+
+	def load_ontology(self, main_ontology_file):
+		"""
+		Loads main ontology file and its imports into RDF graph, unless 
+		already loaded, or held by graph store from an earlier run.
+		"""
+		if self.ontology_file == main_ontology_file:
+			return
+
+		self.ontology_file = main_ontology_file
+		if self.onto_helper.is_graph_stored(main_ontology_file):
+			print ("Using " + main_ontology_file + " graph stored in " + self.onto_helper.graph_store_path)
+			return
+
+		print ("Fetching and parsing " + main_ontology_file + " ...")
+
+		try:
+			# Main file and each ontology include file (must be in OWL RDF
+			# format)
+			self.onto_helper.do_ontology_load(main_ontology_file)
+
+		except Exception as e:
+			#urllib2.URLError: <urlopen error [Errno 8] nodename nor servname provided, or not known>
+			stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+
+		self.onto_helper.save_graph_store(main_ontology_file)
+
+
+	def load_rule_file(self, rule_file_path):
+		"""
+		Loads bucket rules from a .json rule file as written by -o, or from a
+		cached .pickle rule file.
+		"""
+		if rule_file_path.endswith('.pickle'):
+			with open(rule_file_path, 'rb') as input_handle:
+				return pickle.load(input_handle)
+
+		with open(rule_file_path) as input_handle:
+			return json.load(input_handle)
+
+
+	def get_optimised_rules(self, bucket_rules):
+
+		optimiser = orules.RuleOptimiser()
+		bucket_rules = optimiser.get_optimised_rules(bucket_rules)
+		self.log('Optimised rules:', dict(optimiser.counts))
+		return bucket_rules
+
+
+	def do_bucket_rules(self, bucket_rules, comparison_ids):
+		"""
+		Applies each bucket rule to given entity ids. Rules are evaluated
+		via their shared-subexpression DAG, so a subexpression repeated
+		across buckets is evaluated only once for the given ids.
+
+		INPUT
+			bucket_rules: dictionary of bucket id -> rule
+			comparison_ids: list of lexmapr hit ids and their ancestor ids
+		OUTPUT
+			dictionary of triggered bucket id -> set of matched ids (or True)
+		"""
+		# The self.comparison_set of entity ids which rule parts are tested
+		# against.
+		self.comparison_set = set(comparison_ids)
+
+		if self.trace is not None:
+			return self.do_traced_bucket_rules(bucket_rules)
+
+		triggered = {}
+		for bucket_id, output in self.get_rule_dag(bucket_rules).evaluate(self.comparison_set):
+			if output != {False}:
+				triggered[bucket_id] = set(output)
+
+		return triggered
+
+
+	def do_traced_bucket_rules(self, bucket_rules):
+		"""
+		Trace mode version of do_bucket_rules(): each bucket rule is
+		evaluated and timed on its own by do_bucket_rule(), and what each
+		part of a triggered bucket's rule matched is added to self.trace.
+		"""
+		triggered = {}
+		for bucket_id, rule in bucket_rules.items():
+			start = time.perf_counter()
+			output = self.do_bucket_rule(rule)
+			elapsed = time.perf_counter() - start
+			fired = output != {False}
+			self.trace.add_evaluation(bucket_id, elapsed, fired)
+			if fired:
+				triggered[bucket_id] = output
+
+		self.trace.add_sample(self.comparison_set, self.get_rule_dag(bucket_rules).evaluate_trace(self.comparison_set, triggered))
+		return triggered
+
+
+	def write_trace_report(self, trace_file_path):
+
+		with open(trace_file_path, 'w') as output_handle:
+			output_handle.write(json.dumps(self.trace.get_report(), sort_keys = False, indent = 4, separators = (',', ': ')))
+
+		self.log('Wrote trace report', trace_file_path)
+
+
+	def get_rule_dag(self, bucket_rules):
+		"""
+		RuleDAG of given bucket rules, compiled once per rule set.
+		"""
+		if self.rule_dag is None or self.rule_dag.bucket_rules is not bucket_rules:
+			self.rule_dag = orules.RuleDAG(bucket_rules)
+
+		return self.rule_dag
+
+
+	""" ####################################################################
+		Serve mode keeps rules loaded and answers classification requests,
+		one JSON object per line, over stdin/stdout or a unix socket:
+
+			{"ids": ["FOODON:00002099", ...]}
+				-> {"buckets": {"LEXMAPR:0000041": ["FOODON:00002099"]}, "ms": 0.021}
+			{"batch": [["FOODON:00002099", ...], ...]}
+				-> {"results": [{"LEXMAPR:0000041": [...]}, ...], "ms": 0.094}
+			{"terms": ["FOODON:00001286", ...]}  (with -l lookup table)
+				-> {"terms": {"FOODON:00001286": {"LEXMAPR:0000073": [...]}}, "ms": 0.012}
+			{"stats": true}
+				-> request count and latency (ms) mean, p50, p95, p99, max
+			{"reload": true}
+				-> reloads rule file now
+
+		An "id" in a request is echoed in its response.  If rules came from
+		a rule file (-R or -c), the file is reloaded when its modification
+		time changes, checked at most every RELOAD_INTERVAL seconds.
+	"""
+	def do_serve(self, address, bucket_rules, rule_file_path, output_handle):
+
+		self.bucket_rules = bucket_rules
+		self.rule_file_path = rule_file_path
+		self.rule_file_mtime = self.get_rule_file_mtime()
+		self.rule_file_checked = time.time()
+		self.latencies = collections.deque(maxlen = self.LATENCY_WINDOW)
+		self.request_count = 0
+		self.lock = threading.Lock()
+
+		self.log('Serving', len(bucket_rules), 'bucket rules on', address)
+
+		try:
+			if address == 'stdio':
+				for line in sys.stdin:
+					response = self.do_request_line(line)
+					if response:
+						output_handle.write(response + '\n')
+						output_handle.flush()
+			else:
+				if os.path.exists(address):
+					os.remove(address)
+				server = socketserver.ThreadingUnixStreamServer(address, BucketRequestHandler)
+				server.daemon_threads = True
+				server.buckets = self
+				try:
+					server.serve_forever()
+				finally:
+					server.server_close()
+					os.remove(address)
+
+		except KeyboardInterrupt:
+			pass
+
+		sys.stderr.write(json.dumps(self.get_latency_stats()) + '\n')
+
+
+	def do_request_line(self, line):
+		"""
+		Returns JSON response line for given JSON request line, or None for
+		a blank line.
+		"""
+		line = line.strip()
+		if not line:
+			return None
+
+		try:
+			request = json.loads(line)
+		except ValueError as e:
+			return json.dumps({'error': 'Invalid JSON request: ' + str(e)})
+
+		error = self.get_request_error(request)
+		if error:
+			response = {'error': error}
+		else:
+			# A request that fails is answered with an error, rather than
+			# stopping the server for every other client.
+			try:
+				response = self.get_response(request)
+			except Exception as e:
+				response = {'error': 'Request failed: ' + repr(e)}
+
+		if isinstance(request, dict) and 'id' in request:
+			response['id'] = request['id']
+
+		return json.dumps(response)
+
+
+	def get_request_error(self, request):
+		"""
+		Returns description of what is wrong with given parsed JSON 
+		request, or None if it is well formed.
+		"""
+		if not isinstance(request, dict):
+			return 'Request must be a JSON object'
+
+		def is_id_list(ids):
+			return isinstance(ids, list) and all(isinstance(id, str) for id in ids)
+
+		if 'ids' in request and not (isinstance(request['ids'], str) or is_id_list(request['ids'])):
+			return '"ids" must be a list of id strings, or a comma separated string'
+		if 'batch' in request and not (isinstance(request['batch'], list) and all(isinstance(ids, str) or is_id_list(ids) for ids in request['batch'])):
+			return '"batch" must be a list of "ids" values'
+		if 'terms' in request and not is_id_list(request['terms']):
+			return '"terms" must be a list of id strings'
+		return None
+
+
+	def get_response(self, request):
+		"""
+		Returns response dictionary for given well formed request.
+		"""
+		with self.lock:
+			self.check_rule_file(request.get('reload', False))
+
+			if request.get('stats', False):
+				response = self.get_latency_stats()
+
+			elif 'ids' in request or 'batch' in request:
+				start = time.perf_counter()
+				if 'batch' in request:
+					response = {'results': [self.get_buckets(ids) for ids in request['batch']]}
+				else:
+					response = {'buckets': self.get_buckets(request['ids'])}
+				elapsed = (time.perf_counter() - start) * 1000
+				self.latencies.append(elapsed)
+				self.request_count += 1
+				response['ms'] = round(elapsed, 4)
+
+			elif 'terms' in request and self.lookup:
+				start = time.perf_counter()
+				response = {'terms': self.get_term_buckets(request['terms'])}
+				elapsed = (time.perf_counter() - start) * 1000
+				self.latencies.append(elapsed)
+				self.request_count += 1
+				response['ms'] = round(elapsed, 4)
+
+			elif request.get('reload', False):
+				response = {'rules': len(self.bucket_rules)}
+
+			else:
+				response = {'error': 'Request needs one of "ids", "batch", "terms" (with -l), "stats" or "reload"'}
+
+		return response
+
+
+	def get_buckets(self, ids):
+		"""
+		Triggered buckets for a list (or comma separated string) of ids, 
+		with matched id sets as sorted lists for JSON.
+		"""
+		if isinstance(ids, str):
+			ids = ids.split(',')
+
+		return dict((bucket_id, sorted(output, key = str)) for (bucket_id, output) in self.do_bucket_rules(self.bucket_rules, ids).items())
+
+
+	""" ####################################################################
+		Materialised term lookup table: for every class in the loaded graph,
+		the buckets triggered by that class together with its ancestors, as
+		if it were a single lexmapr hit. Serving then needs just one key 
+		lookup per term.
+
+		Only the entity ids that rules mention can affect a rule's output, 
+		so each term's ancestor set is reduced to those ids. Most terms then
+		share one of relatively few reduced sets, and the rule DAG is
+		evaluated once per distinct set rather than once per term.
+	"""
+	def do_materialise(self, bucket_rules, lookup_file_path):
+
+		graph = self.onto_helper.graph
+		rule_ids = self.get_rule_dag(bucket_rules).get_ids()
+
+		self.log('Materialising bucket lookup table for terms in graph')
+		terms = set(subject for subject in graph.subjects(self.TYPE, self.CLASS) if type(subject) is rdflib.term.URIRef)
+		terms.update(subject for subject in graph.subjects(self.SUBCLASS_OF, None) if type(subject) is rdflib.term.URIRef)
+
+		relevant_ids = self.get_relevant_ancestors(terms, rule_ids)
+
+		# Evaluate rules once per distinct set of relevant ids.
+		outputs = {}
+		for comparison_set in set(relevant_ids.values()):
+			outputs[comparison_set] = json.dumps(dict((bucket_id, sorted(output, key = str)) for (bucket_id, output) in self.do_bucket_rules(bucket_rules, comparison_set).items()), sort_keys = True)
+
+		self.log('Terms:', len(terms), 'distinct rule-relevant ancestor sets:', len(outputs))
+
+		# Written to a temporary file then renamed, so readers never see a 
+		# partial table.
+		temp_file_path = lookup_file_path + '.' + str(os.getpid())
+		if os.path.exists(temp_file_path):
+			os.remove(temp_file_path)
+
+		connection = sqlite3.connect(temp_file_path)
+		connection.execute('CREATE TABLE term_buckets (term_id TEXT PRIMARY KEY, buckets TEXT NOT NULL) WITHOUT ROWID')
+		connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+		connection.executemany('INSERT OR REPLACE INTO term_buckets VALUES (?, ?)', 
+			sorted((self.get_node_value(term), outputs[relevant_ids[term]]) for term in terms))
+		connection.executemany('INSERT INTO metadata VALUES (?, ?)', [
+			('code_version', self.CODE_VERSION),
+			('buckets', str(len(bucket_rules))),
+			('terms', str(len(terms))),
+			('created', datetime.datetime.now().isoformat())
+		])
+		connection.commit()
+		connection.close()
+		os.replace(temp_file_path, lookup_file_path)
+
+		self.log('Wrote', lookup_file_path)
+
+
+	def get_relevant_ancestors(self, terms, rule_ids):
+		"""
+		For each term, the frozenset of rule_ids among the term and its
+		rdfs:subClassOf ancestors (named classes only). Equal sets are 
+		shared. A term met again while its own ancestors are still being
+		walked (a subClassOf cycle) contributes what was found so far.
+
+		INPUT
+			terms: iterable of URIRef
+			rule_ids: set of entity ids mentioned by bucket rules
+		OUTPUT
+			{URIRef: frozenset of entity ids}
+		"""
+		graph = self.onto_helper.graph
+		relevant = {}
+		interned = {}
+		in_progress = set()
+
+		for term in terms:
+			# Iterative depth first walk, so deep hierarchies don't hit the
+			# recursion limit.
+			stack = [term]
+			while stack:
+				node = stack[-1]
+				if node in relevant:
+					stack.pop()
+					continue
+
+				parents = [parent for parent in graph.objects(node, self.SUBCLASS_OF) if type(parent) is rdflib.term.URIRef]
+				pending = [parent for parent in parents if not parent in relevant and not parent in in_progress]
+				if pending:
+					in_progress.add(node)
+					stack.extend(pending)
+					continue
+
+				ids = set()
+				node_id = self.get_node_value(node)
+				if node_id in rule_ids:
+					ids.add(node_id)
+				for parent in parents:
+					ids.update(relevant.get(parent, ()))
+
+				ids = frozenset(ids)
+				relevant[node] = interned.setdefault(ids, ids)
+				in_progress.discard(node)
+				stack.pop()
+
+		return relevant
+
+
+	def get_term_buckets(self, term_ids):
+		"""
+		Materialised lookup of buckets triggered by each term id, or None
+		for a term not in the table.
+		"""
+		lookups = OrderedDict()
+		for term_id in term_ids:
+			row = self.lookup.execute('SELECT buckets FROM term_buckets WHERE term_id = ?', (term_id,)).fetchone()
+			lookups[term_id] = json.loads(row[0]) if row else None
+
+		return lookups
+
+
+	def get_rule_file_mtime(self):
+		if self.rule_file_path and os.path.isfile(self.rule_file_path):
+			return os.path.getmtime(self.rule_file_path)
+		return None
+
+
+	def check_rule_file(self, force = False):
+		"""
+		Reloads rule file if forced, or if its modification time has changed
+		since last checked more than RELOAD_INTERVAL seconds ago. 
+		"""
+		if not self.rule_file_path:
+			return
+
+		now = time.time()
+		if not force and now - self.rule_file_checked < self.RELOAD_INTERVAL:
+			return
+
+		self.rule_file_checked = now
+		mtime = self.get_rule_file_mtime()
+		if force or (mtime is not None and mtime != self.rule_file_mtime):
+			# A failed load (e.g. file mid-write) keeps current rules; it is
+			# tried again at next check.
+			try:
+				bucket_rules = self.load_rule_file(self.rule_file_path)
+			except Exception as e:
+				self.log('WARNING: rule file', self.rule_file_path, 'could not be reloaded:', str(e))
+				return
+			self.bucket_rules = self.get_optimised_rules(bucket_rules) if self.optimise else bucket_rules
+			self.rule_file_mtime = mtime
+			self.log('Reloaded', len(self.bucket_rules), 'bucket rules from', self.rule_file_path)
+
+
+	def get_latency_stats(self):
+		"""
+		Request count, and latency statistics in milliseconds over the last
+		LATENCY_WINDOW requests.
+		"""
+		stats = {'requests': self.request_count}
+		if self.latencies:
+			latencies = sorted(self.latencies)
+			last = len(latencies) - 1
+			stats['ms'] = {
+				'mean': round(sum(latencies) / len(latencies), 4),
+				'p50': round(latencies[int(last * 0.50)], 4),
+				'p95': round(latencies[int(last * 0.95)], 4),
+				'p99': round(latencies[int(last * 0.99)], 4),
+				'max': round(latencies[last], 4)
+			}
+		return stats
 
 
 	"""
@@ -356,12 +844,17 @@ class OntologyBuckets(object):
     """
 	def intersectionOf(self, content):
 
-		intermediate = self.do_bucket_rule(content);
-		if all(intermediate):
-			intermediate.discard(True) # redundant
-			return intermediate
-		else:
-			return set([False])
+		# Operands are evaluated in order, stopping at the first one that 
+		# fails.
+		intermediate = set()
+		for item in content.keys():
+			output = self.do_bucket_rule({item: content[item]})
+			if not all(output):
+				return set([False])
+			intermediate.update(output)
+
+		intermediate.discard(True) # redundant
+		return intermediate
 
 	""" 
 		Matches to expressions like "not (a or b or c) ... " meaning
@@ -432,6 +925,97 @@ class OntologyBuckets(object):
 		return output
 
 
+	def do_root_rules(self, root_ids):
+		"""
+		Compiles and merges the bucket rules under each given root term, in
+		root order. Several roots are compiled in parallel by forked worker
+		processes which share the parsed graph and triple map copy-on-write.
+
+		INPUT
+			root_ids: list of full URI root entity ids
+		OUTPUT
+			bucket_rules: dictionary of bucket id -> rule
+		"""
+		self.triple_map = self.get_triple_map()
+
+		workers = min(len(root_ids), multiprocessing.cpu_count())
+		# A forked process can't share graph store's SQLite connection.
+		if workers > 1 and hasattr(os, 'fork') and self.onto_helper.graph_store_path is None:
+			global worker_buckets
+			worker_buckets = self
+			self.log('bucket rule compilation for', root_ids, 'by', workers, 'processes')
+			try:
+				# Workers exit before the pool is left, rather than being 
+				# terminated by it.
+				with multiprocessing.get_context('fork').Pool(workers) as pool:
+					root_rules = pool.map(do_worker_rules, root_ids)
+					pool.close()
+					pool.join()
+			finally:
+				worker_buckets = None
+		else:
+			root_rules = []
+			for term_id in root_ids:
+				self.log('bucket rule compilation for', term_id)
+				root_rules.append(self.do_membership_rules(term_id))
+
+		bucket_rules = {}
+		for rules in root_rules:
+			bucket_rules.update(rules)
+
+		return bucket_rules
+
+
+	def get_cache_key(self, main_ontology_file, root_ids):
+		"""
+		Content address of a compiled rule set: a hash of the ontology and
+		import file content, the requested roots, and this code (version
+		and source), so a cached rule file is only reused when none of the
+		inputs to its compilation have changed.
+		"""
+		digest = hashlib.sha256()
+		digest.update(self.onto_helper.get_ontology_hash(main_ontology_file).encode('utf-8'))
+		digest.update(','.join(root_ids).encode('utf-8'))
+		digest.update(self.CODE_VERSION.encode('utf-8'))
+		for module_file in [__file__, oh.__file__]:
+			with open(module_file, 'rb') as input_handle:
+				digest.update(input_handle.read())
+
+		return digest.hexdigest()[0:16]
+
+
+	def load_rule_cache(self, cache_file_path):
+		"""
+		Returns bucket rules from a cached rule file, or None if there isn't
+		one (or it can't be read).
+		"""
+		if not os.path.isfile(cache_file_path):
+			return None
+
+		try:
+			with open(cache_file_path, 'rb') as input_handle:
+				bucket_rules = pickle.load(input_handle)
+		except Exception as e:
+			print ('WARNING: cached rule file ' + cache_file_path + ' could not be loaded:', e)
+			return None
+
+		self.log("Using cached file:", cache_file_path)
+		return bucket_rules
+
+
+	def save_rule_cache(self, cache_file_path, bucket_rules):
+		"""
+		Writes bucket rules to cached rule file.  It is written to a 
+		temporary file first and then renamed so that a concurrent reader
+		never sees a partial file.
+		"""
+		temp_file_path = cache_file_path + '.' + str(os.getpid())
+		with open(temp_file_path, 'wb') as output_handle:
+			pickle.dump(bucket_rules, output_handle, pickle.HIGHEST_PROTOCOL)
+
+		os.replace(temp_file_path, cache_file_path)
+
+
 	""" ####################################################################
 		Membership Rules are boolean expressions or single entities linked
 		via 'has member' relation between a parent_id entity and children.
@@ -440,7 +1024,8 @@ class OntologyBuckets(object):
 		triple containing "[member of] [cardinality]
 
 		memberships_by_cardinality query returns just the cardinality part.
-		From there we explore the rest of the guts.
+		From there we explore the rest of the guts by walking
+		self.triple_map rather than issuing a query per blank node.
 
 		INPUTS
 			?parent_id ?label ?subject ?predicate ?object
@@ -448,8 +1033,10 @@ class OntologyBuckets(object):
 	"""
 	def do_membership_rules(self, term_id):
 
-		specBinding = {'root': rdflib.URIRef(term_id)} 
-		table = self.onto_helper.do_query_table(self.queries['report_mapping'], specBinding )
+		if self.triple_map is None:
+			self.triple_map = self.get_triple_map()
+
+		table = self.get_rule_triples(rdflib.URIRef(term_id))
 
 		print ("Bucket count:", len(table))
 
@@ -462,8 +1049,8 @@ class OntologyBuckets(object):
 			if self.TEST == 1 and not triple['parent_id'] in (['LEXMAPR:0000041']):
 				continue #LEXMAPR:0000002', 'LEXMAPR:0000007', '
 			
-			# The 'report_mapping' query triples also have a 'label' and
-			# 'parent_id' field. Generally they have predicate: someValuesFrom
+			# get_rule_triples() triples also have a 'label' and 'parent_id'
+			# field. Generally they have predicate: someValuesFrom
 			bucket_rules[triple['parent_id']] = self.do_triple(triple)
 
 			if self.TEST == 1:
@@ -472,18 +1059,125 @@ class OntologyBuckets(object):
 		return bucket_rules
 
 
+	def get_rule_triples(self, root):
+		"""
+		Membership rules under root, as triples.  Membership rules are
+		boolean expressions or single entities linked via 'has member'
+		(RO:0002351) to a parent_id entity.  Walks the rdfs:subClassOf*
+		closure of root, and for each class having a label and an 
+		owl:equivalentClass expression that is either a 'has member'
+		restriction or a boolean class expression, returns a row of that
+		expression's top-level triple.
+
+		OUTPUT
+			[{label, parent_id, subject, predicate, object}, ...] ordered by
+			parent_id URI, with values converted by get_node_value()
+		"""
+		graph = self.onto_helper.graph
+
+		# subClassOf* includes root itself
+		parent_ids = [root]
+		visited = set(parent_ids)
+		for parent_id in parent_ids:
+			for child_id in graph.subjects(self.SUBCLASS_OF, parent_id):
+				if not child_id in visited:
+					visited.add(child_id)
+					parent_ids.append(child_id)
+
+		table = []
+		for parent_id in sorted(parent_ids, key = str):
+			labels = list(graph.objects(parent_id, self.LABEL))
+			if not labels:
+				continue
+
+			rows = []
+			for subject in graph.objects(parent_id, self.EQUIVALENT_CLASS):
+				predicates = self.EXPRESSION_PREDICATES
+				if (subject, self.ON_PROPERTY, self.HAS_MEMBER) in graph:
+					predicates = self.RESTRICTION_PREDICATES + predicates
+
+				for predicate in predicates:
+					for node_object in graph.objects(subject, predicate):
+						# ?subject ?predicate ?object can match other
+						# predicates linking the same pair.
+						for link in graph.predicates(subject, node_object):
+							if not (subject, link, node_object) in rows:
+								rows.append((subject, link, node_object))
+
+			for label in labels:
+				for (subject, predicate, node_object) in rows:
+					table.append({
+						'label': self.get_node_value(label),
+						'parent_id': self.get_node_value(parent_id),
+						'subject': subject,
+						'predicate': self.get_node_value(predicate),
+						'object': self.get_node_value(node_object)
+					})
+
+		return table
+
+
+	def get_triple_map(self):
+		"""
+		Indexes the (predicate, object) pairs of every blank node subject in
+		the graph in one pass. Rule expressions are made entirely of anonymous
+		classes, restrictions and rdf:first/rdf:rest lists, so this map is all
+		that do_triple() needs to walk a rule.
+
+		Each subject's pairs are ordered by predicate URI as the former
+		'triple_by_subject' sparql query did ("ORDER BY ?predicate"), since 
+		later keys overwrite earlier ones when merged into a rule dictionary.
+		Ties keep graph order.
+
+		OUTPUT
+			{BNode: [(predicate, object), ...]} with values converted by 
+			get_node_value()
+		"""
+		graph = self.onto_helper.graph
+		triple_map = {}
+
+		for subject in graph.subjects():
+			if type(subject) is rdflib.term.BNode and not subject in triple_map:
+				pairs = sorted(graph.predicate_objects(subject), key = lambda pair: str(pair[0]))
+				triple_map[subject] = [(self.get_node_value(predicate), self.get_node_value(node_object)) for (predicate, node_object) in pairs]
+
+		return triple_map
+
+
+	def get_node_value(self, value):
+		"""
+		Converts an rdflib term the same way do_query_table() does for a 
+		cell: URIRef to prefixed id, Literal to string (or a value/datatype 
+		dictionary if it has a datatype other than xmls:string). BNodes are
+		returned untouched so they can be looked up in self.triple_map.
+		"""
+		valType = type(value)
+		if valType is rdflib.term.URIRef:
+			if not value in self.entity_ids:
+				self.entity_ids[value] = self.onto_helper.get_entity_id(value)
+			return self.entity_ids[value]
+
+		if valType is rdflib.term.Literal:
+			literal = value.replace('\n', r'\n')
+			if value.datatype == None or value.datatype == self.STRING_DATATYPE:
+				return literal
+			return {'value': literal, 'datatype': self.get_node_value(value.datatype)}
+
+		return value
+
+
 	def get_component_BNode(self, node_id):
 
 		result = {}
 
-		# Find subordinate tripples that begin with triple's object.
+		# Subordinate tripples that begin with triple's object.  Named
+		# entities (strings) and rdf:nil have no entry, so yield {}.
 		# Basically none of these are annotations
-		triples = self.onto_helper.do_query_table(
-			self.queries['triple_by_subject'], {'subject': node_id }
-		)
+		if type(node_id) is not rdflib.term.BNode:
+			return result
 
-		for bnode_triple in triples:
-			result.update( self.do_triple(bnode_triple) )
+		for (predicate, node_object) in self.triple_map.get(node_id, []):
+			result.update( self.do_triple({'subject': node_id, 'predicate': predicate, 'object': node_object}) )
 
 		return result
 
@@ -505,10 +1199,7 @@ class OntologyBuckets(object):
 			return self.get_component_BNode(bnode_object);
 
 		if bnode_predicate == 'rdf:rest':
-			if 'bnode_object' == 'rdf:nil':
-				# End of list.  Nothing more to do here.
-				return None 
-
+			# End of list (rdf:nil) yields an empty dictionary.
 			return self.get_component_BNode(bnode_object);
 
 		if bnode_predicate == 'rdf:type':
@@ -522,7 +1213,7 @@ class OntologyBuckets(object):
 			#print ("KONSTANT:", bnode_object)
 			return {bnode_predicate: {bnode_object: None}};
 
-		# E.g. QUALIFIED {'label': 'Avian', 'parent_id': 'LEXMAPR:0000004', 'expression': {'datatype': 'disjunction', 'data': []}, 'subject': rdflib.term.BNode('N56404ec196374f5998f05241cf8e7875'), 'predicate': 'owl:minQualifiedCardinality', 'object': {'value': '1', 'datatype': 'xmls:nonNegativeInteger'}}
+		# E.g. QUALIFIED {'label': 'Avian', 'parent_id': 'LEXMAPR:0000004', 'subject': rdflib.term.BNode('N56404ec196374f5998f05241cf8e7875'), 'predicate': 'owl:minQualifiedCardinality', 'object': {'value': '1', 'datatype': 'xmls:nonNegativeInteger'}}
 		if bnode_predicate in ['owl:qualifiedCardinality','owl:minQualifiedCardinality','owl:maxQualifiedCardinality']:
 			#print ('QUALIFIED', triple)
 			return {bnode_predicate: 
@@ -537,26 +1228,21 @@ class OntologyBuckets(object):
 
 	def get_component_cardinality(self, subject_id): 
 		"""
-		The cardinality cases all require 2nd query to fetch target class
-		of restriction.
+		The cardinality cases all require the restriction's owl:onClass
+		target class.
 		"""
-		objects = self.onto_helper.do_query_table(
-			self.queries['cardinality_target'], {'subject': subject_id}
-		)
-		#print ("DUMP CARD TRIPLES", objects)
 		# Should only be one...?!
-		for row in objects:
-			node_object = row['object']
-			if type(node_object) == str:
-				return {node_object: None}
+		for (predicate, node_object) in self.triple_map.get(subject_id, []):
+			if predicate == 'owl:onClass':
+				if type(node_object) == str:
+					return {node_object: None}
 
-			# NOT TESTED:
-			return self.get_component_BNode(node_object)
+				# NOT TESTED:
+				return self.get_component_BNode(node_object)
 
 		return {}
 	
 
-
 	def render_debug(self, triple):
 		return ("DEBUG:", json.dumps(triple, sort_keys=False, indent=4, separators=(',', ': ')))
 
@@ -588,11 +1274,52 @@ class OntologyBuckets(object):
 
 		parser.add_option('-r', '--root', dest='root_uri', type='string', help='Comma separated list of full URI root entity ids to fetch underlying terms from. Defaults to owl#Thing.', default='http://www.w3.org/2002/07/owl#Thing')
 
+		parser.add_option('--concurrency', dest='concurrency', type='int', help='Number of import files of an ontology given by URL to download at once.', default=4)
+
+		parser.add_option('--retries', dest='retries', type='int', help='Number of times to retry a failed ontology or import file download.', default=2)
+
+		parser.add_option('-g', '--graph-store', dest='graph_store', type='string', help='Keep ontology graph in given SQLite file rather than in memory.  The file is reused by later runs on the same ontology.')
+
+		parser.add_option('-R', '--rules', dest='rules_file', type='string', help='Use bucket rules from given .json or .pickle rule file rather than an ontology.')
+
+		parser.add_option('-m', '--materialise', dest='materialise', default=False, action='store_true', help='Write a [ontology].buckets.sqlite lookup table of the buckets each term in ontology (with its ancestors) triggers.')
+
+		parser.add_option('-l', '--lookup', dest='lookup', type='string', help='Classify -i ids (or serve mode "terms" requests) by given materialised .buckets.sqlite lookup table.')
+
+		parser.add_option('-O', '--optimise', dest='optimise', default=False, action='store_true', help='Simplify bucket rules (see ontorules.RuleOptimiser) before evaluating them.')
+
+		parser.add_option('-S', '--sharing', dest='sharing', default=False, action='store_true', help='Report shared subexpressions found in bucket rule set.')
+
+		parser.add_option('-t', '--trace', dest='trace', type='string', help='Trace mode: time each bucket rule and record what its parts matched, writing a JSON report to given file on exit.')
+
+		parser.add_option('--trace-limit', dest='trace_limit', type='int', help='Number of most recent comparison sets to keep match traces of in trace mode.', default=100)
+
+		parser.add_option('-s', '--serve', dest='serve', type='string', help='Keep running, answering JSON line classification requests on "stdio" or on given unix socket path.')
+
 		return parser.parse_args()
 
 
+class BucketRequestHandler(socketserver.StreamRequestHandler):
+	"""
+	Answers JSON line requests on a serve mode socket connection.
+	"""
+	def handle(self):
+		for line in self.rfile:
+			response = self.server.buckets.do_request_line(line.decode('utf-8'))
+			if response:
+				self.wfile.write((response + '\n').encode('utf-8'))
+
+
+# Set in parent process before forking do_root_rules() workers
+worker_buckets = None
+
+def do_worker_rules(term_id):
+	return worker_buckets.do_membership_rules(term_id)
+
+
 if __name__ == '__main__':
 
+	oh.OntoHelper.default_query_cache = True
 	buckets = OntologyBuckets()
 	buckets.__main__()  
 
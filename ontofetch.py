@@ -15,6 +15,12 @@
 	ISSUE: Doing a "BINDING (?x as ?y)" expression prevents ?x from 
 	being output in a SELECT. bug leads to no such field being output.
 
+	Compiled SPARQL queries are saved in ~/.cache/ontofetch/queries (or
+	the ONTOFETCH_QUERY_CACHE environment variable's folder; set it empty
+	to not save them) for later runs to load rather than compile again.
+	A folder other users can write to isn't used.  Library use, e.g. 
+	fetch_terms(), only saves them if ONTOFETCH_QUERY_CACHE is set.
+
 	EXAMPLES
 	Retrieve local file genepio-merged.owl and write files genepio-merged.json, genepio-merged.tsv into folder program was launched in.
 
@@ -28,9 +34,79 @@
 
 		> python ontofetch.py https://raw.githubusercontent.com/obi-ontology/obi/master/obi.owl -o test/ -r http://purl.obolibrary.org/obo/OBI_0200111,http://purl.obolibrary.org/obo/IAO_0000572
 
+	An ontology given by URL is downloaded along with its imports, up to 
+	--concurrency files at once, each retried up to --retries times.  
+	Imports start downloading as soon as they are declared, and are parsed
+	while later ones download (see ontoload.py).
+
+	Write terms as a shard .json file per top-level branch (or per id 
+	"prefix", or "size" chunks of --shard-size terms) plus a manifest of
+	shard files, term counts, id ranges and content hashes, for web 
+	clients to load picklists from lazily: 
+
+		> python ontofetch.py test/root-ontology.owl -o test/ -s branch
+
+	Write a smaller, quicker to parse test/root-ontology.compact.json with
+	terms in a columnar table of deduplicated strings instead (see 
+	OntoHelper.get_compact_struct(); read_compact_json() reads it back):
+
+		> python ontofetch.py test/root-ontology.owl -o test/ -f compact
+
+	Write a binary test/root-ontology.index of terms that services can 
+	open with ontoindex.TermIndex, which maps the file into memory rather
+	than reading it, to look up terms by id, prefix, parent or child:
+
+		> python ontofetch.py test/root-ontology.owl -o test/ -f index
+
+	Each term with a replaced_by gets a final_replaced_by: the term at 
+	the end of its chain of replacements.  A .deprecated.json file maps
+	every deprecated or replaced term in the ontology (under the roots or
+	not) to its final replacement.
+
+	While editing an ontology, rebuild output each time it or one of its
+	./imports/ files is saved.  Each file is kept in its own named graph,
+	so only a saved file is parsed again, and only terms it changed are 
+	queried again for labels, definitions and synonyms:
+
+		> python ontofetch.py ../genepio/src/ontology/genepio-edit.owl -o test/ -w
+
+	Query term labels, definitions and synonyms in 8 worker processes, 
+	which share the parsed graph (or, where processes can't be forked,
+	open the -g graph store):
+
+		> python ontofetch.py ../genepio/src/ontology/genepio-merged.owl -o test/ -j 8
+
+	Report progress of each stage of a long run (parse, imports, tree 
+	query, terms and output) on stderr every 10 seconds, with items done,
+	rate and ETA, and to a JSON lines file for scripts to monitor:
+
+		> python ontofetch.py ../genepio/src/ontology/genepio-merged.owl -o test/ -p --progress-interval 10 --progress-file test/genepio-merged.progress.jsonl
+
+	Fetch a small branch of a big ontology with --slim: once loaded, the 
+	graph is pruned to the triples about terms under the -r roots (with
+	their axioms and blank node restrictions, ontology metadata, and
+	deprecations), so term queries run on, and memory holds, just that.
+
+		> python ontofetch.py https://raw.githubusercontent.com/obi-ontology/obi/master/obi.owl -o test/ -r http://purl.obolibrary.org/obo/OBI_0200111 --slim
+
+	Keep the graph of a large ontology in an SQLite file instead of memory.
+	A later run on the same (unchanged) ontology reuses it without parsing.
+
+		> python ontofetch.py ../genepio/src/ontology/genepio-merged.owl -o test/ -g test/genepio-merged.graph.sqlite
+
 	Retrieve Zebra Fish Ontology
 		> python3 ../../ontofetch/ontofetch.py http://purl.obolibrary.org/obo/zfa.owl -r http://purl.obolibrary.org/obo/ZFA_0100000 -o ./
 
+	LIBRARY USE
+	fetch_terms() yields term records (as in the .json "specifications")
+	one by one, without printing or writing files, for a caller to store
+	as they come or stop early:
+
+		import ontofetch
+		(metadata, context, terms) = ontofetch.fetch_terms('test/root-ontology.owl', ['http://purl.obolibrary.org/obo/BFO_0000001'])
+		for term in terms:
+			print (term['id'], term.get('label'))
+
 
 	FUTURE: Get ontology version, and add to "version" field
 	
@@ -41,12 +117,15 @@ import json
 import sys
 import os
 import optparse
+import time
+import multiprocessing
 
 #from ontohelper import OntoHelper as oh
 import ontohelper as oh
 
-import rdflib
-from rdflib.plugins.sparql import prepareQuery
+# rdflib is only imported when first used (see ontohelper); a plain
+# "import rdflib" would import it straight away.
+rdflib = oh.rdflib
 
 # Do this, otherwise a warning appears on stdout: No handlers could be 
 #found for logger "rdflib.term"
@@ -57,6 +136,9 @@ try: #Python 2.7
 except ImportError: # Python 2.6
 	from ordereddict import OrderedDict
 
+# Ontology whose graph term worker processes query; see init_term_worker().
+worker_ontology = None
+
 def stop_err(msg, exit_code = 1):
 	sys.stderr.write("%s\n" % msg)
 	sys.exit(exit_code)
@@ -77,7 +159,14 @@ class Ontology(object):
 
 	CODE_VERSION = '0.0.4'
 	# This list doesn't include synonym types. ontohelper.py provides them.
-	FIELDS = ['id','parent_id','language','ontology','other_parents','label','definition','ul_label','ui_definition','ui_help','deprecated','replaced_by']
+	FIELDS = ['id','parent_id','language','ontology','other_parents','label','definition','ul_label','ui_definition','ui_help','deprecated','replaced_by','final_replaced_by']
+	# Root of all terms fetched unless other roots are given.
+	ROOT_URI = 'http://www.w3.org/2002/07/owl#Thing'
+	# GENEPIO "UI label" annotation, which orders terms ahead of rdfs:label.
+	UI_LABEL = oh.URIRefConstant('http://purl.obolibrary.org/obo/GENEPIO_0000006')
+	DEPRECATED = oh.URIRefConstant('http://www.w3.org/2002/07/owl#deprecated')
+	# IAO "term replaced by" annotation
+	REPLACED_BY = oh.URIRefConstant('http://purl.obolibrary.org/obo/IAO_0100001')
 
 
 	def __init__(self):
@@ -86,6 +175,14 @@ class Ontology(object):
 		# ADDITIONAL FIELDS THAT WOULD BE MANAGED IN SYNCHRONIZATION of TARGET
 		# LOOKUP TABLE: 'updated','preferred'
 		self.fields = self.FIELDS + self.onto_helper.SYNONYM_FIELDS
+		# (graph version, get_replacements(), get_final_replacement() 
+		# results) so far; see get_replacement_state().
+		self.replacement_state = None
+		# Root term id -> (graph version, column names, rows) of its "tree"
+		# query result, before ordering; see get_tree_table().
+		self.tree_results = {}
+		# Number of processes iter_terms() queries term details in.
+		self.workers = 1
 
 		""" 
 		Add these PREFIXES to Sparql query window if you want to test a query there:
@@ -95,17 +192,17 @@ class Ontology(object):
 		PREFIX xmls: <http://www.w3.org/2001/XMLSchema#>
 		""" 
 	 
-		self.queries = {
+		self.queries = oh.QueryRegistry({
 			##################################################################
-			# Generic TREE "is a" hierarchy from given root.
+			# Generic TREE "is a" hierarchy from given root.  Rows are put in
+			# order by get_tree_table(), not by an ORDER BY here.
 			#
-			'tree': prepareQuery("""
+			'tree': """
 				SELECT DISTINCT ?id ?label ?parent_id ?deprecated ?replaced_by 
 				WHERE {	
 					?parent_id rdfs:subClassOf* ?root.
 					?id rdfs:subClassOf ?parent_id.
 					OPTIONAL {?id rdfs:label ?label}.
-	 				OPTIONAL {?id GENEPIO:0000006 ?ui_label}. # for ordering
 					OPTIONAL {?id owl:deprecated ?deprecatedAnnot.
 						BIND(xsd:string(?deprecatedAnnot) As ?deprecated).
 					}.
@@ -113,8 +210,7 @@ class Ontology(object):
 						BIND(xsd:string(?replaced_byAnnot) As ?replaced_by).
 					}.	
 				}
-				ORDER BY ?parent_id ?ui_label ?label 
-			""", initNs = self.onto_helper.namespace),
+			""",
 
 
 			# ################################################################
@@ -122,7 +218,7 @@ class Ontology(object):
 			# These are annotations directly on an entity.  This is the only place
 			# that ui_label and ui_definition should really operate. Every entity
 			# in OWL file is retrieved for their rdfs:label, IAO definition etc.
-			'entity_text': prepareQuery("""
+			'entity_text': """
 
 				SELECT DISTINCT ?label ?definition ?ui_label ?ui_definition
 				WHERE {  
@@ -134,7 +230,7 @@ class Ontology(object):
 					OPTIONAL {?datum GENEPIO:0000006 ?ui_label.} 
 					OPTIONAL {?datum GENEPIO:0000162 ?ui_definition.}
 				} ORDER BY ?label
-			""", initNs = self.onto_helper.namespace),
+			""",
 
 
 
@@ -148,14 +244,14 @@ class Ontology(object):
 			# OUTPUT
 			#   ?parent_ids
 			#
-			#'entity_parents': prepareQuery("""
+			#'entity_parents': """
 			#	SELECT DISTINCT ?datum_id (group_concat(distinct ?parent_id;separator=",") as ?parent_ids)
 			#	WHERE {
 			#		?datum_id rdfs:subClassOf ?parent_id.
 			#		?parent_id rdfs:label ?label # to ensure parent_id entity is in graph as well.
 			#	}
-			#""", initNs = self.onto_helper.namespace),
-		}
+			#""",
+		}, self.onto_helper.namespace, self.onto_helper.get_query_cache_folder())
 
 	def __main__(self):
 		"""
@@ -181,94 +277,436 @@ class Ontology(object):
 		if not len(args):
 			stop_err('Please supply an OWL ontology file (in RDF/XML format)')
 
+		if options.shard_by and options.output_format == 'index':
+			stop_err('A term index (-f index) is one file, so can\'t be sharded (-s)')
+		if options.shard_size < 1:
+			stop_err('--shard-size must be at least 1')
+
 		(main_ontology_file, output_file_basename) = self.onto_helper.check_ont_file(args[0], options)
+		self.onto_helper.fetch_concurrency = options.concurrency
+		self.onto_helper.fetch_retries = options.retries
+		if options.progress or options.progress_file:
+			self.onto_helper.progress = oh.ProgressReporter(sys.stderr if options.progress else None, options.progress_file, options.progress_interval)
 
-		# Load main ontology file into RDF graph
-		print ("Fetching and parsing " + main_ontology_file + " ...")
+		if options.watch:
+			if main_ontology_file[0:4] == 'http' or options.graph_store or options.slim:
+				stop_err('Watch mode needs an ontology file path, and no graph store or slim graph')
+			return self.do_watch(main_ontology_file, options, output_file_basename)
 
-		try:
-			# ISSUE: ontology file taken in as ascii; rdflib doesn't accept
-			# utf-8 characters so can experience conversion issues in string
-			# conversion stuff like .replace() below
-			self.onto_helper.graph.parse(main_ontology_file, format='xml')
+		if options.graph_store:
+			self.onto_helper.open_graph_store(options.graph_store)
 
-		except Exception as e:
-			#urllib2.URLError: <urlopen error [Errno 8] nodename nor servname provided, or not known>
-			stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+		if self.onto_helper.is_graph_stored(main_ontology_file):
+			print ("Using " + main_ontology_file + " graph stored in " + options.graph_store)
+
+		else:
+			self.load_ontology(main_ontology_file)
+
+		if options.slim:
+			self.onto_helper.progress.start('slim', None, options.root_uri)
+			loaded = len(self.onto_helper.graph)
+			(terms, triples) = self.onto_helper.set_slim_graph(options.root_uri.split(','), [self.DEPRECATED, self.REPLACED_BY])
+			self.onto_helper.progress.end()
+			print ('Slim graph: %d terms, %d of %d triples' % (terms, triples, loaded))
+
+		self.do_build(options, output_file_basename)
 
-		# Add each ontology include file (must be in OWL RDF format)
-		self.onto_helper.do_ontology_includes(main_ontology_file)
 
+	def do_build(self, options, output_file_basename):
+		"""
+		Fetches metadata and terms from loaded graph into 
+		self.onto_helper.struct and writes output files.
+		"""
+		self.workers = options.workers
 		# Load self.struct with ontology metadata
 		self.onto_helper.set_ontology_metadata(self.onto_helper.queries['ontology_metadata'])
 		print ('Metadata: ' + json.dumps(self.onto_helper.struct['metadata'],  sort_keys=False, indent=4, separators=(',', ': ')) )
 
-		for term_id in options.root_uri.split(','):
-			print ('Doing term hierarchy query starting at: ' + term_id)
-			specBinding = {'root': rdflib.URIRef(term_id)} 
-			entities = self.onto_helper.do_query_table(self.queries['tree'], specBinding)
+		specifications = self.onto_helper.struct['specifications'] = {}
+		for term in self.iter_terms(options.root_uri.split(',')):
+			specifications[term['id']] = term
 
-			print ('Doing terms: ' + str(len(entities)) )
-			self.do_entities(entities)
+		# Deprecated term -> final replacement lookup table
+		self.do_output_deprecations(output_file_basename)
 		
-		# JSON data structure output
-		self.onto_helper.do_output_json(self.onto_helper.struct, output_file_basename)
+		self.onto_helper.log('Query cache: ' + json.dumps(self.onto_helper.get_query_stats()))
+
+		# Files written: deprecations (above), JSON and tsv.
+		progress = self.onto_helper.progress
+		progress.start('output', 3, output_file_basename)
+		progress.step()
+
+		# JSON data structure output, whole or in shards with a manifest
+		compact = options.output_format == 'compact'
+		if options.shard_by:
+			shards = self.onto_helper.get_shards(specifications, options.shard_by, options.shard_size)
+			self.onto_helper.do_output_shards(self.onto_helper.struct, output_file_basename, shards, options.shard_by, compact)
+			print ('Shards: ' + str(len(shards)))
+		elif compact:
+			self.onto_helper.do_output_compact_json(self.onto_helper.struct, output_file_basename)
+		elif options.output_format == 'index':
+			self.onto_helper.do_output_index(self.onto_helper.struct, output_file_basename)
+		else:
+			self.onto_helper.do_output_json(self.onto_helper.struct, output_file_basename)
+		progress.step()
 		# Tab separated version
 		self.onto_helper.do_output_tsv(self.onto_helper.struct, output_file_basename, self.fields)
+		progress.step()
+		progress.end()
 
 
-	def do_entities(self, table):
+	def do_watch(self, main_ontology_file, options, output_file_basename):
+		"""
+		Loads main ontology file and its imports each into a named graph
+		(see OntoHelper.do_ontology_load_sources()) and builds output, then
+		checks every options.interval seconds for saved changes to them.  A
+		changed file alone is parsed again, and output rebuilt reusing the
+		label, definition and synonym query results of terms it didn't 
+		change (the per term queries that take most of a build).  The 
+		"tree" query, term ordering and output files are redone in full.
+		Stops on Ctrl-C.
+		"""
+		helper = self.onto_helper
+		helper.local_queries.update([self.queries['entity_text'], helper.queries['entity_synonyms']])
+
+		helper.log("Fetching and parsing " + main_ontology_file + " ...")
+		try:
+			helper.do_ontology_load_sources(main_ontology_file)
+		except Exception as e:
+			stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+		self.do_build(options, output_file_basename)
+
+		print ('Watching ' + ', '.join(helper.graph_sources) + ' for changes (Ctrl-C to stop) ...')
+		try:
+			while True:
+				time.sleep(options.interval)
+				changed = helper.get_changed_sources()
+				if changed:
+					start = time.perf_counter()
+					subjects = self.do_rebuild(main_ontology_file, changed, options, output_file_basename)
+					if subjects is not None:
+						print ('Rebuilt in %d ms; %d subjects changed.' % ((time.perf_counter() - start) * 1000, len(subjects)))
+
+		except KeyboardInterrupt:
+			pass
+
+
+	def do_rebuild(self, main_ontology_file, changed, options, output_file_basename):
+		"""
+		Parses given changed source files again and rebuilds output, for
+		do_watch().  Returns set of subjects of changed triples, or None if
+		no file could be parsed.
+		"""
+		helper = self.onto_helper
+		triples = set()
+		reloaded = False
+		for file_path in changed:
+			print ('Reloading ' + file_path)
+			try:
+				triples |= helper.reload_source(file_path)
+				reloaded = True
+			except Exception as e:
+				print ('WARNING:' + file_path + ' could not be parsed; keeping its earlier version.', e)
+
+		if not reloaded:
+			return None
+
+		if main_ontology_file in changed:
+			triples |= helper.set_import_sources(main_ontology_file)
+
+		subjects = set(triple[0] for triple in triples)
+		helper.set_graph_changed(subjects)
+		self.update_tree_results(triples)
+		self.do_build(options, output_file_basename)
+		return subjects
+
+
+	def update_tree_results(self, triples):
+		"""
+		Brings kept "tree" query results up to date after given triples are
+		added to or removed from the graph, without running the query in 
+		full if possible.  If no rdfs:subClassOf triple changed, the terms
+		under each root are the same, so only changed terms' rows are
+		queried again, and put where their old rows were.
+		"""
+		helper = self.onto_helper
+		if any(triple[1] == rdflib.RDFS.subClassOf for triple in triples):
+			self.tree_results = {}
+			return
+
+		ids = set(triple[0] for triple in triples)
+		for (term_id, (version, names, rows)) in list(self.tree_results.items()):
+			id_position = names.index('id')
+			changed_rows = dict((id, helper.get_query_result(self.queries['tree'], {'root': rdflib.URIRef(term_id), 'id': id})[1]) for id in ids)
+			patched = []
+			for row in rows:
+				id = row[id_position]
+				if id in changed_rows:
+					patched.extend(changed_rows.pop(id))
+				elif not id in ids:
+					patched.append(row)
+
+			# A changed term not in the old result but in the new one.
+			if any(changed_rows.values()):
+				del self.tree_results[term_id]
+			else:
+				self.tree_results[term_id] = (helper.graph.version, names, patched)
+
+
+	def get_tree_table(self, term_id):
+		"""
+		Returns do_query_table() rows of "tree" query for terms under given
+		root, grouped by parent_id and within that ordered by ui_label (if
+		any) and label, as the query's ORDER BY ?parent_id ?ui_label ?label
+		used to do in rdflib.  See OntoHelper.get_hierarchy_order().
+		"""
+		helper = self.onto_helper
+		kept = self.tree_results.get(term_id)
+		if kept is not None and kept[0] == helper.graph.version:
+			(names, rows) = kept[1:]
+		else:
+			(names, rows) = helper.get_query_result(self.queries['tree'], {'root': rdflib.URIRef(term_id)})
+			self.tree_results[term_id] = (helper.graph.version, names, rows)
+		rows = helper.get_hierarchy_order(rows, names.index('id'), names.index('parent_id'), names.index('label'), self.UI_LABEL)
+		return list(helper.get_table_rows(rows, list(enumerate(names))))
+
+
+	def iter_terms(self, root_uris = None):
 		""" 
-			Converts table of ontology terms - each having its own row of
-			dictionary, into self.struct['specifications'] dictionary.
-			References to parents are also pursued - on a second iteration
-			so that they are primarily filled in on first pass if already
-			mentioned in hierarchy, but barebones record is created for
-			them if not.
-
-			Example output of one term conversion:
-				"GENEPIO:0001677": {
+			Generator of term records, as kept in output .json 
+			"specifications", for all terms under each given root URI
+			(by default owl:Thing).  Each record is complete when yielded,
+			being made from all of the term's "tree" query rows at once, so
+			records needn't be held by the caller (nor here, where only the
+			roots' "tree" query tables and the ids already yielded are kept).
+			Every root's tree query is run first, so that a term under more
+			than one root is yielded once, with the first root's terms, yet
+			has other_parents from each root it is under.
+
+			A term with a replaced_by also gets its final_replaced_by (see
+			get_final_replacement()).
+
+			Parents of a root's top-level terms also get a minimal record, 
+			after that root's terms, if they aren't terms under any root.
+			Example term record:
+				{
 		            "id": "GENEPIO:0001677",
-		            "parent": "GENEPIO:0001606",
-		            "ui_label": "contact specification - patient"
-		            }
+		            "parent_id": "GENEPIO:0001606",
+		            "label": "contact specification - patient"
 		        }
+		"""
+		done = set()
+		(replacements, finals) = self.get_replacement_state()
+		progress = self.onto_helper.progress
+
+		# A term is in a table once for each of its parents (and labels);
+		# term_rows gathers its rows from all roots, skipping a later 
+		# root's rows for parents already seen, and root_terms lists
+		# each root's terms in order, with the parents they mention.
+		term_rows = OrderedDict()
+		root_terms = []
+		for term_id in root_uris or [self.ROOT_URI]:
+			self.onto_helper.log('Doing term hierarchy query starting at: ' + term_id)
+			progress.start('tree', 1, term_id)
+			table = self.get_tree_table(term_id)
+			progress.step()
+			self.onto_helper.log('Doing terms: ' + str(len(table)) )
+
+			seen = set(term_rows)
+			ids = OrderedDict()
+			parents = OrderedDict()
+			for myDict in table:
+				id = str(myDict['id'])
+				parent_id = self.onto_helper.get_parent_id(myDict) 
+				ids[id] = True
+				if parent_id:
+					parents[parent_id] = True
+				if id in seen and parent_id in [self.onto_helper.get_parent_id(row) for row in term_rows[id]]:
+					continue
+				term_rows.setdefault(id, []).append(myDict)
+			root_terms.append((term_id, ids, parents))
+
+		for (term_id, ids, parents) in root_terms:
+			rows = [(id, term_rows[id]) for id in ids if not id in done]
+			progress.start('terms', len(rows), term_id)
+			for term in self.iter_entities(rows):
+				done.add(term['id'])
+				self.set_final_replacement(term, replacements, finals)
+				progress.step()
+				yield term
+			progress.end()
+
+			# Parent gets entry too, though maybe not a label. If not 
+			# mentioned in its own right, then it was parent of top-level
+			# entity, and not really important, so it gets a minimal entry.
+			for parent_id in parents:
+				if not parent_id in done and not parent_id in term_rows:
+					done.add(parent_id)
+					yield {'id': parent_id, 'datatype': 'entity'}
+
+
+	def iter_entities(self, term_rows):
+		"""
+		Generator of term records made by do_entity() from each given (id,
+		"tree" table rows) item, in the given order.  With self.workers
+		above 1, terms are split into shards done by a pool of worker 
+		processes (see do_term_shard()), whose results are merged back in
+		order, so output is the same as from a single process.
+		"""
+		if self.workers < 2 or len(term_rows) < 2:
+			for (id, rows) in term_rows:
+				specifications = {}
+				for myDict in rows:
+					self.do_entity(myDict, specifications)
+				yield specifications[id]
+			return
+
+		helper = self.onto_helper
+		# Forked workers share the parent's parsed graph (copy-on-write). 
+		# Elsewhere they are started afresh, so need a graph store to open.
+		global worker_ontology
+		if 'fork' in multiprocessing.get_all_start_methods():
+			context = multiprocessing.get_context('fork')
+			worker_ontology = self
+		elif helper.graph_store_path:
+			context = multiprocessing.get_context('spawn')
+		else:
+			helper.log('WARNING: Worker processes need a graph store (-g) on this platform; using one process.')
+			self.workers = 1
+			for term in self.iter_entities(term_rows):
+				yield term
+			return
+
+		# Several shards per worker even out their uneven query times.
+		size = max(1, len(term_rows) // (self.workers * 8))
+		shards = [term_rows[start: start + size] for start in range(0, len(term_rows), size)]
+		pool = context.Pool(self.workers, init_term_worker, (helper.graph_store_path, helper.struct['@context'], helper.struct['metadata']))
+		try:
+			for results in pool.imap(do_term_shard, shards):
+				for (term, context_items) in results:
+					# Prefixes the term's ids added to @context, as they 
+					# would have been in a single process.
+					for (prefix, uri) in context_items:
+						helper.struct['@context'][prefix] = uri
+					yield term
+		finally:
+			pool.terminate()
+			worker_ontology = None
+
+
+	def get_replacements(self):
+		"""
+		Returns dictionary of the full URI of each deprecated (owl:deprecated
+		true) or replaced (IAO:0100001 replaced_by) term in the graph, to 
+		the full URI of its replacement, or None if it has none.  Of more
+		than one replacement, the first in sorted order is used.  Terms
+		needn't be under the roots being fetched, as deprecated terms often
+		aren't in the class hierarchy at all.
+		"""
+		graph = self.onto_helper.graph
+		replacements = {}
+		for (subject, value) in graph.subject_objects(self.DEPRECATED):
+			if isinstance(subject, rdflib.URIRef) and str(value).lower() in ('true', '1'):
+				replacements[str(subject)] = None
+
+		for (subject, value) in sorted((str(subject), str(value)) for (subject, value) in graph.subject_objects(self.REPLACED_BY) if isinstance(subject, rdflib.URIRef)):
+			if replacements.get(subject) is None:
+				replacements[subject] = self.get_replacement_uri(value)
 
-			
+		return replacements
+
+
+	def get_replacement_state(self):
+		"""
+		Returns (get_replacements(), dictionary of get_final_replacement()
+		results so far), kept while the graph is unchanged.
 		"""
+		version = self.onto_helper.graph.version
+		if self.replacement_state is None or self.replacement_state[0] != version:
+			self.replacement_state = (version, self.get_replacements(), {})
+		return self.replacement_state[1:]
 
-		# List of parents to process after 1st pass through table's entities.
-		parents = [] 
 
-		for myDict in table:
-			self.do_entity(myDict)
+	def get_replacement_uri(self, value):
+		"""
+		Full URI of a replaced_by value, which may be a URI or, as a 
+		literal, a prefixed id like "GO:0005623".
+		"""
+		if value[0:4] != 'http' and ':' in value and value.rsplit(':', 1)[0] in self.onto_helper.struct['@context']:
+			return self.onto_helper.get_expanded_id(value)
+		return value
 
-			parent_id = self.onto_helper.get_parent_id(myDict) 
-			if parent_id:
-				if not parent_id in parents:
-					parents.append(parent_id)
 
-		# 2nd pass does parents:
-		# Parent gets entry in structure too, though maybe not a label.
-		# If not already mentioned in its own right, then it was parent
-		# of top-level entity, and not really important, so it gets a
-		# minimal entry.
-		for parent_id in parents:
-			if not parent_id in self.onto_helper.struct['specifications']:
-				self.onto_helper.set_entity_default(self.onto_helper.struct, 'specifications', parent_id, {
-					'id': parent_id, 
-					'datatype': 'entity'
-				})
+	def get_final_replacement(self, uri, replacements, finals):
+		"""
+		Follows replaced_by chain from given term URI to its last term, the
+		first one without a replacement (which is the given term itself if
+		it has none).  Returns None if the chain runs into a cycle.  Results
+		for every term on the chain are kept in finals, so each chain is 
+		followed once.
+		"""
+		path = []
+		on_path = set()
+		current = uri
+		while not current in finals:
+			if current in on_path:
+				cycle = path[path.index(current):]
+				self.onto_helper.log('WARNING: replaced_by cycle: ' + ' -> '.join(cycle + [current]))
+				finals[current] = None
+				break
+			replacement = replacements.get(current)
+			if replacement is None:
+				finals[current] = current
+				break
+			path.append(current)
+			on_path.add(current)
+			current = replacement
+
+		for term_uri in path:
+			finals[term_uri] = finals[current]
+		return finals[current]
+
+
+	def set_final_replacement(self, myDict, replacements, finals):
+		"""
+		Adds final_replaced_by, the end of the term's replaced_by chain, to
+		given term record if it has a replaced_by.  It is left out if the
+		chain is a cycle.
+		"""
+		if myDict.get('replaced_by'):
+			final = self.get_final_replacement(self.get_replacement_uri(myDict['replaced_by']), replacements, finals)
+			if final is not None:
+				myDict['final_replaced_by'] = self.onto_helper.get_entity_id(final)
+
 
+	def do_output_deprecations(self, output_file_basename):
+		"""
+		Writes a .deprecated.json lookup table of every deprecated or 
+		replaced term id in the ontology to the id of its final 
+		replacement (see get_final_replacement()), or null if it has none 
+		or its replaced_by chain is a cycle, for remapping stored term ids
+		with one lookup each:
 
-	def do_entity(self, myDict):
+			{"GENEPIO:0001032":"GENEPIO:0001988","OBI:0000000":null,...}
 		"""
-		Inserts or overlays entity described by myDict into 
-		self.struct['specifications']
+		(replacements, finals) = self.get_replacement_state()
+		deprecations = {}
+		for uri in replacements:
+			final = self.get_final_replacement(uri, replacements, finals)
+			deprecations[self.onto_helper.get_entity_id(uri)] = None if final in (None, uri) else self.onto_helper.get_entity_id(final)
+
+		with (open(output_file_basename + '.deprecated.json', 'w')) as output_handle:
+			output_handle.write(json.dumps(OrderedDict(sorted(deprecations.items())), separators = (',', ':')))
+
+
+	def do_entity(self, myDict, specifications):
+		"""
+		Inserts or overlays entity described by myDict into given
+		specifications dictionary.
 		
 		INPUT
 			myDict:dict (row from table)
-			prefix:string indicates source ontology for term
+			specifications:dict of term id -> term record
 		OUTPUT
 			myDict:dict modified entity
 		"""
@@ -287,8 +725,8 @@ class Ontology(object):
 
 		# Addresses case where a term is in query more than once, as
 		# a result of being positioned in different places in hierarchy.
-		if id in self.onto_helper.struct['specifications']:
-			existing = self.onto_helper.struct['specifications'][id]
+		if id in specifications:
+			existing = specifications[id]
 			parent_id = myDict['parent_id']
 			existing_p_id = existing['parent_id']
 			if parent_id and existing_p_id and parent_id != existing_p_id:
@@ -296,35 +734,37 @@ class Ontology(object):
 					existing['other_parents'] = []
 				existing['other_parents'].append(parent_id)
 
-		self.onto_helper.set_entity_default(self.onto_helper.struct, 'specifications', id, myDict)
+		if not id in specifications:
+			specifications[id] = myDict
 
-		self.do_entity_text(id)
-		self.do_entity_synonyms(id)
+		self.do_entity_text(id, specifications[id])
+		self.do_entity_synonyms(id, specifications[id])
 
 
-	def do_entity_text(self, id):
+	def do_entity_text(self, id, spec):
 		"""
 		For given entity, all 'labels' query fields are returned (rdfs:label, IAO 
-		definition, UI label, UI definition) and added to the entity directly.
+		definition, UI label, UI definition) and added to its spec record directly.
 
 		"""
 		myURI = rdflib.URIRef(self.onto_helper.get_expanded_id(id))
-		rows = self.onto_helper.graph.query(
+		rows = self.onto_helper.query(
 			self.queries['entity_text'],	
 			initBindings = {'datum': myURI} 
 		)
 		# Should only be 1 row to loop through
 		for row in rows: 
-			myDict = row.asdict()	
+			# Plain strings, not rdflib Literals, for library use.
+			myDict = dict((key, str(value)) for (key, value) in row.asdict().items())
 			# Adds any new text items to given id's structure
-			self.onto_helper.struct['specifications'][id].update(myDict) 
+			spec.update(myDict) 
 			# Issue: carriage returns in definition; this is taken care of in
 			# do_output_tsv()
 
 
-	def do_entity_synonyms(self, id):
+	def do_entity_synonyms(self, id, spec):
 		"""
-		Augment each entry in 'specifications' with semi-colon-delimited 
+		Augment given 'specifications' entry with semi-colon-delimited 
 		synonyms gathered from 'entity_synonyms' query of annotations which
 		originate in these relations 
 
@@ -346,13 +786,11 @@ class Ontology(object):
 		"""
 		
 		myURI = rdflib.URIRef(self.onto_helper.get_expanded_id(id))
-		rows = self.onto_helper.graph.query(
+		rows = self.onto_helper.query(
 			self.onto_helper.queries['entity_synonyms'], 
 			initBindings = {'datum': myURI }
 		)
 
-		spec = self.onto_helper.struct['specifications'][id]
-
 		for row in rows:
 
 			# Specification distinguishes between these kinds of synonym
@@ -372,9 +810,50 @@ class Ontology(object):
 							spec[prefix_field] = phrases
 
 
-	def get_command_line(self):
+	def load_ontology(self, main_ontology_file):
+		"""
+		Loads main ontology file and its imports into RDF graph, exiting 
+		with an error message if the main file can't be loaded.
+		"""
+		self.onto_helper.log("Fetching and parsing " + main_ontology_file + " ...")
+
+		try:
+			self.read_ontology(main_ontology_file)
+
+		except Exception as e:
+			#urllib2.URLError: <urlopen error [Errno 8] nodename nor servname provided, or not known>
+			stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+
+
+	def read_ontology(self, main_ontology_file):
+		"""
+		Loads main ontology file and its imports into RDF graph; an error
+		loading the main file is raised.
+		"""
+		self.onto_helper.do_ontology_load(main_ontology_file)
+		self.onto_helper.save_graph_store(main_ontology_file)
+
+
+	def open_ontology(self, main_ontology_file, graph_store = None):
+		"""
+		Loads ontology (or reuses given graph store of it) and its metadata,
+		as __main__() does but without command line, printing or output 
+		files.  Errors are raised.  See fetch_terms().
+		"""
+		self.onto_helper.verbose = False
+		if graph_store:
+			self.onto_helper.open_graph_store(graph_store)
+
+		if not self.onto_helper.is_graph_stored(main_ontology_file):
+			self.read_ontology(main_ontology_file)
+
+		self.onto_helper.set_ontology_metadata(self.onto_helper.queries['ontology_metadata'])
+
+
+	def get_command_line(self, args = None):
 		"""
 		*************************** Parse Command Line *****************************
+		Parses given arguments, by default the command line's.
 		"""
 		parser = MyParser(
 			description = 'Ontology term fetch to tabular output.  See https://github.com/GenEpiO/genepio',
@@ -389,13 +868,95 @@ class Ontology(object):
 
 		parser.add_option('-o', '--output', dest='output_folder', type='string', help='Path of output file to create')
 		
-		parser.add_option('-r', '--root', dest='root_uri', type='string', help='Comma separated list of full URI root entity ids to fetch underlying terms from. Defaults to owl#Thing.', default='http://www.w3.org/2002/07/owl#Thing')
+		parser.add_option('-g', '--graph-store', dest='graph_store', type='string', help='Keep ontology graph in given SQLite file rather than in memory.  The file is reused by later runs on the same ontology.')
+
+		parser.add_option('--concurrency', dest='concurrency', type='int', help='Number of import files of an ontology given by URL to download at once.', default=4)
+
+		parser.add_option('--retries', dest='retries', type='int', help='Number of times to retry a failed ontology or import file download.', default=2)
+
+		parser.add_option('-f', '--format', dest='output_format', type='choice', choices=['json', 'compact', 'index'], help='JSON output as usual ("json"), or as a smaller .compact.json file ("compact") with a columnar term table (see OntoHelper.get_compact_struct()), or as a memory-mappable binary .index file ("index") for lookup by id (see ontoindex.py).', default='json')
+
+		parser.add_option('-s', '--shard-by', dest='shard_by', type='choice', choices=oh.OntoHelper.SHARD_MODES, help='Instead of one .json file, write a .json file per shard of terms (in compact form with -f compact), and a .manifest.json listing them.  Shards are by top-level "branch", id "prefix", or "size" (see --shard-size).  Not for -f index.')
+
+		parser.add_option('--shard-size', dest='shard_size', type='int', help='Number of terms (at least 1) per shard for --shard-by size.', default=1000)
+
+		parser.add_option('-j', '--workers', dest='workers', type='int', help='Number of processes to query term details in.  Output is the same as with 1 (the default).', default=1)
+
+		parser.add_option('-w', '--watch', dest='watch', default=False, action='store_true', help='Keep running, rebuilding output whenever the ontology file or one of its ./imports/ files is saved.')
+
+		parser.add_option('--interval', dest='interval', type='float', help='Seconds between checks for changed files in watch mode.', default=1.0)
+
+		parser.add_option('-p', '--progress', dest='progress', default=False, action='store_true', help='Print progress of each stage (parse, imports, slim, tree, terms, output) to stderr: items done, rate and ETA.')
+
+		parser.add_option('--progress-file', dest='progress_file', type='string', help='Write progress events of each stage to given file as JSON lines.')
 
-		return parser.parse_args()
+		parser.add_option('--progress-interval', dest='progress_interval', type='float', help='Least number of seconds between progress events of a stage.', default=1.0)
+
+		parser.add_option('--slim', dest='slim', default=False, action='store_true', help='Once the ontology is loaded, keep only the part of its graph about terms under the -r roots, so that queries and memory use scale with their branches.  Output is the same.')
+
+		parser.add_option('-r', '--root', dest='root_uri', type='string', help='Comma separated list of full URI root entity ids to fetch underlying terms from. Defaults to owl#Thing.', default=self.ROOT_URI)
+
+		return parser.parse_args(args)
+
+
+def init_term_worker(graph_store_path, context, metadata):
+	"""
+	Sets up worker process for Ontology.iter_entities(): a forked one 
+	already has the parent's ontology; a spawned one opens its graph 
+	store.  A graph store's SQLite connection can't be shared between 
+	processes, so a forked one reopens it too.
+	"""
+	global worker_ontology
+	if worker_ontology is None:
+		worker_ontology = Ontology()
+	if graph_store_path:
+		worker_ontology.onto_helper.open_graph_store(graph_store_path)
+	worker_ontology.onto_helper.verbose = False
+	# Progress is the parent's to report, as it merges worker results.
+	worker_ontology.onto_helper.progress = oh.ProgressReporter()
+	worker_ontology.onto_helper.struct['metadata'] = metadata
+	worker_ontology.shard_context = OrderedDict(context)
+
+
+def do_term_shard(term_rows):
+	"""
+	Returns a (term record, @context items it added) tuple for each given
+	(id, "tree" table rows) item, made by Ontology.do_entity() in a worker
+	process.  Each shard starts from the parent's @context, so that the 
+	first term of a shard to add a prefix reports it, and the parent, 
+	merging shards in order, adds each prefix at the same point as a 
+	single process would.
+	"""
+	helper = worker_ontology.onto_helper
+	context = helper.struct['@context'] = OrderedDict(worker_ontology.shard_context)
+	results = []
+	for (id, rows) in term_rows:
+		before = dict(context)
+		specifications = {}
+		for myDict in rows:
+			worker_ontology.do_entity(myDict, specifications)
+		results.append((specifications[id], [(prefix, uri) for (prefix, uri) in context.items() if before.get(prefix) != uri]))
+
+	return results
+
+
+def fetch_terms(main_ontology_file, root_uris = None, graph_store = None):
+	"""
+	Library entry point: loads given ontology file path or URL (or reuses
+	its graph store) and returns (metadata, @context, terms) where terms 
+	is an iterator of term records under given root URIs, as produced by
+	Ontology.iter_terms().  Nothing is printed or written; errors are
+	raised.  Stopping iteration early skips the remaining terms' queries.
+	"""
+	ontology = Ontology()
+	ontology.open_ontology(main_ontology_file, graph_store)
+	struct = ontology.onto_helper.struct
+	return (struct['metadata'], struct['@context'], ontology.iter_terms(root_uris))
 
 
 if __name__ == '__main__':
 
+	oh.OntoHelper.default_query_cache = True
 	genepio = Ontology()
 	genepio.__main__()  
 
@@ -25,10 +25,17 @@
 """
 
 import os
+import re
 import json
 import sys
-import rdflib
-from rdflib.plugins.sparql import prepareQuery
+import hashlib
+import pickle
+import types
+import tempfile
+import importlib
+import glob
+import time
+import stat
 
 # Do this, otherwise a warning appears on stdout: No handlers could be 
 #found for logger "rdflib.term"
@@ -39,19 +46,419 @@ try: #Python 2.7
 except ImportError: # Python 2.6
 	from ordereddict import OrderedDict
 
+try: #Python 3
+	from urllib.request import urlopen, Request
+except ImportError: # Python 2
+	from urllib2 import urlopen, Request
+
 def stop_err(msg, exit_code = 1):
 	sys.stderr.write("%s\n" % msg)
 	sys.exit(exit_code)
 
 
+def get_lazy_module(name):
+	"""
+	Returns named module, registered in sys.modules but only actually
+	imported when one of its attributes is first used.  Later plain
+	"import name" statements get the same lazy module.
+	"""
+	if name in sys.modules:
+		return sys.modules[name]
+	try:
+		import importlib.util
+		spec = importlib.util.find_spec(name)
+		loader = importlib.util.LazyLoader(spec.loader)
+	except (ImportError, AttributeError, ValueError): # Python 2
+		return importlib.import_module(name)
+
+	spec.loader = loader
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	loader.exec_module(module)
+	return module
+
+
+# rdflib takes a good part of a second to import, which runs that never
+# touch a graph (--version, cached rule sets) shouldn't pay for.
+rdflib = get_lazy_module('rdflib')
+
+
+class URIRefConstant(object):
+	"""
+	Class attribute holding an rdflib URIRef, or list of them, for given 
+	URI(s), only made when first read so that declaring it doesn't import
+	rdflib.
+	"""
+	def __init__(self, uri):
+		self.uri = uri
+		self.value = None
+
+	def __get__(self, instance, owner):
+		if self.value is None:
+			if isinstance(self.uri, list):
+				self.value = [rdflib.term.URIRef(uri) for uri in self.uri]
+			else:
+				self.value = rdflib.term.URIRef(self.uri)
+		return self.value
+
+
+def get_algebra_reduction(node):
+	"""
+	Pickle reduction of a SPARQL algebra CompValue or Expr node; their
+	attribute lookup returns None for anything missing, which defeats 
+	pickle's default handling.  An Expr's bound evaluation method is 
+	pickled as its function.
+	"""
+	attrs = dict(vars(node))
+	evalfn = attrs.get('_evalfn')
+	if evalfn is not None:
+		if node is get_true_filter():
+			return (get_true_filter, ())
+		attrs['_evalfn'] = evalfn.__func__
+	return (get_algebra_node, (type(node), attrs, list(OrderedDict.items(node))))
+
+
+def get_algebra_node(node_class, attrs, items):
+
+	node = node_class.__new__(node_class)
+	OrderedDict.__init__(node)
+	OrderedDict.update(node, items)
+	node.__dict__.update(attrs)
+	if attrs.get('_evalfn') is not None:
+		node._evalfn = types.MethodType(attrs['_evalfn'], node)
+	return node
+
+
+def get_true_filter():
+	# Shared OPTIONAL {} filter whose evaluation function is a lambda.
+	from rdflib.plugins.sparql import operators
+	return operators.TrueFilter
+
+
+class QueryRegistry(object):
+	"""
+	Named SPARQL queries, each compiled by rdflib prepareQuery() only when
+	first used, so runs that use few or none of them don't compile the 
+	rest.  Used like the dictionary of prepared queries it replaces:
+
+		self.queries = oh.QueryRegistry({'tree': 'SELECT ...'}, namespace)
+		self.onto_helper.do_query_table(self.queries['tree'], bindings)
+
+	Compiled query algebra is also saved in cache_folder, keyed by a hash 
+	of query text, namespaces and rdflib version, so that later runs load
+	it rather than parse the query again.  Saving is best effort; a query 
+	that can't be pickled is just compiled each run.
+	"""
+
+	def __init__(self, queries, namespace, cache_folder = None):
+
+		self.sources = OrderedDict(queries)
+		self.namespace = namespace
+		self.cache_folder = cache_folder
+		self.compiled = {}
+
+
+	def __getitem__(self, name):
+
+		query = self.compiled.get(name)
+		if query is None:
+			query = self.get_compiled_query(self.sources[name])
+			self.compiled[name] = query
+		return query
+
+
+	def __contains__(self, name):
+		return name in self.sources
+
+
+	def __iter__(self):
+		return iter(self.sources)
+
+
+	def __len__(self):
+		return len(self.sources)
+
+
+	def keys(self):
+		return self.sources.keys()
+
+
+	def items(self):
+		return [(name, self[name]) for name in self.sources]
+
+
+	def get_cache_path(self, source):
+
+		key = hashlib.sha256()
+		key.update(source.encode('utf-8'))
+		for prefix in sorted(self.namespace):
+			key.update(('\n%s %s' % (prefix, self.namespace[prefix])).encode('utf-8'))
+		key.update(rdflib.__version__.encode('utf-8'))
+		return os.path.join(self.cache_folder, key.hexdigest() + '.pickle')
+
+
+	def get_compiled_query(self, source):
+		"""
+		Returns rdflib Query for given SPARQL text, from cache_folder if 
+		saved there, otherwise compiled and then saved.
+		"""
+		from rdflib.plugins.sparql import prepareQuery
+
+		if not self.cache_folder:
+			return prepareQuery(source, initNs = self.namespace)
+
+		cache_path = self.get_cache_path(source)
+		try:
+			with open(cache_path, 'rb') as handle:
+				return self.get_query(pickle.load(handle))
+		except Exception:
+			# Missing, unreadable or written by other code: recompile.
+			pass
+
+		query = prepareQuery(source, initNs = self.namespace)
+		self.save_query(cache_path, query)
+		return query
+
+
+	def get_query(self, algebra):
+		"""
+		Rebuilds a prepared query around given algebra, with prologue (the 
+		prefixes and base it was compiled with) as prepareQuery() makes it.
+		"""
+		from rdflib.plugins.sparql.sparql import Query, Prologue
+
+		prologue = Prologue()
+		for (prefix, uri) in self.namespace.items():
+			prologue.bind(prefix, uri)
+		return Query(prologue, algebra)
+
+
+	def save_query(self, cache_path, query):
+
+		from rdflib.plugins.sparql.parserutils import CompValue, Expr
+		import copyreg
+
+		class AlgebraPickler(pickle.Pickler):
+			dispatch_table = copyreg.dispatch_table.copy()
+			dispatch_table[CompValue] = get_algebra_reduction
+			dispatch_table[Expr] = get_algebra_reduction
+
+		temp_path = None
+		try:
+			if not os.path.isdir(self.cache_folder):
+				os.makedirs(self.cache_folder, 0o700)
+			(handle, temp_path) = tempfile.mkstemp(dir = self.cache_folder, suffix = '.tmp')
+			with os.fdopen(handle, 'wb') as output:
+				AlgebraPickler(output, pickle.HIGHEST_PROTOCOL).dump(query.algebra)
+			os.rename(temp_path, cache_path)
+		except Exception:
+			# Unpicklable algebra (e.g. other lambda filters) or unwritable
+			# folder: the query just gets compiled on each run.
+			if temp_path is not None and os.path.isfile(temp_path):
+				os.remove(temp_path)
+
+
+class ProgressReporter(object):
+	"""
+	Throttled progress events of a long run's stages (e.g. "parse", 
+	"imports", "tree", "terms", "output"), so that a slow run can be told
+	from a stalled one.  Each event has the time, stage, event ("start",
+	"progress" or "end"), items done and total (if known), elapsed
+	seconds, rate (items per second) and ETA seconds, and optionally a 
+	detail such as the root term or file a stage is working on.  Events
+	are written as a line of text to stream (e.g. sys.stderr) and/or as
+	JSON lines to file_path; "start" and "end" always, "progress" at most
+	once per interval seconds.  With neither stream nor file_path it does
+	nothing, so callers needn't check whether progress is wanted.
+
+		progress = oh.ProgressReporter(sys.stderr, 'genepio.progress.jsonl')
+		progress.start('terms', len(terms))
+		for term in terms:
+			...
+			progress.step()
+		progress.end()
+
+	step() is cheap enough for a per term loop: it only counts until the
+	number of items that the rate so far says will take a tenth of 
+	interval has gone by, and only then reads the clock.
+	"""
+
+	# Clock reads per interval by step().
+	CHECKS = 10
+
+	def __init__(self, stream = None, file_path = None, interval = 1.0):
+
+		self.stream = stream
+		self.output_handle = open(file_path, 'w') if file_path else None
+		self.interval = interval
+		self.stage = None
+		self.detail = None
+		self.done = 0
+		self.total = None
+		# perf_counter() of stage start, and of last event written.
+		self.started = None
+		self.emitted = None
+		# Value of self.done at which step() next reads the clock; never
+		# when there is nowhere to write events to.
+		self.next_check = float('inf')
+
+
+	def is_enabled(self):
+
+		return self.stream is not None or self.output_handle is not None
+
+
+	def start(self, stage, total = None, detail = None):
+		"""
+		Starts given stage of total items (None if not known), ending any
+		stage still going.
+		"""
+		self.end()
+		(self.stage, self.total, self.detail, self.done) = (stage, total, detail, 0)
+		if self.is_enabled():
+			self.started = self.emitted = time.perf_counter()
+			self.next_check = 1
+			self.do_event('start', self.started)
+
+
+	def step(self, count = 1):
+		"""
+		Adds given number of items to those done in current stage.
+		"""
+		self.done += count
+		if self.done >= self.next_check:
+			now = time.perf_counter()
+			# The last item's event would just precede the "end" one.
+			if now - self.emitted >= self.interval and self.done != self.total:
+				self.emitted = now
+				self.do_event('progress', now)
+			rate = self.done / (now - self.started) if now > self.started else 0
+			self.next_check = self.done + max(1, int(rate * self.interval / self.CHECKS))
+
+
+	def end(self):
+		"""
+		Ends current stage, if any.
+		"""
+		if self.stage is not None and self.is_enabled():
+			self.do_event('end', time.perf_counter())
+		self.stage = None
+		self.next_check = float('inf')
+
+
+	def close(self):
+
+		self.end()
+		if self.output_handle is not None:
+			self.output_handle.close()
+			self.output_handle = None
+
+
+	def get_event(self, event, now):
+
+		elapsed = now - self.started
+		rate = self.done / elapsed if self.done and elapsed > 0 else None
+		record = OrderedDict()
+		record['time'] = round(time.time(), 3)
+		record['stage'] = self.stage
+		record['event'] = event
+		record['done'] = self.done
+		record['total'] = self.total
+		record['elapsed_seconds'] = round(elapsed, 3)
+		record['rate'] = round(rate, 1) if rate else None
+		record['eta_seconds'] = round(max(0, self.total - self.done) / rate, 1) if rate and self.total is not None else None
+		if self.detail is not None:
+			record['detail'] = self.detail
+		return record
+
+
+	def get_event_text(self, record):
+
+		text = 'Progress: ' + record['stage'] + (' ' + record['detail'] if 'detail' in record else '') + ': '
+		if record['event'] == 'start':
+			return text + 'started' + (', %d to do' % record['total'] if record['total'] is not None else '')
+
+		text += str(record['done']) + ('/%d (%d%%)' % (record['total'], 100 * record['done'] // record['total']) if record['total'] else '')
+		if record['event'] == 'end':
+			text += ' done in %ss' % record['elapsed_seconds']
+		if record['rate']:
+			text += ', %s/s' % record['rate']
+		if record['event'] == 'progress' and record['eta_seconds'] is not None:
+			text += ', ETA %ss' % record['eta_seconds']
+		return text
+
+
+	def do_event(self, event, now):
+
+		record = self.get_event(event, now)
+		if self.output_handle is not None:
+			self.output_handle.write(json.dumps(record) + '\n')
+			self.output_handle.flush()
+		if self.stream is not None:
+			self.stream.write(self.get_event_text(record) + '\n')
+			self.stream.flush()
+
+
 class OntoHelper(object):
 
 	CODE_VERSION = '0.0.4'
 	SYNONYM_FIELDS = ['oboInOwl_hasSynonym','oboInOwl_hasBroadSynonym','oboInOwl_hasExactSynonym','oboInOwl_hasNarrowSynonym','IAO_0000118']
+	# Query result cache limit, in result rows; bigger results aren't cached.
+	QUERY_CACHE_ROWS = 200000
+	# Whether compiled queries are saved in ~/.cache/ontofetch/queries when
+	# the ONTOFETCH_QUERY_CACHE environment variable isn't set.  Command
+	# line scripts turn it on; library use only saves them where asked.
+	default_query_cache = False
+	STRING_DATATYPE = URIRefConstant('http://www.w3.org/2001/XMLSchema#string')
+	# Ways get_shards() can split specifications; see do_output_shards().
+	SHARD_MODES = ['branch', 'prefix', 'size']
+	# Specifications fields holding term ids (or lists of them), which
+	# get_compact_struct() stores as prefix table index and local part.
+	ID_FIELDS = ['id', 'parent_id', 'other_parents', 'replaced_by']
+	COMPACT_FORMAT = 'ontofetch-compact/1'
 
 	def __init__(self):
 
-		self.graph = rdflib.Graph()
+		# Graph made on first use of self.graph; see graph property.
+		self._graph = None
+		# SQLite file of a disk-backed graph, if open_graph_store() is used.
+		self.graph_store_path = None
+		# BNode -> owl:unionOf disjunction item ids, for self.graph as of
+		# its version self.disjunction_version.  See get_disjunctions().
+		self.disjunctions = {}
+		self.list_index = None
+		self.disjunction_version = None
+		# (query, bindings) -> (column names, result rows) in least to most
+		# recently used order, for self.graph as of self.query_cache_version.
+		# See get_query_result().
+		self.query_cache = OrderedDict()
+		self.query_cache_version = None
+		self.query_cache_rows = 0
+		self.query_stats = OrderedDict([('hits', 0), ('misses', 0), ('evictions', 0), ('invalidations', 0)])
+		# Queries whose results depend only on triples with the term bound
+		# to them as subject (and a URI or literal object), so that their
+		# cached results survive set_graph_changed() about other terms.
+		self.local_queries = set()
+		# Source file path -> modification time, of named graphs loaded by
+		# do_ontology_load_sources().
+		self.graph_sources = OrderedDict()
+
+		# Whether log() prints progress messages; not for library use.
+		self.verbose = True
+		# Stage progress events of loading and term fetching; none unless
+		# replaced by one with somewhere to write them.
+		self.progress = ProgressReporter()
+		# Limits on parallel downloads, and tries after a failed one, when
+		# loading an ontology by URL.  See do_ontology_load().
+		self.fetch_concurrency = 4
+		self.fetch_retries = 2
+		# Ontology URL -> get_ontology_hash() of it, and -> main file content
+		# it downloaded, which ontoload.OntologyLoader takes rather than
+		# downloading the file again.
+		self.ontology_hashes = {}
+		self.ontology_downloads = {}
+		# Folder compiled queries are saved in, if any.
+		self.query_cache_folder = self.get_safe_folder(self.get_default_query_cache_folder())
 
 		self.struct = OrderedDict()
 		"""
@@ -86,22 +493,23 @@ class OntoHelper(object):
 		# Namespace is for rdflib sparql querries
 		# FUTURE: DEPRECATE?.  QUERY ENGINE SHOULD USE @CONTEXT.
 		self.namespace = { 
-			'owl': rdflib.URIRef('http://www.w3.org/2002/07/owl#'),
-			'rdfs': rdflib.URIRef('http://www.w3.org/2000/01/rdf-schema#'),
-			'rdf':	rdflib.URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#'),
-			'xmls': rdflib.URIRef('http://www.w3.org/2001/XMLSchema#'),
-			'dc': rdflib.URIRef('http://purl.org/dc/elements/1.1/'),
-			'terms': rdflib.URIRef('http://purl.org/dc/terms/'),
-			'oboInOwl': rdflib.URIRef('http://www.geneontology.org/formats/oboInOwl#'),
-			'OBO': rdflib.URIRef('http://purl.obolibrary.org/obo/'), # shortcut for all OBOFoundry purls
-			'IAO':	rdflib.URIRef('http://purl.obolibrary.org/obo/IAO_'),
-			'GENEPIO':rdflib.URIRef('http://purl.obolibrary.org/obo/GENEPIO_'), # Still needed for a few GEEM relations
-			'RO':	rdflib.URIRef('http://purl.obolibrary.org/obo/RO_'),
-			'OBI':	rdflib.URIRef('http://purl.obolibrary.org/obo/OBI_'),
-			'AGENCY': rdflib.URIRef('http://genepio.org/ontology/lexmapr/')
+			'owl': 'http://www.w3.org/2002/07/owl#',
+			'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+			'rdf':	'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+			'xmls': 'http://www.w3.org/2001/XMLSchema#',
+			'xsd': 'http://www.w3.org/2001/XMLSchema#',
+			'dc': 'http://purl.org/dc/elements/1.1/',
+			'terms': 'http://purl.org/dc/terms/',
+			'oboInOwl': 'http://www.geneontology.org/formats/oboInOwl#',
+			'OBO': 'http://purl.obolibrary.org/obo/', # shortcut for all OBOFoundry purls
+			'IAO':	'http://purl.obolibrary.org/obo/IAO_',
+			'GENEPIO':'http://purl.obolibrary.org/obo/GENEPIO_', # Still needed for a few GEEM relations
+			'RO':	'http://purl.obolibrary.org/obo/RO_',
+			'OBI':	'http://purl.obolibrary.org/obo/OBI_',
+			'AGENCY': 'http://genepio.org/ontology/lexmapr/'
 		}
 
-		self.queries = {
+		self.queries = QueryRegistry({
 
 			##################################################################
 			# Fetch ontology metadata fields
@@ -115,7 +523,7 @@ class OntoHelper(object):
 		    #		<dc:license rdf:resource="http://creativecommons.org/licenses/by/3.0/"/>
 		    #		<dc:date rdf:datatype="http://www.w3.org/2001/XMLSchema#date">2018-02-28</dc:date>
 
-			'ontology_metadata': prepareQuery("""
+			'ontology_metadata': """
 			SELECT DISTINCT ?resource ?title ?description ?versionIRI ?prefix ?license ?date 
 			WHERE {
 				?resource rdf:type owl:Ontology.
@@ -126,7 +534,7 @@ class OntoHelper(object):
 				OPTIONAL {?resource (dc:license|terms:license) ?license.}
 				OPTIONAL {?resource (dc:date|terms:date) ?date.}
 			}
-			""", initNs = self.namespace),
+			""",
 
 			# ################################################################
 			# Terms are augmented with synonyms in order for type-as-you-go inputs
@@ -137,7 +545,7 @@ class OntoHelper(object):
 			# OUTPUT
 			#   ?Synonym ?ExactSynonym ?NarrowSynonym
 			#
-			'entity_synonyms': prepareQuery("""
+			'entity_synonyms': """
 
 				SELECT DISTINCT ?datum 
 					?oboInOwl_hasSynonym 
@@ -153,16 +561,78 @@ class OntoHelper(object):
 					UNION {?datum oboInOwl:hasNarrowSynonym ?oboInOwl_hasNarrowSynonym.}
 					UNION {?datum IAO:0000118 ?IAO_0000118.}
 				}
-			""", initNs = self.namespace),
+			""",
 			
-		}
+		}, self.namespace, self.get_query_cache_folder())
 
 	def __main__(self):
 		pass
 
 
+	@property
+	def graph(self):
+		"""
+		The rdflib graph, an in-memory one made (and rdflib imported) only
+		when first needed unless open_graph_store() set a disk-backed one.
+		"""
+		if self._graph is None:
+			import ontostore
+			self._graph = ontostore.VersionedGraph()
+		return self._graph
+
+
+	@graph.setter
+	def graph(self, graph):
+		self._graph = graph
+
+
+	def get_query_cache_folder(self):
+		"""
+		Folder QueryRegistry saves compiled queries in, or None: see
+		get_default_query_cache_folder() and get_safe_folder().
+		"""
+		return self.query_cache_folder
+
+
+	def get_default_query_cache_folder(self):
+		"""
+		The ONTOFETCH_QUERY_CACHE environment variable if set (empty to not
+		save compiled queries), otherwise ~/.cache/ontofetch/queries if 
+		default_query_cache is on.
+		"""
+		folder = os.environ.get('ONTOFETCH_QUERY_CACHE')
+		if folder is None and self.default_query_cache:
+			folder = os.path.join(os.path.expanduser('~'), '.cache', 'ontofetch', 'queries')
+		return folder or None
+
+
+	def get_safe_folder(self, folder):
+		"""
+		Returns given cache folder, or None if it exists but belongs to 
+		another user or can be written by others, since pickled queries
+		loaded from it could run any code they were written with.  A new
+		folder is made readable by its user only.
+		"""
+		if folder is None or not os.path.isdir(folder) or not hasattr(os, 'getuid'):
+			return folder
+
+		status = os.stat(folder)
+		if status.st_uid != os.getuid() or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+			self.log('WARNING: not using query cache folder ' + folder + ', as other users can write to it.')
+			return None
+		return folder
+
+
 	############################## UTILITIES ###########################
 
+	def log(self, *args):
+		"""
+		Prints progress or warning message, unless self.verbose is off.
+		"""
+		if self.verbose:
+			print (' '.join(str(arg) for arg in args))
+
+
 	def get_bindings(self, myDict):
 		obj = {}
 		for entity in myDict:
@@ -307,15 +777,183 @@ class OntoHelper(object):
 
 
 	def reorder(self, entity, part, orderedKeys = None):
-			""" Order given entity part dictionary by given order array of ids, or alphabetically if none.
+			""" Order given entity part dictionary by given order array of ids, or alphabetically (by ui_label, or label if none) if none.
+				Items not in orderedKeys keep their relative order after those that are.
 				# components, models, choices are all orderedDict already.
 			"""
 			if part in entity:
 				if orderedKeys:
 					# Each entity[part] item is given a rank by the index location of its id in given orderedKeys list
-					entity[part] = OrderedDict(sorted(entity[part].items(), key=lambda item: orderedKeys.index(item[0]) if item[0] in orderedKeys else False))
+					ranks = dict((key, ptr) for (ptr, key) in reversed(list(enumerate(orderedKeys))))
+					entity[part] = OrderedDict(sorted(entity[part].items(), key=lambda item: ranks.get(item[0], len(ranks))))
 				else:
-					entity[part] = OrderedDict(sorted(entity[part].items(), key=attrgetter('ui_label')) )
+					entity[part] = OrderedDict(sorted(entity[part].items(), key=lambda item: item[1].get('ui_label') or item[1].get('label') or ''))
+
+
+	def get_hierarchy_order(self, rows, id_position, parent_position, label_position, ui_label_predicate = None):
+		"""
+		Returns given query result rows in parent grouped order, as a SPARQL
+		ORDER BY ?parent_id ?ui_label ?label would give them (a term with 
+		several ui labels being placed by its first), but sorted here at 
+		far less cost than in rdflib: each column's distinct values are
+		ranked once (see get_rank_map()), and rows sorted on their ranks.
+		The sort is stable, so ties keep their query result order.
+
+		INPUT
+			rows: query result rows (sequences of rdflib terms, None where unbound)
+			id_position, parent_position, label_position: row positions of term id, parent id and label
+			ui_label_predicate: optional annotation property URIRef of terms' ui labels
+		"""
+		ui_labels = {}
+		if ui_label_predicate is not None:
+			ids = set(row[id_position] for row in rows)
+			candidates = {}
+			for (term, ui_label) in self.graph.subject_objects(ui_label_predicate):
+				if term in ids:
+					candidates.setdefault(term, []).append(ui_label)
+			ui_label_ranks = self.get_rank_map(ui_label for values in candidates.values() for ui_label in values)
+			for (term, values) in candidates.items():
+				ui_labels[term] = min(ui_label_ranks[ui_label] for ui_label in values)
+
+		parent_ranks = self.get_rank_map(row[parent_position] for row in rows)
+		label_ranks = self.get_rank_map(row[label_position] for row in rows)
+
+		return sorted(rows, key = lambda row: (parent_ranks[row[parent_position]], ui_labels.get(row[id_position], -1), label_ranks[row[label_position]]))
+
+
+	def get_rank_map(self, terms):
+		"""
+		Returns dictionary of the rank of each of given rdflib terms in 
+		SPARQL ORDER BY order, terms that sort as equal sharing a rank, and
+		None (unbound) ranking -1, before all terms.
+		"""
+		from rdflib.plugins.sparql.evalutils import _val
+
+		terms = set(terms) - set([None])
+		# rdflib compares literals by rather slow rich comparison; URIs and
+		# string literals (the usual case) have an equivalent plain key.
+		keys = dict((term, self.get_order_key(term)) for term in terms)
+		if None in keys.values():
+			keys = dict((term, _val(term)) for term in terms)
+
+		ranks = {None: -1}
+		rank = -1
+		previous = None
+		for term in sorted(terms, key = keys.get):
+			key = keys[term]
+			if previous is None or previous < key:
+				rank += 1
+			ranks[term] = rank
+			previous = key
+		return ranks
+
+
+	def get_order_key(self, term):
+		"""
+		Key that sorts a URIRef or plain or xsd:string literal as SPARQL
+		ORDER BY does, i.e. as rdflib's term comparison: URIs before 
+		literals, literals without a language tag before those with one, 
+		then by language and text (a plain and an xsd:string literal of the
+		same text being equal).  None for other terms.
+		"""
+		termType = type(term)
+		if termType is rdflib.term.URIRef:
+			return (2, False, '', str(term))
+		if termType is rdflib.term.Literal and (term.datatype is None or term.datatype == self.STRING_DATATYPE):
+			return (3, term.language is not None, term.language or '', str(term))
+		return None
+
+
+	def set_slim_graph(self, root_uris, predicates = ()):
+		"""
+		Replaces self.graph, once loaded, with an in-memory graph of just
+		what queries about terms under given root URIs need, so that they
+		and memory use scale with the size of those branches rather than 
+		of the whole ontology and its imports.  Kept are triples whose 
+		subject is:
+			a root or a term under one by rdfs:subClassOf*;
+			an owl:Ontology (for metadata);
+			an owl:Axiom annotating one of those terms;
+			a blank node (restriction, list, etc.) in an object of a kept
+			triple, recursively.
+		Triples of given predicates are kept whatever their subject, e.g.
+		for deprecation lookups across the whole ontology.  Returns 
+		(number of terms, number of triples) kept.
+		"""
+		import ontostore
+
+		graph = self.graph
+		terms = set()
+		for root_uri in root_uris:
+			terms.update(graph.transitive_subjects(rdflib.RDFS.subClassOf, rdflib.URIRef(root_uri)))
+
+		subjects = set(terms)
+		subjects.update(graph.subjects(rdflib.RDF.type, rdflib.OWL.Ontology))
+		for (axiom, source) in graph.subject_objects(rdflib.OWL.annotatedSource):
+			if source in terms:
+				subjects.add(axiom)
+
+		slim = ontostore.VersionedGraph()
+		for (prefix, uri) in graph.namespaces():
+			slim.bind(prefix, uri, override = True)
+
+		pending = list(subjects)
+		while pending:
+			subject = pending.pop()
+			for (predicate, obj) in graph.predicate_objects(subject):
+				slim.add((subject, predicate, obj))
+				if isinstance(obj, rdflib.BNode) and not obj in subjects:
+					subjects.add(obj)
+					pending.append(obj)
+
+		for predicate in predicates:
+			for triple in graph.triples((None, predicate, None)):
+				slim.add(triple)
+
+		self.graph = slim
+		return (len(terms), len(slim))
+
+
+	def open_graph_store(self, store_path):
+		"""
+		Replaces in-memory self.graph with one kept in given SQLite file (see
+		ontostore.SQLiteStore), for ontologies too large to hold in memory.
+		"""
+		import ontostore
+
+		self.graph = ontostore.VersionedGraph(store = ontostore.SQLiteStore())
+		self.graph.open(store_path, create = True)
+		self.graph_store_path = store_path
+
+
+	def is_graph_stored(self, main_ontology_file):
+		"""
+		True if graph store already holds given ontology, with imports, as
+		loaded by an earlier run.  Otherwise the store is emptied, ready for
+		loading, and False returned.
+		"""
+		if self.graph_store_path is None:
+			return False
+
+		store = self.graph.store
+		if store.get_metadata('ontology_hash') == self.get_ontology_hash(main_ontology_file):
+			self.ontology_downloads.pop(main_ontology_file, None)
+			return True
+
+		store.clear()
+		store.set_metadata('ontology_hash', None)
+		self.graph.set_changed()
+		return False
+
+
+	def save_graph_store(self, main_ontology_file):
+		"""
+		Commits loaded ontology to graph store, recording which ontology it
+		holds for is_graph_stored().
+		"""
+		if self.graph_store_path is not None:
+			self.graph.store.set_metadata('ontology_hash', self.get_ontology_hash(main_ontology_file))
+			self.graph.store.commit()
 
 
 	def do_ontology_includes(self, main_ontology_file):
@@ -328,40 +966,336 @@ class OntoHelper(object):
 		INPUT
 
 		"""
-		imports = self.graph.query("""
-			SELECT distinct ?import_file
-			WHERE {?s owl:imports ?import_file.}
-			ORDER BY (?import_file)
-		""")		
+		imports = self.get_ontology_imports()
 
-		print ("It has %s import files ..." % len(imports))
+		self.log("It has %s import files ..." % len(imports))
+		self.progress.start('imports', len(imports))
 
-		for result_row in imports:
+		for import_file in imports:
 
-			import_file = result_row.import_file
-			print (import_file)
+			self.log(import_file)
 			# If main file supplied as a URI, then process imports likewise
 			if main_ontology_file[0:4] == 'http':
 				try:
-					self.graph.parse(import_file, format='xml')	
+					self.graph.parse(import_file, format='xml')
 				#except rdflib.exceptions.ParserError as e:
 				except Exception as e:
-					print ('WARNING:' + import_file + " could not be loaded!\n", e)		
+					self.log('WARNING:' + import_file + " could not be loaded!\n", e)		
 
 			# Ontology given as file path, so only check its ./imports/ folder
 			# since, as a local resource, its imports should be local too.
 			else:
 
-				file_path = os.path.dirname(main_ontology_file) + '/imports/' + import_file.rsplit('/',1)[1]
+				file_path = self.get_import_file_path(main_ontology_file, import_file)
 
 				try:
 					if os.path.isfile( file_path):
-						self.graph.parse(file_path)	
+						self.graph.parse(file_path)
 					else:
-						print ('WARNING:' + file_path + " could not be loaded!  Does its ontology include purl have a corresponding local file? \n")
+						self.log('WARNING:' + file_path + " could not be loaded!  Does its ontology include purl have a corresponding local file? \n")
 
 				except rdflib.exceptions.ParserError as e:
-					print (file_path + " needs to be in RDF OWL format!")			
+					self.log(file_path + " needs to be in RDF OWL format!")			
+
+			self.progress.step()
+
+		self.progress.end()
+
+
+	def get_ontology_imports(self):
+		"""
+		Returns sorted list of owl:imports IRIs (URIRefs) declared in graph.
+		"""
+		imports = self.graph.query("""
+			SELECT distinct ?import_file
+			WHERE {?s owl:imports ?import_file.}
+			ORDER BY (?import_file)
+		""")
+		return [result_row.import_file for result_row in imports]
+
+
+	def do_ontology_load(self, main_ontology_file):
+		"""
+		Parses main ontology file and its imports into graph.  One given by
+		URL is downloaded, with its imports, by ontoload.OntologyLoader, 
+		overlapping downloads with parsing; self.fetch_concurrency and 
+		self.fetch_retries set its limits.  Errors loading the main file 
+		are raised.
+		"""
+		if main_ontology_file[0:4].lower() == 'http':
+			import ontoload
+
+			loader = ontoload.OntologyLoader(self, self.fetch_concurrency, self.fetch_retries)
+			loader.load(main_ontology_file)
+			self.log('Downloads: ' + json.dumps(loader.get_stats()))
+
+		else:
+			# ISSUE: ontology file taken in as ascii; rdflib doesn't accept
+			# utf-8 characters so can experience conversion issues in string
+			# conversion stuff like .replace() below
+			self.progress.start('parse', 1, main_ontology_file)
+			self.graph.parse(main_ontology_file, format='xml')
+			self.progress.step()
+			self.progress.end()
+
+			# Add each ontology include file (must be in OWL RDF format)
+			self.do_ontology_includes(main_ontology_file)
+
+
+	def do_ontology_load_sources(self, main_ontology_file):
+		"""
+		As do_ontology_load() for an ontology given as a file path, but 
+		self.graph becomes a dataset in which the main file and each of its
+		./imports/ files is parsed into a named graph of its own, so that 
+		reload_source() can parse one of them again without the others.
+		"""
+		import ontostore
+
+		self.graph = ontostore.VersionedConjunctiveGraph()
+		self.graph_sources = OrderedDict()
+		self.progress.start('parse', 1, main_ontology_file)
+		self.get_source_graph(main_ontology_file).parse(main_ontology_file, format = 'xml')
+		self.graph_sources[main_ontology_file] = os.path.getmtime(main_ontology_file)
+		self.progress.step()
+		self.set_import_sources(main_ontology_file)
+		self.graph.set_changed()
+
+
+	def get_source_graph(self, file_path):
+		"""
+		Named graph of given source file in self.graph dataset.
+		"""
+		return self.graph.get_context(rdflib.URIRef('file://' + os.path.abspath(file_path)))
+
+
+	def get_source_triples(self, graph):
+		"""
+		Returns set of (subject, predicate, object) triples of given graph 
+		with no blank nodes.  Blank nodes get new ids each time a file is
+		parsed, so triples with them can't be compared between parses.
+		"""
+		return set(triple for triple in graph if not isinstance(triple[0], rdflib.BNode) and not isinstance(triple[2], rdflib.BNode))
+
+
+	def set_import_sources(self, main_ontology_file):
+		"""
+		Brings the named graphs of import files in line with the main file's
+		owl:imports, as do_ontology_includes() loads them: new imports are
+		parsed, and dropped ones removed.  Returns set of triples added or
+		removed (without blank nodes; see get_source_triples()).
+		"""
+		import_paths = []
+		for import_file in self.get_ontology_imports():
+			file_path = self.get_import_file_path(main_ontology_file, import_file)
+			if os.path.isfile(file_path):
+				import_paths.append(file_path)
+			else:
+				self.log('WARNING:' + file_path + " could not be loaded!  Does its ontology include purl have a corresponding local file? \n")
+
+		triples = set()
+		self.progress.start('imports', len([file_path for file_path in import_paths if not file_path in self.graph_sources]))
+		for file_path in list(self.graph_sources)[1:]:
+			if not file_path in import_paths:
+				self.log('Removing ' + file_path)
+				graph = self.get_source_graph(file_path)
+				triples |= self.get_source_triples(graph)
+				self.graph.remove_context(graph)
+				del self.graph_sources[file_path]
+
+		for file_path in import_paths:
+			if not file_path in self.graph_sources:
+				self.log(file_path)
+				try:
+					graph = self.get_source_graph(file_path)
+					graph.parse(file_path)
+					triples |= self.get_source_triples(graph)
+					self.graph_sources[file_path] = os.path.getmtime(file_path)
+				except rdflib.exceptions.ParserError as e:
+					self.log(file_path + " needs to be in RDF OWL format!")
+				self.progress.step()
+
+		self.progress.end()
+		return triples
+
+
+	def get_changed_sources(self):
+		"""
+		Source files loaded by do_ontology_load_sources() that have been 
+		modified since they were parsed.
+		"""
+		return [file_path for (file_path, mtime) in self.graph_sources.items() if os.path.isfile(file_path) and os.path.getmtime(file_path) != mtime]
+
+
+	def reload_source(self, file_path):
+		"""
+		Parses given source file again, replacing its named graph, and 
+		returns set of triples added or removed (apart from triples with
+		blank nodes, which are replaced anyway).  If it can't
+		be parsed, e.g. as it is only partly saved, the exception is raised 
+		and the graph kept as it was.  Call set_graph_changed() after.
+		"""
+		mtime = os.path.getmtime(file_path)
+		parsed = rdflib.Graph()
+		try:
+			parsed.parse(file_path, format = 'xml' if file_path == list(self.graph_sources)[0] else None)
+		finally:
+			# Not tried again until it is saved again.
+			self.graph_sources[file_path] = mtime
+
+		graph = self.get_source_graph(file_path)
+		old_triples = self.get_source_triples(graph)
+		self.graph.remove_context(graph)
+		graph = self.get_source_graph(file_path)
+		# Added to the named graph directly, so self.graph's version (and
+		# query cache) stays for set_graph_changed() to deal with.
+		graph.addN((subject, predicate, obj, graph) for (subject, predicate, obj) in parsed)
+
+		return old_triples ^ self.get_source_triples(parsed)
+
+
+	def set_graph_changed(self, subjects):
+		"""
+		Records a change to self.graph of triples about given subjects, 
+		made otherwise than through self.graph's own add() and remove(),
+		e.g. by reload_source().  Cached results of self.local_queries not
+		bound to one of the subjects stay; other cached results are dropped.
+		"""
+		current = self.query_cache_version == self.graph.version
+		self.graph.set_changed()
+		if not current:
+			return
+
+		kept = OrderedDict()
+		for (key, cached) in self.query_cache.items():
+			(query, bindings) = key
+			if query in self.local_queries and not any(value in subjects for (name, value) in bindings):
+				kept[key] = cached
+
+		if len(kept) < len(self.query_cache):
+			self.query_stats['invalidations'] += 1
+		self.query_cache = kept
+		self.query_cache_rows = sum(len(cached[1]) for cached in kept.values())
+		self.query_cache_version = self.graph.version
+
+
+	def get_import_file_path(self, main_ontology_file, import_file):
+		"""
+		Local ./imports/ folder location of an owl:imports file for an 
+		ontology given as a file path.
+		"""
+		return os.path.dirname(main_ontology_file) + '/imports/' + import_file.rsplit('/',1)[1]
+
+
+	def get_ontology_hash(self, main_ontology_file):
+		"""
+		Returns a sha256 hex digest of the main ontology file content plus
+		that of each import file do_ontology_includes() (or, for a URL, 
+		ontoload.OntologyLoader) would load for it, so that any change to 
+		them gives a new hash.  Imports are the owl:imports objects of the
+		parsed main file, as get_ontology_imports() finds them; see 
+		get_declared_imports().
+
+		A local ontology's imports are read from its ./imports/ folder; a
+		missing one contributes just its IRI.  For an ontology given by URL,
+		each import's ETag and Last-Modified response headers are used if 
+		its server gives either, and otherwise its content is fetched.  An
+		import that can't be fetched contributes just its IRI.  The main
+		file is downloaded once per OntoHelper; its content is kept for
+		do_ontology_load(), and the hash for later calls.
+
+		INPUT
+			main_ontology_file: file path or URL, as returned by check_ont_file()
+		OUTPUT
+			:string hex digest
+		"""
+		digest = hashlib.sha256()
+		remote = main_ontology_file[0:4] == 'http'
+
+		if remote:
+			if main_ontology_file in self.ontology_hashes:
+				return self.ontology_hashes[main_ontology_file]
+			content = urlopen(main_ontology_file, timeout = 60).read()
+			self.ontology_downloads[main_ontology_file] = content
+		else:
+			with open(main_ontology_file, 'rb') as input_handle:
+				content = input_handle.read()
+
+		digest.update(content)
+
+		for import_file in self.get_declared_imports(main_ontology_file, content):
+			digest.update(b'\n' + import_file.encode('utf-8') + b'\n')
+			if remote:
+				digest.update(self.get_import_version(import_file))
+			else:
+				file_path = self.get_import_file_path(main_ontology_file, import_file)
+				if os.path.isfile(file_path):
+					with open(file_path, 'rb') as input_handle:
+						digest.update(hashlib.sha256(input_handle.read()).digest())
+
+		if remote:
+			self.ontology_hashes[main_ontology_file] = digest.hexdigest()
+		return digest.hexdigest()
+
+
+	def get_declared_imports(self, main_ontology_file, content):
+		"""
+		Returns sorted owl:imports IRIs of given main ontology file content,
+		parsed (in a graph of its own) as do_ontology_load() parses it.  
+		The result only depends on content, so is saved in the query cache
+		folder, keyed by content hash, for later runs to read rather than 
+		parse the file again.
+		"""
+		cache_folder = self.get_query_cache_folder()
+		cache_path = None
+		if cache_folder:
+			cache_path = os.path.join(cache_folder, 'imports-' + hashlib.sha256(content).hexdigest() + '.json')
+			if os.path.isfile(cache_path):
+				try:
+					with open(cache_path) as input_handle:
+						return json.load(input_handle)
+				except ValueError:
+					pass
+
+		graph = rdflib.Graph()
+		graph.parse(data = content, format = 'xml', publicID = main_ontology_file)
+		imports = sorted(set(str(import_file) for import_file in graph.objects(None, rdflib.OWL.imports)))
+
+		if cache_path:
+			# Best effort, as for saved queries.
+			temp_path = None
+			try:
+				if not os.path.isdir(cache_folder):
+					os.makedirs(cache_folder, 0o700)
+				(handle, temp_path) = tempfile.mkstemp(dir = cache_folder, suffix = '.tmp')
+				with os.fdopen(handle, 'w') as output_handle:
+					json.dump(imports, output_handle)
+				os.rename(temp_path, cache_path)
+			except Exception:
+				if temp_path is not None and os.path.isfile(temp_path):
+					os.remove(temp_path)
+
+		return imports
+
+
+	def get_import_version(self, import_file):
+		"""
+		Returns bytes identifying the current version of import file at 
+		given URL: its ETag and Last-Modified headers, or if it has neither,
+		a hash of its content.  Empty if it can't be fetched.
+		"""
+		try:
+			response = urlopen(Request(import_file, method = 'HEAD'), timeout = 60)
+			headers = [response.headers.get('ETag'), response.headers.get('Last-Modified')]
+			response.close()
+			if any(headers):
+				return json.dumps(headers).encode('utf-8')
+		except Exception:
+			pass
+
+		try:
+			return hashlib.sha256(urlopen(import_file, timeout = 60).read()).digest()
+		except Exception:
+			return b''
 
 
 	def set_ontology_metadata(self, query):
@@ -383,7 +1317,7 @@ class OntoHelper(object):
 		metadata = self.graph.query(query)
 
 		for myDict in metadata: # Should only be 1 row containing a dictionary.
-			myDict2 = myDict.asdict()
+			myDict2 = dict((key, str(value)) for (key, value) in myDict.asdict().items())
 			# Default values
 			myDict2['type'] = 'ontology'
 			myDict2['status'] = 'release'
@@ -394,7 +1328,96 @@ class OntoHelper(object):
 			self.struct['metadata'] = myDict2
 
 
-	def do_query_table(self, query, initBinds = {}):
+	def query(self, query, initBindings = {}):
+		"""
+		Cached equivalent of self.graph.query(): returns list of result rows
+		(rdflib ResultRow, accessible by position or column name).
+		"""
+		return self.get_query_result(query, initBindings)[1]
+
+
+	def get_query_result(self, query, initBindings = {}, lazy = False):
+		"""
+		Returns (column names, list of result rows) of given query (prepared
+		or string) and bindings, from self.query_cache if possible.  The 
+		cache is emptied whenever the graph changes, and least recently 
+		used results are evicted to keep it within QUERY_CACHE_ROWS rows.
+		Rows are shared between callers so must not be modified.
+
+		With lazy = True, an uncached result's rows are an iterator over
+		the live query result instead of a list.  Rows are kept for the 
+		cache only until there are more than QUERY_CACHE_ROWS of them, so
+		a large result is never held whole.
+		"""
+		if self.query_cache_version != self.graph.version:
+			if self.query_cache:
+				self.query_stats['invalidations'] += 1
+			self.query_cache = OrderedDict()
+			self.query_cache_rows = 0
+			self.query_cache_version = self.graph.version
+
+		key = (query, tuple(sorted(initBindings.items())))
+		cached = self.query_cache.get(key)
+		if cached is not None:
+			self.query_stats['hits'] += 1
+			self.query_cache.move_to_end(key)
+			return cached
+
+		self.query_stats['misses'] += 1
+		result = self.graph.query(query, initBindings = initBindings)
+		names = [str(var) for var in result.vars or []]
+		if lazy:
+			return (names, self.iter_query_result(key, names, result))
+
+		rows = list(result)
+		self.set_query_result(key, names, rows)
+		return (names, rows)
+
+
+	def iter_query_result(self, key, names, result):
+		"""
+		Generator of given live query result's rows, which caches them as 
+		get_query_result() would if they are all read, are no more than 
+		QUERY_CACHE_ROWS, and the graph hasn't changed meanwhile.
+		"""
+		version = self.graph.version
+		rows = []
+		for row in result:
+			if rows is not None:
+				rows.append(row)
+				if len(rows) > self.QUERY_CACHE_ROWS:
+					rows = None
+			yield row
+
+		if rows is not None and self.query_cache_version == version == self.graph.version:
+			self.set_query_result(key, names, rows)
+
+
+	def set_query_result(self, key, names, rows):
+
+		# A lazy result may have been cached by another call meanwhile.
+		if len(rows) <= self.QUERY_CACHE_ROWS and not key in self.query_cache:
+			self.query_cache[key] = (names, rows)
+			self.query_cache_rows += len(rows)
+			while self.query_cache_rows > self.QUERY_CACHE_ROWS:
+				(old_key, old) = self.query_cache.popitem(last = False)
+				self.query_cache_rows -= len(old[1])
+				self.query_stats['evictions'] += 1
+
+
+	def get_query_stats(self):
+		"""
+		Query result cache statistics.
+		"""
+		stats = OrderedDict(self.query_stats)
+		lookups = stats['hits'] + stats['misses']
+		stats['hit_rate'] = round(float(stats['hits']) / lookups, 4) if lookups else 0.0
+		stats['entries'] = len(self.query_cache)
+		stats['rows'] = self.query_cache_rows
+		return stats
+
+
+	def do_query_table(self, query, initBinds = {}, columns = None):
 		"""
 		Given a sparql 1.1 query, returns a list of objects, one for each row.
 		For each object key/value, simplifies any URI reference (http://...) 
@@ -403,13 +1426,29 @@ class OntoHelper(object):
 		INPUT
 		initBinds:	To provide parameters to the query, supply it with initBindings 
 					containing a dictionary of bindings in format "term: value".
+		columns:	Optional list of the query's column names to convert and 
+					return; by default all of them.
+
+		"""
+		rows = self.iter_query_table(query, initBinds, columns)
+		if rows is None:
+			return None
+
+		return list(rows)
 
+
+	def iter_query_table(self, query, initBinds = {}, columns = None, raw = False):
+		"""
+		As do_query_table(), but returns an iterator that converts each row
+		only as it is reached, so a large result is never held as a whole
+		table.  With raw = True, rows are tuples of the given (or all) 
+		columns' unconverted rdflib values, None where unbound.
 		"""
 
 		#query = self.queries[query_name]
 
 		try:
-			result = self.graph.query(query, initBindings=initBinds)
+			(names, result) = self.get_query_result(query, initBinds, lazy = True)
 		except Exception as e:
 			print ("\nSparql query [%s] parsing problem: %s \n" % (query, str(e) ))
 			return None
@@ -419,42 +1458,67 @@ class OntoHelper(object):
 		#columns = re.search(r"(?mi)\s*SELECT(\s+DISTINCT)?\s+((\?\w+\s+|\(\??\w+\s+as\s+\?\w+\)\s*)+)\s*WHERE", query)
 		#columns = re.findall(r"\s+\?(?P<name>\w+)\)?", columns.group(2))
 
+		# Column positions are resolved once per query, not per row.
+		if columns is None:
+			selected = list(enumerate(names))
+		else:
+			selected = [(names.index(column), column) for column in columns]
+
+		if raw:
+			positions = [ptr for (ptr, column) in selected]
+			return (tuple(row[ptr] for ptr in positions) for row in result)
+
+		return self.get_table_rows(result, selected)
+
+
+	def get_table_rows(self, result, selected):
+		"""
+		Generator of do_query_table() row dictionaries for given query
+		result rows and [(position, column name)] pairs.  URIRef and 
+		literal datatype conversions are cached for the whole result.
+		"""
 		STRING_DATATYPE = rdflib.term.URIRef('http://www.w3.org/2001/XMLSchema#string')
-		table = []
-		for ptr, row in enumerate(result):
-			rowdict = row.asdict()
+		URIREF = rdflib.term.URIRef
+		LITERAL = rdflib.term.Literal
+		BNODE = rdflib.term.BNode
+		entity_ids = {}
+		# Literal datatype -> converted datatype id, or None for plain string
+		datatypes = {None: None, STRING_DATATYPE: None}
+
+		for row in result:
 			newrowdict = {}
 
-			for column in rowdict:
+			for (ptr, column) in selected:
 
 				# Each value has a datatype defined by RDF Parser: URIRef, Literal, BNode
-				value = rowdict[column]
+				value = row[ptr]
+				if value is None:
+					continue
+
 				valType = type(value) 
-				if valType is rdflib.term.URIRef : 
-					newrowdict[column] = self.get_entity_id(value)  # a plain string
+				if valType is URIREF:
+					entity_id = entity_ids.get(value)
+					if entity_id is None:
+						entity_id = entity_ids[value] = self.get_entity_id(value)
+					newrowdict[column] = entity_id  # a plain string
 
-				elif valType is rdflib.term.Literal :
+				elif valType is LITERAL:
 					# Text may include carriage returns; escape to json
-					literal = {'value': value.replace('\n', r'\n')} 
+					literal = value.replace('\n', r'\n')
 					#_invalid_uri_chars = '<>" {}|\\^`'
 
-					if hasattr(value, 'datatype'): #rdf:datatype
-						#Convert literal back to straight string if its datatype is simply xmls:string
-						if value.datatype == None or value.datatype == STRING_DATATYPE:
-							literal = literal['value']
-						else:
-							literal['datatype'] = self.get_entity_id(value.datatype)															
-
-					elif hasattr(value, 'language'): # e.g.  xml:lang="en"
-						#A query Literal won't have a language if its the result of str(?whatever) !
-						literal['language'] = self.get_entity_id(value.language)
-					
-					else: # WHAT OTHER OPTIONS?
-						literal = literal['value']
+					# Literal is left as straight string if its datatype is 
+					# simply xmls:string.  A language (e.g. xml:lang="en") 
+					# isn't kept.
+					datatype = value.datatype
+					if not datatype in datatypes:
+						datatypes[datatype] = self.get_entity_id(datatype)
+					if datatypes[datatype] is not None:
+						literal = {'value': literal, 'datatype': datatypes[datatype]}
 
 					newrowdict[column] = literal
 
-				elif valType is rdflib.term.BNode:
+				elif valType is BNODE:
 					"""
 					Convert a variety of BNode structures into something simple.
 					E.g. "(province or state or territory)" is a BNode structure coded like
@@ -465,12 +1529,7 @@ class OntoHelper(object):
                     			   <rdf:Description rdf:about="&resource;SIO_000662"/>
                     			   ...
                     """
-                    # Here we fetch list of items in disjunction
-					disjunction = self.graph.query(
-						"SELECT ?id WHERE {?datum owl:unionOf/rdf:rest*/rdf:first ?id}", 
-						initBindings={'datum': value} )		
-					results = [self.get_entity_id(item[0]) for item in disjunction] 
-					newrowdict['expression'] = {'datatype':'disjunction', 'data':results}
+					newrowdict['expression'] = {'datatype':'disjunction', 'data':list(self.get_disjunctions((value,))[value])}
 
 					newrowdict[column] = value
 
@@ -478,9 +1537,54 @@ class OntoHelper(object):
 
 					newrowdict[column] = {'value': 'unrecognized column [%s] type %s for value %s' % (column, type(value), value)}
 
-			table.append(newrowdict)
+			yield newrowdict
 
-		return table
+
+	def get_disjunctions(self, bnodes):
+		"""
+		Returns dictionary of (at least) given BNodes -> list of ids of items
+		in their owl:unionOf lists, as by 
+		"?datum owl:unionOf/rdf:rest*/rdf:first ?id".
+
+		Lists are resolved from an index of the graph's rdf:first and 
+		rdf:rest triples, built in one pass, rather than by a SPARQL path
+		query per BNode.  Index and resolved lists are kept until 
+		graph changes.
+		"""
+		if self.disjunction_version != self.graph.version:
+			self.disjunctions = {}
+			self.list_index = None
+			self.disjunction_version = self.graph.version
+
+		unresolved = [bnode for bnode in bnodes if not bnode in self.disjunctions]
+		if unresolved:
+			union_of = rdflib.term.URIRef(self.namespace['owl'] + 'unionOf')
+			heads = dict((bnode, list(self.graph.objects(bnode, union_of))) for bnode in unresolved)
+
+			if self.list_index is None and any(heads.values()):
+				self.list_index = ({}, {})
+				for (cell, first) in self.graph.subject_objects(rdflib.RDF.first):
+					self.list_index[0].setdefault(cell, []).append(first)
+				for (cell, rest) in self.graph.subject_objects(rdflib.RDF.rest):
+					self.list_index[1].setdefault(cell, []).append(rest)
+
+			(firsts, rests) = self.list_index or ({}, {})
+			for bnode in unresolved:
+				items = []
+				for head in heads[bnode]:
+					# rdf:rest* visits each list cell once, head included.
+					visited = set([head])
+					queue = [head]
+					for cell in queue:
+						items.extend(firsts.get(cell, []))
+						for rest in rests.get(cell, []):
+							if not rest in visited:
+								visited.add(rest)
+								queue.append(rest)
+
+				self.disjunctions[bnode] = [self.get_entity_id(item) for item in items]
+
+		return self.disjunctions
 
 
 	def check_folder(self, file_path, message = "Directory for "):
@@ -569,3 +1673,276 @@ class OntoHelper(object):
 			output_handle.write('\n'.join(output))
 
 
+	def do_output_compact_json(self, struct, output_file_basename):
+		"""
+		Writes get_compact_struct() version of struct, unindented, to a 
+		.compact.json file.  read_compact_json() reads it back.
+		"""
+		with (open(output_file_basename + '.compact.json', 'w')) as output_handle:
+			output_handle.write(json.dumps(self.get_compact_struct(struct), sort_keys = False, separators = (',', ':')))
+
+
+	def do_output_index(self, struct, output_file_basename):
+		"""
+		Writes struct's term records to a memory-mappable .index file (see
+		ontoindex.py) for services to look terms up in by id.
+		"""
+		import ontoindex
+		ontoindex.write_term_index(struct['specifications'], output_file_basename + '.index')
+
+
+	def get_compact_struct(self, struct):
+		"""
+		Returns a copy of struct with its "specifications" term records in 
+		a columnar table rather than as dictionaries, for a smaller file
+		that is quicker to parse.  Other parts of struct are as they were.
+
+			"specifications": {
+				"format": "ontofetch-compact/1",
+				"fields": ["id", "parent_id", "label", ...],
+				"shapes": [[0, 1, 2], ...],
+				"prefixes": ["BFO", "ENVO", ...],
+				"strings": ["0000001", "entity", ...],
+				"rows": [[0, [0, 0], [0, 3], 1], ...]
+			}
+
+		Each row is a term record: its shape (an index into shapes, which 
+		lists the record's fields, by index into fields, in the record's 
+		order) followed by its field values.  A string value is an index
+		into strings, which holds each distinct string once.  In ID_FIELDS
+		a string is instead [prefix index, local part string index], e.g.
+		"BFO:0000001" -> [0, 0], or [string index] if it has no colon.  A 
+		list value is a list of these.  Any other value (none are made by
+		ontofetch.py) is wrapped as {"value": value}.  The specifications
+		key of each record is its id.  get_expanded_struct() reverses this
+		exactly.
+		"""
+		fields = OrderedDict()
+		shapes = OrderedDict()
+		prefixes = OrderedDict()
+		strings = OrderedDict()
+		rows = []
+
+		def get_index(table, key):
+			index = table.get(key)
+			if index is None:
+				index = table[key] = len(table)
+			return index
+
+		def get_value(value, is_id):
+			if isinstance(value, list):
+				return [get_value(item, is_id) for item in value]
+			if not isinstance(value, str):
+				return {'value': value}
+			if not is_id:
+				return get_index(strings, value)
+			if ':' in value:
+				(prefix, local) = value.split(':', 1)
+				return [get_index(prefixes, prefix), get_index(strings, local)]
+			return [get_index(strings, value)]
+
+		for (key, record) in struct['specifications'].items():
+			if record.get('id') != key:
+				raise ValueError('Specifications key %s is not its record id' % key)
+			shape = tuple(get_index(fields, field) for field in record)
+			row = [get_index(shapes, shape)]
+			for (field, value) in record.items():
+				row.append(get_value(value, field in self.ID_FIELDS))
+			rows.append(row)
+
+		table = OrderedDict()
+		table['format'] = self.COMPACT_FORMAT
+		table['fields'] = list(fields)
+		table['shapes'] = [list(shape) for shape in shapes]
+		table['prefixes'] = list(prefixes)
+		table['strings'] = list(strings)
+		table['rows'] = rows
+
+		compact = OrderedDict()
+		for (key, value) in struct.items():
+			compact[key] = table if key == 'specifications' else value
+		return compact
+
+
+	def get_expanded_struct(self, compact):
+		"""
+		Returns struct, as made by ontofetch.py, that get_compact_struct() 
+		made given compact struct from.
+		"""
+		table = compact['specifications']
+		if table.get('format') != self.COMPACT_FORMAT:
+			raise ValueError('Not an %s specifications table' % self.COMPACT_FORMAT)
+
+		fields = table['fields']
+		# Shape -> (record fields, whether each holds ids)
+		shapes = [([fields[ptr] for ptr in shape], [fields[ptr] in self.ID_FIELDS for ptr in shape]) for shape in table['shapes']]
+		prefixes = table['prefixes']
+		strings = table['strings']
+
+		def get_value(value, is_id):
+			if isinstance(value, int):
+				return strings[value]
+			if isinstance(value, dict):
+				return value['value']
+			# An id is a list of ints; a list value's items aren't ints.
+			if is_id and value and isinstance(value[0], int):
+				if len(value) == 1:
+					return strings[value[0]]
+				return prefixes[value[0]] + ':' + strings[value[1]]
+			return [get_value(item, is_id) for item in value]
+
+		specifications = OrderedDict()
+		for row in table['rows']:
+			(names, ids) = shapes[row[0]]
+			# Most values are plain strings.
+			record = OrderedDict(zip(names, [strings[value] if type(value) is int else get_value(value, is_id) for (value, is_id) in zip(row[1:], ids)]))
+			specifications[record['id']] = record
+
+		struct = OrderedDict()
+		for (key, value) in compact.items():
+			struct[key] = specifications if key == 'specifications' else value
+		return struct
+
+
+	def read_compact_json(self, file_path):
+		"""
+		Returns struct from a do_output_compact_json() file.
+		"""
+		with (open(file_path, 'r')) as input_handle:
+			return self.get_expanded_struct(json.load(input_handle, object_pairs_hook = OrderedDict))
+
+
+	def get_shards(self, specifications, shard_by, shard_size = 1000):
+		"""
+		Splits given specifications into groups for do_output_shards().
+
+		INPUT
+			specifications: dict of term id -> term record, in output order
+			shard_by: one of SHARD_MODES:
+				branch: a term goes with its top-level ancestor (a term
+					whose parent has no record, or only a minimal parent
+					one), found by following parent_id.  A picklist is
+					thus usually in one shard.
+				prefix: a term goes with others of its id prefix, e.g. 
+					"BFO" for BFO:0000001.
+				size: terms are put in id order and cut into shards of
+					shard_size terms (at least 1), so shard id ranges 
+					don't overlap.
+		OUTPUT
+			OrderedDict of shard key -> list of term ids, in output order.
+		"""
+		shards = OrderedDict()
+
+		if shard_by == 'size':
+			if shard_size < 1:
+				raise ValueError('Shard size must be at least 1, not %d' % shard_size)
+			ids = sorted(specifications)
+			position = dict((id, ptr) for (ptr, id) in enumerate(specifications))
+			for start in range(0, len(ids), shard_size):
+				chunk = ids[start: start + shard_size]
+				shards[chunk[0]] = sorted(chunk, key = position.get)
+			return shards
+
+		# Ancestor lookups along parent_id chains are memoized in branches.
+		branches = {}
+		for id in specifications:
+			if shard_by == 'prefix':
+				key = id.split(':', 1)[0] if ':' in id and id[0:4] != 'http' else ''
+			else:
+				key = self.get_branch_id(id, specifications, branches)
+			shards.setdefault(key, []).append(id)
+
+		return shards
+
+
+	def get_branch_id(self, id, specifications, branches):
+		"""
+		Top-level ancestor of given term along its parent_id chain, stopping
+		at a parent without a full record of its own, or at a cycle.
+		"""
+		path = []
+		while not id in branches:
+			parent_id = specifications[id].get('parent_id')
+			parent = specifications.get(parent_id)
+			if not parent or not 'parent_id' in parent or parent_id in path:
+				branches[id] = id
+				break
+			path.append(id)
+			id = parent_id
+
+		for term_id in path:
+			branches[term_id] = branches[id]
+		return branches[id]
+
+
+	def do_output_shards(self, struct, output_file_basename, shards, shard_by, compact = False):
+		"""
+		Writes struct's specifications as one .json file per shard, given 
+		by get_shards(), and a small .manifest.json listing them, so that a
+		web client can load only the shards (picklists) it renders, and 
+		download a shard again only when its hash changes.  Shard files
+		have the same layout as do_output_json() files but hold only their
+		"specifications" part; metadata and @context are in the manifest:
+
+			{
+				"metadata": {...},
+				"@context": {...},
+				"shard_by": "branch",
+				"format": "json",
+				"terms": 2530,
+				"shards": [
+					{
+						"key": "BFO:0000001",
+						"file": "root-ontology.shard-0001.json",
+						"terms": 35,
+						"first_id": "BFO:0000001",
+						"last_id": "BFO:0000040",
+						"sha256": "9f2c..."
+					}, ...
+				]
+			}
+
+		first_id and last_id bound the shard's ids in sorted order.  If 
+		compact, shard files are get_compact_struct() tables instead.  Shard
+		files left by an earlier run of the same output are removed.
+
+		OUTPUT
+			manifest dictionary, as written
+		"""
+		for file_path in glob.glob(glob.escape(output_file_basename) + '.shard-*.json'):
+			os.remove(file_path)
+
+		specifications = struct['specifications']
+		manifest = OrderedDict()
+		manifest['metadata'] = struct['metadata']
+		manifest['@context'] = struct['@context']
+		manifest['shard_by'] = shard_by
+		manifest['format'] = self.COMPACT_FORMAT if compact else 'json'
+		manifest['terms'] = len(specifications)
+		manifest['shards'] = []
+
+		for (ptr, (key, ids)) in enumerate(shards.items()):
+			file_path = output_file_basename + '.shard-%04d.json' % (ptr + 1)
+			shard_struct = {'specifications': OrderedDict((id, specifications[id]) for id in ids)}
+			if compact:
+				content = json.dumps(self.get_compact_struct(shard_struct), sort_keys = False, separators = (',', ':'))
+			else:
+				content = json.dumps(shard_struct, sort_keys = False, indent = 4, separators = (',', ': '))
+			with (open(file_path, 'w')) as output_handle:
+				output_handle.write(content)
+
+			shard = OrderedDict()
+			shard['key'] = key
+			shard['file'] = os.path.basename(file_path)
+			shard['terms'] = len(ids)
+			shard['first_id'] = min(ids)
+			shard['last_id'] = max(ids)
+			shard['sha256'] = hashlib.sha256(content.encode('utf-8')).hexdigest()
+			manifest['shards'].append(shard)
+
+		with (open(output_file_basename + '.manifest.json', 'w')) as output_handle:
+			output_handle.write(json.dumps(manifest, sort_keys = False, indent = 4, separators = (',', ': ')))
+
+		return manifest
+
+
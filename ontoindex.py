@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+""" **************************************************************************
+	Memory-mapped binary term index of ontofetch.py output.
+
+	write_term_index() writes a struct's term records (its
+	"specifications") to a binary file that TermIndex opens with mmap,
+	so that a service needing only a term's label, parent or deprecation
+	status can look it up without loading the .json output.  Pages are
+	read from the file as needed, and processes opening the same file
+	share them in the operating system's page cache rather than each
+	holding a copy of every term.
+
+		import ontoindex
+
+		index = ontoindex.TermIndex('test/root-ontology.index')
+		term = index.get_term('BFO:0000040')   # id, label, parent_id, ...
+		index.get_children('BFO:0000040')      # ids of subclasses
+		list(index.iter_prefix('ENVO:'))       # ENVO ids, in sorted order
+		index.get_record('BFO:0000040')        # whole .json record
+
+	File layout (little-endian):
+
+		header	HEADER struct: magic, version, entry size, term count,
+				hash slot count, and the offsets of the sections below.
+		entries	ENTRY struct per term, sorted by id: (offset, length) in
+				heap of id, label, replaced_by and the term's JSON
+				record, its parent's entry number, the start and count of
+				its children's entry numbers, and flags (1 = deprecated).
+		hash	Entry number + 1 (0 = empty) for each of a power of two
+				number of slots, placed by CRC-32 of id with linear
+				probing, for constant time lookup by id.
+		children	Entry numbers of each term's children (terms whose
+				parent_id or other_parents is that term), in output order.
+		heap	UTF-8 strings.
+
+	Entries are sorted, so a prefix scan is a binary search then a walk.
+	An index is replaced by writing a temporary file and renaming it, so
+	processes with the old file open keep a consistent view of it.
+
+	**************************************************************************
+"""
+
+import os
+import json
+import mmap
+import struct
+import zlib
+import tempfile
+
+try: #Python 2.7
+	from collections import OrderedDict
+except ImportError: # Python 2.6
+	from ordereddict import OrderedDict
+
+class TermIndex(object):
+	"""
+	Read-only view of a write_term_index() file.  Lookups decode only the
+	fields asked for, straight from the mapped file.
+	"""
+
+	MAGIC = b'ONTOIDX1'
+	VERSION = 1
+	# magic, version, entry size, terms, hash slots, and offsets of
+	# entries, hash, children and heap.
+	HEADER = struct.Struct('<8sIIIIQQQQ')
+	# id, label, replaced_by and record (offset, length) pairs, parent
+	# entry number, children start and count, flags.
+	ENTRY = struct.Struct('<IIIIIIIIIIII')
+	SLOT = struct.Struct('<I')
+	# Entry number of a missing parent.
+	NONE = 0xFFFFFFFF
+	DEPRECATED = 1
+
+	def __init__(self, file_path):
+
+		with open(file_path, 'rb') as input_handle:
+			self.map = mmap.mmap(input_handle.fileno(), 0, access = mmap.ACCESS_READ)
+
+		(magic, version, entry_size, self.count, self.slots, self.entries_offset, self.hash_offset, self.children_offset, self.heap_offset) = self.HEADER.unpack_from(self.map, 0)
+		if magic != self.MAGIC or version != self.VERSION or entry_size != self.ENTRY.size:
+			self.map.close()
+			raise ValueError(file_path + ' is not a version %d term index' % self.VERSION)
+
+
+	def close(self):
+
+		self.map.close()
+
+
+	def __enter__(self):
+
+		return self
+
+
+	def __exit__(self, *args):
+
+		self.close()
+
+
+	def __len__(self):
+
+		return self.count
+
+
+	def __contains__(self, id):
+
+		return self.get_position(id) is not None
+
+
+	def __iter__(self):
+		"""
+		Term ids in sorted order.
+		"""
+		for position in range(self.count):
+			yield self.get_id(position)
+
+
+	############################## Lookup #############################
+
+	def get_entry(self, position):
+
+		return self.ENTRY.unpack_from(self.map, self.entries_offset + position * self.ENTRY.size)
+
+
+	def get_string(self, offset, length):
+
+		return self.map[self.heap_offset + offset: self.heap_offset + offset + length].decode('utf-8') if length else None
+
+
+	def get_id(self, position):
+
+		(offset, length) = struct.unpack_from('<II', self.map, self.entries_offset + position * self.ENTRY.size)
+		return self.get_string(offset, length)
+
+
+	def get_position(self, id):
+		"""
+		Entry number of given term id, or None if it isn't indexed.
+		"""
+		key = id.encode('utf-8')
+		mask = self.slots - 1
+		slot = zlib.crc32(key) & mask
+		while True:
+			position = self.SLOT.unpack_from(self.map, self.hash_offset + slot * 4)[0]
+			if not position:
+				return None
+			(offset, length) = struct.unpack_from('<II', self.map, self.entries_offset + (position - 1) * self.ENTRY.size)
+			if length == len(key) and self.map[self.heap_offset + offset: self.heap_offset + offset + length] == key:
+				return position - 1
+			slot = (slot + 1) & mask
+
+
+	def get_term(self, id):
+		"""
+		Returns {id, label, parent_id, deprecated, replaced_by} of given
+		term id (label and replaced_by are None if the term has none, and
+		JSON text if not a string in the term's record), or None if it 
+		isn't indexed.
+		"""
+		position = self.get_position(id)
+		if position is None:
+			return None
+		entry = self.get_entry(position)
+		return {
+			'id': id,
+			'label': self.get_string(entry[2], entry[3]),
+			'parent_id': None if entry[8] == self.NONE else self.get_id(entry[8]),
+			'deprecated': bool(entry[11] & self.DEPRECATED),
+			'replaced_by': self.get_string(entry[4], entry[5])
+		}
+
+
+	def get_label(self, id):
+
+		position = self.get_position(id)
+		if position is not None:
+			entry = self.get_entry(position)
+			return self.get_string(entry[2], entry[3])
+
+
+	def get_parent_id(self, id):
+
+		position = self.get_position(id)
+		if position is not None:
+			parent = self.get_entry(position)[8]
+			if parent != self.NONE:
+				return self.get_id(parent)
+
+
+	def get_children(self, id):
+		"""
+		Ids of given term's children, in output order.
+		"""
+		position = self.get_position(id)
+		if position is None:
+			return []
+		(start, count) = self.get_entry(position)[9:11]
+		positions = struct.unpack_from('<%dI' % count, self.map, self.children_offset + start * 4)
+		return [self.get_id(child) for child in positions]
+
+
+	def get_record(self, id):
+		"""
+		Given term's whole record, as in the .json "specifications".
+		"""
+		position = self.get_position(id)
+		if position is not None:
+			entry = self.get_entry(position)
+			return json.loads(self.get_string(entry[6], entry[7]))
+
+
+	def iter_prefix(self, prefix):
+		"""
+		Generator of ids starting with given prefix (e.g. "BFO:"), in
+		sorted order.
+		"""
+		key = prefix.encode('utf-8')
+		(low, high) = (0, self.count)
+		while low < high:
+			middle = (low + high) // 2
+			if self.get_id(middle).encode('utf-8') < key:
+				low = middle + 1
+			else:
+				high = middle
+
+		for position in range(low, self.count):
+			id = self.get_id(position)
+			if not id.startswith(prefix):
+				break
+			yield id
+
+
+def write_term_index(specifications, file_path):
+	"""
+	Writes given term records (id -> record, in output order, as in an
+	ontofetch.py struct's "specifications") to a TermIndex file.
+	"""
+	ids = sorted(specifications)
+	positions = dict((id, position) for (position, id) in enumerate(ids))
+	heap = bytearray()
+	strings = {}
+
+	def add_data(data):
+		# Checked before entries are packed with heap offsets.
+		if len(heap) + len(data) > 0xFFFFFFFF:
+			raise ValueError('Term index string heap is over 4GB')
+		heap.extend(data)
+		return (len(heap) - len(data), len(data))
+
+	def get_string(value):
+		if not value:
+			return (0, 0)
+		# E.g. a label list or language-tagged dict, kept as in the record.
+		if not isinstance(value, str):
+			value = json.dumps(value, separators = (',', ':'))
+		if not value in strings:
+			strings[value] = add_data(value.encode('utf-8'))
+		return strings[value]
+
+	# Children in output order of each parent entry number.
+	children = [[] for id in ids]
+	for (id, record) in specifications.items():
+		# A parent can be in other_parents more than once.
+		for parent_id in OrderedDict.fromkeys([record.get('parent_id')] + record.get('other_parents', [])):
+			if parent_id in positions:
+				children[positions[parent_id]].append(positions[id])
+
+	entries = bytearray()
+	child_positions = []
+	for id in ids:
+		record = specifications[id]
+		parent = positions.get(record.get('parent_id'), TermIndex.NONE)
+		# owl:deprecated value, as the "tree" query gives it: "true" etc.
+		flags = TermIndex.DEPRECATED if str(record.get('deprecated')).lower() in ('true', '1') else 0
+		# Record JSON strings are unique, so aren't looked up in strings.
+		record_ref = add_data(json.dumps(record, separators = (',', ':')).encode('utf-8'))
+		entries.extend(TermIndex.ENTRY.pack(*(get_string(id) + get_string(record.get('label')) + get_string(record.get('replaced_by')) + record_ref + (parent, len(child_positions), len(children[positions[id]]), flags))))
+		child_positions.extend(children[positions[id]])
+
+	# At most half full, so probes stay short.
+	slots = 1
+	while slots < 2 * len(ids):
+		slots *= 2
+	table = [0] * slots
+	for (position, id) in enumerate(ids):
+		slot = zlib.crc32(id.encode('utf-8')) & (slots - 1)
+		while table[slot]:
+			slot = (slot + 1) & (slots - 1)
+		table[slot] = position + 1
+
+	entries_offset = TermIndex.HEADER.size
+	hash_offset = entries_offset + len(entries)
+	children_offset = hash_offset + slots * 4
+	heap_offset = children_offset + len(child_positions) * 4
+	header = TermIndex.HEADER.pack(TermIndex.MAGIC, TermIndex.VERSION, TermIndex.ENTRY.size, len(ids), slots, entries_offset, hash_offset, children_offset, heap_offset)
+
+	(handle, temp_path) = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(file_path)), suffix = '.tmp')
+	try:
+		with os.fdopen(handle, 'wb') as output_handle:
+			output_handle.write(header)
+			output_handle.write(entries)
+			output_handle.write(struct.pack('<%dI' % slots, *table))
+			output_handle.write(struct.pack('<%dI' % len(child_positions), *child_positions))
+			output_handle.write(heap)
+		# Readable by other users' services, as a plainly written file is.
+		os.chmod(temp_path, 0o644)
+		os.rename(temp_path, file_path)
+	except Exception:
+		os.remove(temp_path)
+		raise
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+""" **************************************************************************
+	Concurrent loading of an ontology given by URL, with its imports, into
+	an OntoHelper graph.
+
+	OntologyLoader downloads the main ontology file in chunks and, as soon
+	as an owl:imports declaration shows up in the downloaded text, starts
+	downloading that import too.  Completed files are parsed one at a time
+	in a worker thread while other downloads carry on, so network and
+	parsing time overlap rather than add up.  Files are parsed in the same
+	order as OntoHelper.do_ontology_includes() would: the main file, then
+	the imports the parsed main file declares, sorted by IRI.  The graph
+	built is therefore the same.
+
+		import ontohelper as oh
+		import ontoload
+
+		helper = oh.OntoHelper()
+		ontoload.OntologyLoader(helper, concurrency = 4, retries = 2).load('http://purl.obolibrary.org/obo/genepio.owl')
+
+	Downloads use urllib in a thread pool of size concurrency.  A download
+	that fails, e.g. because of a connection error or a 5xx response, is
+	tried again up to retries more times, with a doubling delay between
+	tries.  An import that still can't be fetched is reported and skipped,
+	as before.  A main file that can't be fetched raises an exception.
+
+	load() returns only once every download thread has finished, so none
+	outlives it (e.g. into forked worker processes).  Downloads no longer
+	wanted (speculative ones the main file didn't really declare, or all
+	of them after an error) have their connections shut down, so they
+	end at once rather than when their next chunk comes, and aren't 
+	tried again or counted.  Called from code 
+	with an event loop running (e.g. fetch_terms() in an async service),
+	it runs its own event loop in a separate thread, blocking the caller
+	until the ontology is loaded, as a synchronous call does.
+
+	This module needs Python 3.9 or later (asyncio, and cancel_futures of
+	ThreadPoolExecutor.shutdown()); it is only imported by 
+	OntoHelper.do_ontology_load() for an ontology given by URL.
+
+	**************************************************************************
+"""
+
+import os
+import re
+import socket
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+
+
+class OntologyLoader(object):
+
+	# Bytes read per download step; imports are looked for in each.
+	CHUNK_SIZE = 65536
+	# Seconds before the first retry of a failed download; doubled after.
+	RETRY_DELAY = 0.5
+	# RDF/XML owl:imports declaration, as do_ontology_includes() finds
+	# them by query once the main file is parsed.
+	IMPORT_PATTERN = re.compile(rb'<owl:imports\s+rdf:resource="([^"]+)"')
+	HEADERS = {'Accept': 'application/rdf+xml, */*;q=0.1'}
+
+	def __init__(self, onto_helper, concurrency = 4, retries = 2, timeout = 60):
+
+		self.onto_helper = onto_helper
+		self.concurrency = max(1, concurrency)
+		self.retries = max(0, retries)
+		self.timeout = timeout
+		# Import IRI -> download task, started as its declaration is read
+		self.downloads = {}
+		# URLs whose downloads are no longer wanted, and whether all are;
+		# read_url() stops at its next chunk, or when stop_download() shuts
+		# down its connection.
+		self.cancelled = set()
+		self.stopping = False
+		# URL -> response being read, and lock held while one is added,
+		# closed or shut down.
+		self.responses = {}
+		self.response_lock = threading.Lock()
+		# Counters reported by get_stats()
+		self.stats = {'downloads': 0, 'retries': 0, 'failures': 0, 'bytes': 0, 'download_seconds': 0.0, 'parse_seconds': 0.0}
+
+
+	def load(self, main_ontology_file):
+		"""
+		Parses given ontology URL and its imports into onto_helper.graph.
+		"""
+		# One thread parses (the graph isn't safe for concurrent writes),
+		# while concurrency threads download.
+		self.fetch_executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+		self.parse_executor = concurrent.futures.ThreadPoolExecutor(1)
+		self.stopping = False
+		try:
+			self.run(self.do_load(main_ontology_file))
+		finally:
+			# Downloads not started are dropped, and those still going
+			# (speculative ones not really declared) stop and are waited 
+			# for.
+			self.stopping = True
+			for url in list(self.responses):
+				self.stop_download(url)
+			self.fetch_executor.shutdown(wait = True, cancel_futures = True)
+			self.parse_executor.shutdown()
+
+
+	def run(self, coroutine):
+		"""
+		Runs given coroutine to completion in a new event loop, in a 
+		thread of its own if this thread already has one running.
+		"""
+		try:
+			asyncio.get_running_loop()
+		except RuntimeError:
+			return asyncio.run(coroutine)
+
+		with concurrent.futures.ThreadPoolExecutor(1) as executor:
+			return executor.submit(asyncio.run, coroutine).result()
+
+
+	async def do_load(self, main_ontology_file):
+
+		self.loop = asyncio.get_running_loop()
+		progress = self.onto_helper.progress
+		# Content get_ontology_hash() has just downloaded is used as is.
+		body = self.onto_helper.ontology_downloads.pop(main_ontology_file, None)
+		if body is None:
+			body = await self.get_download(main_ontology_file, self.add_declared_imports)
+		progress.start('parse', 1, main_ontology_file)
+		await self.do_parse(main_ontology_file, body)
+		progress.step()
+
+		imports = self.onto_helper.get_ontology_imports()
+		self.onto_helper.log("It has %s import files ..." % len(imports))
+
+		import_files = [str(import_file) for import_file in imports]
+		for import_file in import_files:
+			self.start_download(import_file)
+
+		# Speculatively started downloads the main file didn't really
+		# declare (e.g. in a comment) aren't waited for.
+		for (import_file, task) in self.downloads.items():
+			if not import_file in import_files:
+				self.cancelled.add(import_file)
+				task.cancel()
+				self.stop_download(import_file)
+
+		progress.start('imports', len(import_files))
+		for import_file in import_files:
+			self.onto_helper.log(import_file)
+			try:
+				body = await self.downloads[import_file]
+				await self.do_parse(import_file, body)
+			except Exception as e:
+				self.onto_helper.log('WARNING:' + import_file + " could not be loaded!\n", e)
+			progress.step()
+		progress.end()
+
+
+	def add_declared_imports(self, text):
+		"""
+		Starts download of each import declared in given main file text.
+		"""
+		for import_file in self.IMPORT_PATTERN.findall(text):
+			self.start_download(import_file.decode('utf-8'))
+
+
+	def start_download(self, import_file):
+
+		if not import_file in self.downloads:
+			self.downloads[import_file] = self.loop.create_task(self.get_download(import_file))
+
+
+	async def get_download(self, url, on_chunk = None):
+		"""
+		Returns content of given URL, trying again after a delay if the
+		download fails.  on_chunk, if given, is called (in the event loop)
+		with the text read so far, less what earlier calls have covered
+		apart from a small overlap, so that a declaration split between
+		two chunks is still seen.
+		"""
+		delay = self.RETRY_DELAY
+		for attempt in range(self.retries + 1):
+			if attempt:
+				self.stats['retries'] += 1
+				await asyncio.sleep(delay)
+				delay *= 2
+			try:
+				start = time.perf_counter()
+				body = await self.loop.run_in_executor(self.fetch_executor, self.read_url, url, on_chunk)
+			except HTTPError as e:
+				# Client errors (e.g. 404) won't be fixed by trying again.
+				if e.code < 500 or attempt == self.retries or self.is_cancelled(url):
+					self.add_failure(url)
+					raise
+			except Exception:
+				if attempt == self.retries or self.is_cancelled(url):
+					self.add_failure(url)
+					raise
+			else:
+				# A cancelled download's (partial) content isn't used.
+				if not self.is_cancelled(url):
+					self.stats['downloads'] += 1
+					self.stats['bytes'] += len(body)
+					self.stats['download_seconds'] += time.perf_counter() - start
+				return body
+
+
+	def is_cancelled(self, url):
+		return self.stopping or url in self.cancelled
+
+
+	def add_failure(self, url):
+
+		if not self.is_cancelled(url):
+			self.stats['failures'] += 1
+
+
+	def read_url(self, url, on_chunk):
+		"""
+		Downloads given URL in the calling (executor) thread.
+		"""
+		chunks = []
+		tail = b''
+		response = urlopen(Request(url, None, self.HEADERS), timeout = self.timeout)
+		with self.response_lock:
+			self.responses[url] = response
+		try:
+			while True:
+				# Checked after response is added, so a download cancelled 
+				# before stop_download() could see it still stops here.
+				if self.is_cancelled(url):
+					break
+				chunk = response.read(self.CHUNK_SIZE)
+				if not chunk:
+					break
+				chunks.append(chunk)
+				if on_chunk is not None:
+					text = tail + chunk
+					self.loop.call_soon_threadsafe(on_chunk, text)
+					tail = text[-1024:]
+		finally:
+			with self.response_lock:
+				del self.responses[url]
+				response.close()
+
+		return b''.join(chunks)
+
+
+	def stop_download(self, url):
+		"""
+		Shuts down the connection of given URL's download, if it is being
+		read, so that a read waiting for data returns at once.  Best effort:
+		where a socket can't be made from the response's file descriptor, 
+		the download stops at its next chunk.
+		"""
+		with self.response_lock:
+			response = self.responses.get(url)
+			if response is None:
+				return
+			try:
+				# A duplicate descriptor, closed here, shares the connection.
+				with socket.socket(fileno = os.dup(response.fileno())) as connection:
+					connection.shutdown(socket.SHUT_RDWR)
+			except Exception:
+				pass
+
+
+	async def do_parse(self, url, body):
+
+		start = time.perf_counter()
+		await self.loop.run_in_executor(self.parse_executor, self.parse, url, body)
+		self.stats['parse_seconds'] += time.perf_counter() - start
+
+
+	def parse(self, url, body):
+		# Parsed as graph.parse(url, format='xml') would, with url as base.
+		self.onto_helper.graph.parse(data = body, format = 'xml', publicID = url)
+
+
+	def get_stats(self):
+
+		stats = dict(self.stats)
+		stats['download_seconds'] = round(stats['download_seconds'], 3)
+		stats['parse_seconds'] = round(stats['parse_seconds'], 3)
+		return stats
@@ -0,0 +1,593 @@
+#!/usr/bin/python
+
+""" **************************************************************************
+	Compiled forms of ontobucket.py bucket rule sets.
+
+	A bucket_rules dictionary (as written to [ontology].json by ontobucket.py)
+	repeats many subexpressions verbatim - the same owl:unionOf term lists
+	and owl:complementOf exclusions appear in many buckets. RuleDAG
+	hash-conses the rule set into a directed acyclic graph of unique
+	expression nodes, so each shared node is evaluated once per comparison
+	set rather than once per occurrence.
+
+		import ontorules as orules
+
+		dag = orules.RuleDAG(bucket_rules)
+		for (bucket_id, output) in dag.evaluate(set(['FOODON:00002099'])):
+			...
+
+	Evaluation semantics are exactly those of OntologyBuckets.do_bucket_rule()
+	and its owl_rules functions.
+
+	RuleOptimiser rewrites a rule set into a smaller equivalent one, and
+	RuleTrace collects OntologyBuckets trace mode counters and traces.
+
+	**************************************************************************
+"""
+
+import json
+import collections
+
+try: #Python 2.7
+	from collections import OrderedDict
+except ImportError: # Python 2.6
+	from ordereddict import OrderedDict
+
+
+class RuleDAG(object):
+	"""
+	Nodes are tuples, held in self.nodes in children-first order so that
+	a single forward pass evaluates the whole rule set:
+
+		('expr', frozenset(entity ids), (child node ids))
+			A rule dictionary: matched entity ids plus union of its
+			function children's outputs.
+		(op, child node id)
+			op is 'some', 'all' or 'not'; child is an 'expr' node.
+		(op, child node id, limit)
+			op is 'exactly', 'min' or 'max' qualified cardinality.
+	"""
+
+	# owl:unionOf evaluates exactly as owl:someValuesFrom does (see
+	# OntologyBuckets.owl_rules) so both compile to the same node.
+	FUNCTIONS = {
+		'owl:someValuesFrom': 'some',
+		'owl:unionOf': 'some',
+		'owl:intersectionOf': 'all',
+		'owl:complementOf': 'not',
+		'owl:qualifiedCardinality': 'exactly',
+		'owl:minQualifiedCardinality': 'min',
+		'owl:maxQualifiedCardinality': 'max'
+	}
+
+	# Rule dictionary key each op is written back out as by get_rule().
+	OPERATORS = {
+		'some': 'owl:someValuesFrom',
+		'all': 'owl:intersectionOf',
+		'not': 'owl:complementOf',
+		'exactly': 'owl:qualifiedCardinality',
+		'min': 'owl:minQualifiedCardinality',
+		'max': 'owl:maxQualifiedCardinality'
+	}
+
+	FALSE = frozenset([False])
+	TRUE = frozenset([True])
+	EMPTY = frozenset()
+
+	def __init__(self, bucket_rules):
+
+		self.bucket_rules = bucket_rules
+		self.nodes = []
+		# node tuple -> position in self.nodes
+		self.node_index = {}
+		# Number of places in rule set each node occurs
+		self.references = []
+		# Number of nodes rule set would have without sharing
+		self.tree_size = 0
+		# [(bucket_id, node id), ...] in bucket_rules order
+		self.roots = []
+
+		for bucket_id, rule in bucket_rules.items():
+			self.roots.append((bucket_id, self.add_expression(rule)))
+
+
+	def add_node(self, node):
+
+		self.tree_size += 1
+		if node in self.node_index:
+			node_id = self.node_index[node]
+			self.references[node_id] += 1
+			return node_id
+
+		node_id = len(self.nodes)
+		self.nodes.append(node)
+		self.node_index[node] = node_id
+		self.references.append(1)
+		return node_id
+
+
+	def add_expression(self, rule):
+		"""
+		Adds a rule dictionary.  Keys that aren't rule functions are entity
+		ids to compare against comparison set, as in do_bucket_rule(). Key
+		order doesn't affect evaluation, so children are sorted to give
+		equal expressions equal nodes.
+		"""
+		ids = []
+		children = []
+		for (item, content) in rule.items():
+			if item in self.FUNCTIONS:
+				children.append(self.add_function(item, content))
+			else:
+				ids.append(item)
+
+		return self.add_node(('expr', frozenset(ids), tuple(sorted(set(children)))))
+
+
+	def add_function(self, item, content):
+
+		op = self.FUNCTIONS[item]
+		if op in ('exactly', 'min', 'max'):
+			return self.add_node((op, self.add_expression(content['set']), content['limit']))
+
+		return self.add_node((op, self.add_expression(content)))
+
+
+	def get_ids(self):
+		"""
+		Set of entity ids rule set mentions; only these affect evaluation.
+		"""
+		return frozenset(item for node in self.nodes if node[0] == 'expr' for item in node[1])
+
+
+	def evaluate(self, comparison_set):
+		"""
+		Evaluates every node once, children first, for given comparison set.
+
+		INPUT
+			comparison_set: set of lexmapr hit ids and their ancestor ids
+		OUTPUT
+			[(bucket_id, output), ...] in bucket_rules order, including
+			untriggered buckets, where output is a frozenset of matched ids
+			(and/or True), or frozenset([False]) as from do_bucket_rule().
+		"""
+		results = self.evaluate_nodes(comparison_set)
+		return [(bucket_id, results[node_id]) for (bucket_id, node_id) in self.roots]
+
+
+	def evaluate_trace(self, comparison_set, bucket_ids):
+		"""
+		get_trace() report for each of given buckets.
+		"""
+		results = self.evaluate_nodes(comparison_set)
+		root_ids = dict(self.roots)
+		return OrderedDict((bucket_id, self.get_trace(results, comparison_set, root_ids[bucket_id])) for bucket_id in bucket_ids)
+
+
+	def evaluate_nodes(self, comparison_set):
+
+		FALSE = self.FALSE
+		TRUE = self.TRUE
+		EMPTY = self.EMPTY
+		results = [None] * len(self.nodes)
+
+		for (node_id, node) in enumerate(self.nodes):
+			op = node[0]
+
+			if op == 'expr':
+				output = node[1] & comparison_set if node[1] else EMPTY
+				for child in node[2]:
+					# Child outputs are shared, never modified in place
+					output = output | results[child] if output else results[child]
+
+			elif op == 'some':
+				output = results[node[1]] - FALSE
+				if not output:
+					output = FALSE
+
+			elif op == 'all':
+				output = results[node[1]]
+				output = output - TRUE if all(output) else FALSE
+
+			elif op == 'not':
+				output = FALSE if any(results[node[1]]) else TRUE
+
+			else:
+				output = results[node[1]]
+				size = len(output)
+				limit = node[2]
+				if not ((op == 'exactly' and size == limit)
+					or (op == 'min' and size >= limit)
+					or (op == 'max' and size <= limit)):
+					output = FALSE
+
+			results[node_id] = output
+
+		return results
+
+
+	def get_rule(self, node_id):
+		"""
+		Rule dictionary for given node, e.g. to write a DAG back out as
+		bucket_rules.  owl:unionOf is written as owl:someValuesFrom unless
+		a sibling already has that key.
+		"""
+		node = self.nodes[node_id]
+		op = node[0]
+
+		if op == 'expr':
+			rule = OrderedDict((item, None) for item in sorted(node[1]))
+			for child in node[2]:
+				for (item, content) in self.get_rule(child).items():
+					# A rule may have both a someValuesFrom and a unionOf
+					if item in rule and item == 'owl:someValuesFrom':
+						item = 'owl:unionOf'
+					rule[item] = content
+			return rule
+
+		if op in ('exactly', 'min', 'max'):
+			return {self.OPERATORS[op]: {'limit': node[2], 'set': self.get_rule(node[1])}}
+
+		return {self.OPERATORS[op]: self.get_rule(node[1])}
+
+
+	def get_sharing_report(self, top = 10):
+		"""
+		Summary of subexpression sharing found in rule set, with the most
+		shared non-trivial nodes (by occurrences x subtree size).  Single
+		entity ids, and rule dictionaries that merely wrap one function, 
+		aren't listed.
+		"""
+		subtree_sizes = []
+		for node in self.nodes:
+			children = node[2] if node[0] == 'expr' else (node[1],)
+			subtree_sizes.append(1 + sum(subtree_sizes[child] for child in children))
+
+		shared = [node_id for node_id in range(len(self.nodes)) if self.references[node_id] > 1]
+		shared.sort(key = lambda node_id: -self.references[node_id] * subtree_sizes[node_id])
+
+		report = OrderedDict()
+		report['buckets'] = len(self.roots)
+		report['tree_nodes'] = self.tree_size
+		report['dag_nodes'] = len(self.nodes)
+		report['shared_nodes'] = len(shared)
+		report['evaluations_saved'] = self.tree_size - len(self.nodes)
+		report['saving'] = round(1 - float(len(self.nodes)) / self.tree_size, 4) if self.tree_size else 0.0
+		report['most_shared'] = [
+			OrderedDict([
+				('references', self.references[node_id]),
+				('size', subtree_sizes[node_id]),
+				('rule', json.dumps(self.get_rule(node_id)))
+			])
+			for node_id in shared if subtree_sizes[node_id] > 1 and not self.is_wrapper(node_id)
+		][0:top]
+
+		return report
+
+
+	def get_trace(self, results, comparison_set, node_id):
+		"""
+		Nested report of what each part of a node's expression matched, from
+		evaluate_nodes() results.  An expression lists the entity ids it
+		matched directly; a function gives its output, with True/False as
+		JSON booleans.
+		"""
+		node = self.nodes[node_id]
+		op = node[0]
+		trace = OrderedDict()
+
+		if op == 'expr':
+			trace['ids'] = sorted(node[1] & comparison_set)
+			trace['parts'] = [self.get_trace(results, comparison_set, child) for child in node[2]]
+			return trace
+
+		trace['rule'] = self.OPERATORS[op]
+		if op in ('exactly', 'min', 'max'):
+			trace['limit'] = node[2]
+		trace['output'] = sorted(results[node_id], key = str)
+		trace['set'] = self.get_trace(results, comparison_set, node[1])
+		return trace
+
+
+	def is_wrapper(self, node_id):
+
+		node = self.nodes[node_id]
+		return node[0] == 'expr' and not node[1] and len(node[2]) == 1
+
+
+class RuleOptimiser(object):
+	"""
+	Rewrites bucket rules into smaller equivalent ones. Each rewrite keeps
+	the exact output set of do_bucket_rule() for every comparison set, not
+	just whether a rule fires:
+
+	  - A someValuesFrom/unionOf operand of a someValuesFrom/unionOf is
+	    inlined, e.g. someValuesFrom(unionOf(a, b)) -> someValuesFrom(a, b). 
+	    (False outputs of inlined operands are discarded by the outer one
+	    anyway.)
+	  - An intersectionOf operand of an intersectionOf is inlined.
+	  - minQualifiedCardinality 1 over plain entity ids becomes 
+	    someValuesFrom; with ids alone neither can see a False or True.
+	  - Operands that evaluate to a constant regardless of comparison set
+	    are folded: dropped where they can't affect the result (False in a
+	    union or complement, True in an intersection, empty anywhere), or
+	    replaced by the smallest rule giving the same constant:
+	    {'owl:someValuesFrom': {}} for False, {'owl:complementOf': {}} for
+	    True.
+
+	Operands are not reordered by selectivity: RuleDAG evaluates every 
+	node for each comparison set, without short-circuiting, so order 
+	wouldn't change evaluation time.
+
+	Rewrites that would need two operands of a rule dictionary under the
+	same key are skipped.  Top-level bucket expressions are left as is
+	since a False there shows in the output set.
+	"""
+
+	FUNCTIONS = RuleDAG.FUNCTIONS
+	CARDINALITIES = ('exactly', 'min', 'max')
+	FALSE = RuleDAG.FALSE
+	TRUE = RuleDAG.TRUE
+	EMPTY = RuleDAG.EMPTY
+
+	def __init__(self):
+
+		self.counts = OrderedDict([
+			('unions_flattened', 0),
+			('intersections_flattened', 0),
+			('cardinalities_relaxed', 0),
+			('constants_folded', 0)
+		])
+
+
+	def get_optimised_rules(self, bucket_rules):
+
+		return OrderedDict((bucket_id, self.get_optimised_expression(rule, None)) for (bucket_id, rule) in bucket_rules.items())
+
+
+	def get_optimised_expression(self, rule, parent_op):
+		"""
+		Returns optimised copy of a rule dictionary that is the content of a
+		parent_op function (None at top level).
+		"""
+		items = []
+		for (item, content) in rule.items():
+			if item in self.FUNCTIONS:
+				content = self.get_optimised_function(item, content)
+			items.append((item, content))
+
+		items = self.get_relaxed_items(items)
+
+		if parent_op in ('some', 'all'):
+			items = self.get_flattened_items(items, parent_op)
+
+		if parent_op is not None:
+			items = self.get_folded_items(items, parent_op)
+
+		return OrderedDict(items)
+
+
+	def get_optimised_function(self, item, content):
+
+		op = self.FUNCTIONS[item]
+		if op in self.CARDINALITIES:
+			return {'limit': content['limit'], 'set': self.get_optimised_expression(content['set'], op)}
+
+		return self.get_optimised_expression(content, op)
+
+
+	def get_relaxed_items(self, items):
+		"""
+		Replaces minQualifiedCardinality 1 over plain entity ids with 
+		someValuesFrom, if a someValuesFrom/unionOf key is free.
+		"""
+		for (ptr, (item, content)) in enumerate(items):
+			if item == 'owl:minQualifiedCardinality' and content['limit'] == 1 \
+				and not any(key in self.FUNCTIONS for key in content['set']):
+				keys = [key for (key, value) in items]
+				for key in ['owl:someValuesFrom', 'owl:unionOf']:
+					if not key in keys:
+						items[ptr] = (key, content['set'])
+						self.counts['cardinalities_relaxed'] += 1
+						break
+
+		return items
+
+
+	def get_flattened_items(self, items, parent_op):
+		"""
+		Inlines operands having same function as parent into parent's
+		dictionary, where their keys fit.
+		"""
+		result = OrderedDict()
+		nested = []
+		for (item, content) in items:
+			if self.FUNCTIONS.get(item) == parent_op:
+				nested.append((item, content))
+			else:
+				result[item] = content
+
+		for (item, content) in nested:
+			merged = OrderedDict(result)
+			for (key, value) in content.items():
+				if not self.set_item(merged, key, value):
+					break
+			else:
+				result = merged
+				self.counts['unions_flattened' if parent_op == 'some' else 'intersections_flattened'] += 1
+				continue
+
+			if not self.set_item(result, item, content):
+				return items
+
+		return list(result.items())
+
+
+	def get_folded_items(self, items, parent_op):
+		"""
+		Drops or shrinks operands with a constant output.
+		"""
+		result = OrderedDict()
+		replaced = []
+		for (item, content) in items:
+			value = self.get_constant(item, content) if item in self.FUNCTIONS else None
+			if value is None:
+				result[item] = content
+
+			elif value == self.EMPTY \
+				or (value == self.FALSE and parent_op in ('some', 'not')) \
+				or (value == self.TRUE and parent_op == 'all'):
+				self.counts['constants_folded'] += 1
+
+			elif value == self.FALSE and (item, content) != ('owl:someValuesFrom', {}):
+				replaced.append((item, content, 'owl:someValuesFrom', {}))
+
+			elif value == self.TRUE and (item, content) != ('owl:complementOf', {}):
+				replaced.append((item, content, 'owl:complementOf', {}))
+
+			else:
+				result[item] = content
+
+		for (item, content, constant_item, constant_content) in replaced:
+			if self.set_item(result, constant_item, constant_content):
+				self.counts['constants_folded'] += 1
+			elif not self.set_item(result, item, content):
+				return items
+
+		return list(result.items())
+
+
+	def set_item(self, rule, item, content):
+		"""
+		Adds item to rule dictionary unless its key is taken. Entity ids 
+		can always be added; someValuesFrom can also go under unionOf.
+		"""
+		if not item in self.FUNCTIONS:
+			rule[item] = None
+			return True
+
+		if self.FUNCTIONS[item] == 'some':
+			keys = ['owl:someValuesFrom', 'owl:unionOf']
+		else:
+			keys = [item]
+
+		for key in keys:
+			if not key in rule:
+				rule[key] = content
+				return True
+
+		return False
+
+
+	def get_constant(self, item, content):
+		"""
+		Output of a rule function if it doesn't depend on comparison set,
+		else None.
+		"""
+		op = self.FUNCTIONS[item]
+		value = self.get_expression_constant(content['set'] if op in self.CARDINALITIES else content)
+		if value is None:
+			return None
+
+		if op == 'some':
+			return (value - self.FALSE) or self.FALSE
+		if op == 'all':
+			return value - self.TRUE if all(value) else self.FALSE
+		if op == 'not':
+			return self.FALSE if any(value) else self.TRUE
+
+		size = len(value)
+		limit = content['limit']
+		if (op == 'exactly' and size == limit) or (op == 'min' and size >= limit) or (op == 'max' and size <= limit):
+			return value
+		return self.FALSE
+
+
+	def get_expression_constant(self, rule):
+
+		value = self.EMPTY
+		for (item, content) in rule.items():
+			if not item in self.FUNCTIONS:
+				return None
+			item_value = self.get_constant(item, content)
+			if item_value is None:
+				return None
+			value = value | item_value
+
+		return value
+
+
+class RuleTrace(object):
+	"""
+	Per-bucket evaluation counters, and for the most recent comparison
+	sets a trace of which rule parts matched which ids in each triggered
+	bucket, for OntologyBuckets trace mode.  Times are of each bucket's
+	own rule dictionary evaluation by do_bucket_rule(), i.e. without the
+	sharing of RuleDAG, so they show which rules are costly in themselves.
+	"""
+
+	def __init__(self, limit = 100):
+
+		self.samples = 0
+		# bucket_id -> [evaluations, seconds, fired]
+		self.counters = OrderedDict()
+		# Traces of the last [limit] comparison sets
+		self.traces = collections.deque(maxlen = limit)
+
+
+	def add_evaluation(self, bucket_id, seconds, fired):
+
+		counter = self.counters.get(bucket_id)
+		if counter is None:
+			counter = self.counters[bucket_id] = [0, 0.0, 0]
+		counter[0] += 1
+		counter[1] += seconds
+		if fired:
+			counter[2] += 1
+
+
+	def add_sample(self, comparison_set, traces):
+
+		self.samples += 1
+		if self.traces.maxlen:
+			self.traces.append(OrderedDict([('ids', sorted(comparison_set, key = str)), ('buckets', traces)]))
+
+
+	def get_report(self):
+		"""
+		JSON-ready report, with buckets in descending order of cumulative
+		evaluation time.
+		"""
+		rules = OrderedDict()
+		for (bucket_id, (evaluations, seconds, fired)) in sorted(self.counters.items(), key = lambda counter: -counter[1][1]):
+			rules[bucket_id] = OrderedDict([
+				('evaluations', evaluations),
+				('ms', round(seconds * 1000, 4)),
+				('us_per_evaluation', round(seconds * 1000000 / evaluations, 3)),
+				('fired', fired),
+				('fire_rate', round(float(fired) / evaluations, 4))
+			])
+
+		report = OrderedDict()
+		report['samples'] = self.samples
+		report['ms'] = round(sum(counter[1] for counter in self.counters.values()) * 1000, 4)
+		report['rules'] = rules
+		report['traces'] = list(self.traces)
+		return report
+
+
+def get_rule_ids(rule):
+	"""
+	Set of entity ids a rule dictionary mentions. A rule's output depends 
+	only on which of these are in the comparison set.
+	"""
+	ids = set()
+	for (item, content) in rule.items():
+		if not item in RuleDAG.FUNCTIONS:
+			ids.add(item)
+		elif RuleDAG.FUNCTIONS[item] in RuleOptimiser.CARDINALITIES:
+			ids.update(get_rule_ids(content['set']))
+		else:
+			ids.update(get_rule_ids(content))
+
+	return ids
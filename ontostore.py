@@ -0,0 +1,378 @@
+#!/usr/bin/python
+
+""" **************************************************************************
+	Disk-backed rdflib graph store for OntoHelper.graph.
+
+	SQLiteStore keeps triples in a SQLite database file rather than in
+	memory, so an ontology bigger than available RAM can still be queried
+	by ontofetch.py and ontobucket.py.  Each distinct term (URI, blank node
+	or literal) is stored once in a terms table, and triples as rows of
+	three term ids with subject, predicate and object first indexes.  A
+	populated store file can be opened again by a later run without
+	parsing the ontology again.
+
+		import rdflib
+		import ontostore
+
+		graph = rdflib.Graph(store = ontostore.SQLiteStore())
+		graph.open('test/root-ontology.graph.sqlite', create = True)
+		graph.parse('test/root-ontology.owl', format = 'xml')
+		graph.store.commit()
+
+	Added triples are buffered and written in batches, so parsing into a
+	store is a bulk load.  Only the Python standard library sqlite3 module
+	is needed.
+
+	VersionedGraph, the graph class OntoHelper uses for either store, is
+	here too so that importing ontohelper doesn't import rdflib, as is
+	VersionedConjunctiveGraph, its named graph version for watch mode.
+
+	**************************************************************************
+"""
+
+import os
+import sqlite3
+import itertools
+
+import rdflib
+from rdflib.store import Store, VALID_STORE, NO_STORE
+
+
+class SQLiteStore(Store):
+	"""
+	A context-unaware rdflib Store (like the default Memory store as used
+	by OntoHelper), with a key/value metadata table for callers' use.
+	"""
+
+	context_aware = False
+	formula_aware = False
+	transaction_aware = False
+	graph_aware = False
+
+	# Number of added triples buffered before they are written.
+	BATCH_SIZE = 10000
+	# Number of term <-> id conversions kept in memory.
+	TERM_CACHE_SIZE = 200000
+	# SQLite page cache, in KiB.
+	CACHE_KB = 65536
+
+	SCHEMA = [
+		'CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, datatype TEXT NOT NULL, language TEXT NOT NULL)',
+		'CREATE UNIQUE INDEX IF NOT EXISTS term_key ON terms (value, kind, datatype, language)',
+		'CREATE TABLE IF NOT EXISTS triples (s INTEGER NOT NULL, p INTEGER NOT NULL, o INTEGER NOT NULL, PRIMARY KEY (s, p, o)) WITHOUT ROWID',
+		'CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s)',
+		'CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p)',
+		'CREATE TABLE IF NOT EXISTS namespaces (prefix TEXT PRIMARY KEY, uri TEXT NOT NULL)',
+		'CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)'
+	]
+
+	def __init__(self, configuration = None, identifier = None):
+
+		self.connection = None
+		self.path = None
+		# Added triples (as term id tuples) not yet written
+		self.pending = []
+		# (kind, value, datatype, language) -> id, and id -> rdflib term
+		self.term_ids = {}
+		self.terms = {}
+		super(SQLiteStore, self).__init__(configuration, identifier)
+
+
+	def open(self, configuration, create = True):
+		"""
+		Opens store in given SQLite file path, creating it if allowed.
+		"""
+		if not create and not os.path.isfile(configuration):
+			return NO_STORE
+
+		self.path = configuration
+		# ontoload.OntologyLoader parses in a thread of its own, while the
+		# opening thread waits, so the connection is never used by two
+		# threads at once.
+		self.connection = sqlite3.connect(configuration, check_same_thread = False)
+		self.connection.execute('PRAGMA cache_size = -%d' % self.CACHE_KB)
+		self.connection.execute('PRAGMA journal_mode = WAL')
+		self.connection.execute('PRAGMA synchronous = NORMAL')
+		for statement in self.SCHEMA:
+			self.connection.execute(statement)
+		self.connection.commit()
+		return VALID_STORE
+
+
+	def close(self, commit_pending_transaction = False):
+
+		if self.connection is not None:
+			self.commit()
+			self.connection.close()
+			self.connection = None
+
+
+	def destroy(self, configuration):
+
+		self.close()
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.isfile(configuration + suffix):
+				os.remove(configuration + suffix)
+
+
+	def commit(self):
+
+		self.flush()
+		self.connection.commit()
+
+
+	def rollback(self):
+
+		self.pending = []
+		self.connection.rollback()
+
+
+	def flush(self):
+		"""
+		Writes buffered added triples.
+		"""
+		if self.pending:
+			self.connection.executemany('INSERT OR IGNORE INTO triples VALUES (?, ?, ?)', self.pending)
+			self.pending = []
+
+
+	def clear(self):
+		"""
+		Removes all triples and terms, keeping namespaces and metadata.
+		"""
+		self.pending = []
+		self.term_ids = {}
+		self.terms = {}
+		self.connection.execute('DELETE FROM triples')
+		self.connection.execute('DELETE FROM terms')
+		self.connection.commit()
+
+
+	############################## Terms ##############################
+
+	def get_term_key(self, term):
+
+		if isinstance(term, rdflib.term.Literal):
+			return (str(term), 'L', str(term.datatype or ''), term.language or '')
+		if isinstance(term, rdflib.term.BNode):
+			return (str(term), 'B', '', '')
+		return (str(term), 'U', '', '')
+
+
+	def get_term_id(self, term, create = False):
+		"""
+		Database id of given term; None if it isn't stored (and create is
+		False).
+		"""
+		key = self.get_term_key(term)
+		term_id = self.term_ids.get(key)
+		if term_id is not None:
+			return term_id
+
+		row = self.connection.execute('SELECT id FROM terms WHERE value = ? AND kind = ? AND datatype = ? AND language = ?', key).fetchone()
+		if row:
+			term_id = row[0]
+		elif create:
+			term_id = self.connection.execute('INSERT INTO terms (value, kind, datatype, language) VALUES (?, ?, ?, ?)', key).lastrowid
+		else:
+			return None
+
+		if len(self.term_ids) >= self.TERM_CACHE_SIZE:
+			self.term_ids = {}
+		self.term_ids[key] = term_id
+		return term_id
+
+
+	def get_term(self, term_id, value, kind, datatype, language):
+
+		term = self.terms.get(term_id)
+		if term is None:
+			if kind == 'U':
+				term = rdflib.term.URIRef(value)
+			elif kind == 'B':
+				term = rdflib.term.BNode(value)
+			else:
+				term = rdflib.term.Literal(value, lang = language or None, datatype = datatype or None)
+
+			if len(self.terms) >= self.TERM_CACHE_SIZE:
+				self.terms = {}
+			self.terms[term_id] = term
+
+		return term
+
+
+	############################# Triples #############################
+
+	def add(self, triple, context, quoted = False):
+
+		(subject, predicate, obj) = triple
+		self.pending.append((self.get_term_id(subject, True), self.get_term_id(predicate, True), self.get_term_id(obj, True)))
+		if len(self.pending) >= self.BATCH_SIZE:
+			self.flush()
+
+
+	def addN(self, quads):
+
+		for (subject, predicate, obj, context) in quads:
+			self.add((subject, predicate, obj), context)
+
+
+	def get_pattern_sql(self, triple_pattern):
+		"""
+		Returns (SQL where clause, parameters) matching given triple
+		pattern, or None if a term in it isn't stored so nothing matches.
+		"""
+		clauses = []
+		parameters = []
+		for (column, term) in zip(('s', 'p', 'o'), triple_pattern):
+			if term is not None:
+				term_id = self.get_term_id(term)
+				if term_id is None:
+					return None
+				clauses.append('t.' + column + ' = ?')
+				parameters.append(term_id)
+
+		return (' WHERE ' + ' AND '.join(clauses) if clauses else '', parameters)
+
+
+	def remove(self, triple_pattern, context = None):
+
+		self.flush()
+		pattern = self.get_pattern_sql(triple_pattern)
+		if pattern is not None:
+			self.connection.execute('DELETE FROM triples AS t' + pattern[0], pattern[1])
+
+
+	def triples(self, triple_pattern, context = None):
+		"""
+		Generator of ((subject, predicate, object), contexts) for triples
+		matching given pattern, None being a wildcard.
+		"""
+		self.flush()
+		pattern = self.get_pattern_sql(triple_pattern)
+		if pattern is None:
+			return
+
+		# Only unbound positions need their terms fetched.
+		columns = ['t.s', 't.p', 't.o']
+		joins = []
+		unbound = [ptr for ptr in range(3) if triple_pattern[ptr] is None]
+		for ptr in unbound:
+			alias = 'n' + str(ptr)
+			columns.extend([alias + '.value', alias + '.kind', alias + '.datatype', alias + '.language'])
+			joins.append(' JOIN terms AS %s ON %s.id = t.%s' % (alias, alias, 'spo'[ptr]))
+
+		cursor = self.connection.execute('SELECT ' + ', '.join(columns) + ' FROM triples AS t' + ''.join(joins) + pattern[0], pattern[1])
+
+		for row in cursor:
+			triple = list(triple_pattern)
+			for (offset, ptr) in enumerate(unbound):
+				start = 3 + offset * 4
+				triple[ptr] = self.get_term(row[ptr], *row[start:start + 4])
+			yield (tuple(triple), iter(()))
+
+
+	def __len__(self, context = None):
+
+		self.flush()
+		return self.connection.execute('SELECT COUNT(*) FROM triples').fetchone()[0]
+
+
+	def contexts(self, triple = None):
+
+		return iter(())
+
+
+	############################ Namespaces ###########################
+
+	def bind(self, prefix, namespace, override = True):
+
+		row = self.connection.execute('SELECT prefix FROM namespaces WHERE uri = ?', (str(namespace),)).fetchone()
+		if row and not override:
+			return
+		if row:
+			self.connection.execute('DELETE FROM namespaces WHERE uri = ?', (str(namespace),))
+		self.connection.execute('INSERT OR REPLACE INTO namespaces VALUES (?, ?)', (prefix, str(namespace)))
+
+
+	def namespace(self, prefix):
+
+		row = self.connection.execute('SELECT uri FROM namespaces WHERE prefix = ?', (prefix,)).fetchone()
+		return rdflib.term.URIRef(row[0]) if row else None
+
+
+	def prefix(self, namespace):
+
+		row = self.connection.execute('SELECT prefix FROM namespaces WHERE uri = ?', (str(namespace),)).fetchone()
+		return row[0] if row else None
+
+
+	def namespaces(self):
+
+		for (prefix, uri) in self.connection.execute('SELECT prefix, uri FROM namespaces').fetchall():
+			yield (prefix, rdflib.term.URIRef(uri))
+
+
+	############################# Metadata ############################
+
+	def get_metadata(self, key):
+
+		row = self.connection.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else None
+
+
+	def set_metadata(self, key, value):
+
+		self.connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?)', (key, value))
+
+
+class VersionedGraph(rdflib.Graph):
+	"""
+	rdflib Graph whose version changes whenever triples are added or 
+	removed (including by parse(), which adds them), so that caches of
+	query results or other graph-derived data can tell when they are
+	stale.  Versions are unique across graphs, so a cache can't mistake a
+	replacement graph for the one it was filled from.
+	"""
+
+	versions = itertools.count(1)
+
+	def __init__(self, *args, **kwargs):
+
+		super(VersionedGraph, self).__init__(*args, **kwargs)
+		self.set_changed()
+
+
+	def set_changed(self):
+		"""
+		Gives graph a new version; call after changing its store directly.
+		"""
+		self.version = next(VersionedGraph.versions)
+
+
+	def add(self, triple):
+
+		self.version = next(VersionedGraph.versions)
+		return super(VersionedGraph, self).add(triple)
+
+
+	def addN(self, quads):
+
+		self.version = next(VersionedGraph.versions)
+		return super(VersionedGraph, self).addN(quads)
+
+
+	def remove(self, triple):
+
+		self.version = next(VersionedGraph.versions)
+		return super(VersionedGraph, self).remove(triple)
+
+
+class VersionedConjunctiveGraph(VersionedGraph, rdflib.ConjunctiveGraph):
+	"""
+	VersionedGraph of named graphs (in rdflib's default Memory store),
+	queried as their union.  Triples parsed or removed through one of its
+	named graphs (get_context()) bypass the version change, so call
+	set_changed() after.
+	"""
+	pass